@@ -1,5 +1,5 @@
 
-from . import compress, convert, files, merge, ocr, split, watermark
+from . import compress, convert, files, jobs, merge, ocr, split, watermark
 
 routers = [
     ocr.router,
@@ -9,6 +9,7 @@ routers = [
     convert.router,
     watermark.router,
     files.router,
+    jobs.router,
 ]
 
 __all__ = [
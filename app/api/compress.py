@@ -1,43 +1,59 @@
 ﻿from typing import Dict
 
-from fastapi import APIRouter, File, HTTPException, UploadFile, status
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
 
+from app.core.executor import get_executor
+from app.core.jobs import dispatch
 from app.core.logging import configure_logging
-from app.models import CompressionCommitRequest
+from app.models import CompressionCommitRequest, CompressionEstimateRequest
 from app.services.compression_service import CompressionService
+from app.storage.budget import get_disk_budget
+from app.storage.ingest import UploadIngestor, upload_openapi
 from app.storage.local import LocalStorage
-from app.storage.registry import get_document, register_document
-from app.utils.file_utils import ensure_pdf
-from app.utils.pdf_preview import render_page_preview
+from app.storage.registry import get_document, ingest_document
+from app.utils.pdf_preview import card_preview
 
 router = APIRouter(prefix="/pdf/compress", tags=["PDF Compression"])
 
 logger = configure_logging()
 storage = LocalStorage()
+ingestor = UploadIngestor(storage)
 compression_service = CompressionService(storage)
+executor = get_executor()
 
-ALLOWED_LEVELS = {"low", "medium", "high"}
+ALLOWED_LEVELS = {"low", "medium", "high", "scan"}
 
 
-def _card(entry) -> dict:
-  preview = render_page_preview(entry.path, 1)
+async def _card(entry) -> dict:
+  preview = await card_preview(entry.path, entry.sha256)
   card = entry.to_card(preview=preview)
   card["is_temp"] = True
   return card
 
 
-@router.post("/upload", summary="رفع ملف PDF للتحضير لعملية الضغط")
-async def upload_pdf(file: UploadFile = File(...)) -> dict:
-  ensure_pdf(file)
-  temp_path = storage.save_upload(file, temp=True)
-  entry = register_document(temp_path, file.filename, expect_pdf=True)
-  logger.info("تم رفع ملف للضغط: %s", file.filename)
-  return {"status": "ok", "file": _card(entry)}
+@router.post("/upload", summary="رفع ملف PDF للتحضير لعملية الضغط", openapi_extra=upload_openapi("file"))
+async def upload_pdf(request: Request) -> dict:
+  upload = await ingestor.receive_one(request, field="file", expect_pdf=True)
+  entry = await ingest_document(upload.path, upload.filename, expect_pdf=True, sha256=upload.sha256)
+  logger.info("تم رفع ملف للضغط: %s", upload.filename)
+  return {"status": "ok", "file": await _card(entry)}
+
+
+@router.post("/estimate", summary="تقدير حجم الناتج وزمن الضغط لكل مستوى دون ضغط الملف")
+async def estimate_compress(payload: CompressionEstimateRequest) -> dict:
+  entry = get_document(payload.file_id, require_pdf=True)
+  with get_disk_budget().pinned([entry.path]):
+    estimate = await compression_service.estimate_async(entry.path)
+  return {"status": "ok", "file_id": entry.file_id, **estimate}
 
 
 @router.post("/commit", summary="ضغط الملف بالمستوى المحدد وإرجاع بطاقة النتيجة")
-async def commit_compress(payload: CompressionCommitRequest) -> dict:
-  if payload.level not in ALLOWED_LEVELS:
+async def commit_compress(
+  payload: CompressionCommitRequest,
+  response: Response,
+  async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202)."),
+) -> dict:
+  if not payload.target_bytes and payload.level not in ALLOWED_LEVELS:
     raise HTTPException(
       status_code=status.HTTP_400_BAD_REQUEST,
       detail=f"مستوى الضغط غير مدعوم. الخيارات المتاحة: {', '.join(ALLOWED_LEVELS)}.",
@@ -46,38 +62,43 @@ async def commit_compress(payload: CompressionCommitRequest) -> dict:
   entry = get_document(payload.file_id, require_pdf=True)
   original_size = entry.size_bytes
 
-  compressed_path = compression_service.compress(entry.path, payload.level)
-  output_name = payload.output_filename or f"{entry.path.stem}_{payload.level}.pdf"
+  async def run() -> dict:
+    result = await compression_service.compress_async(entry.path, payload.level, target_bytes=payload.target_bytes)
+    compressed_path = result.path
+    output_name = payload.output_filename or f"{entry.path.stem}_{result.level}.pdf"
+
+    public_path = await executor.run_io(storage.register_public_download, compressed_path, output_name)
+    result_entry = await ingest_document(public_path, output_name, expect_pdf=True)
+
+    preview = await card_preview(public_path, result_entry.sha256)
+    result_card = result_entry.to_card(preview=preview)
+    result_card.update(
+      {
+        "download_url": f"/downloads/{public_path.name}",
+        "is_temp": False,
+      }
+    )
+
+    compressed_size = result_entry.size_bytes
+    reduction_bytes = max(0, original_size - compressed_size)
+    reduction_percent = round((reduction_bytes / original_size) * 100, 2) if original_size else 0
+
+    stats: Dict[str, float | int] = {
+      "original_size": original_size,
+      "compressed_size": compressed_size,
+      "reduction_bytes": reduction_bytes,
+      "reduction_percent": reduction_percent,
+      **result.as_dict(),
+    }
 
-  public_path = storage.register_public_download(compressed_path, output_name)
-  result_entry = register_document(public_path, output_name, expect_pdf=True)
+    logger.info("اكتملت عملية الضغط للملف %s بمستوى %s", entry.filename, result.level)
 
-  preview = render_page_preview(public_path, 1)
-  result_card = result_entry.to_card(preview=preview)
-  result_card.update(
-    {
-      "download_url": f"/downloads/{public_path.name}",
-      "is_temp": False,
+    return {
+      "status": "ok",
+      "message": "تم ضغط الملف بنجاح.",
+      "result": result_card,
+      "stats": stats,
+      "level": result.level,
     }
-  )
-
-  compressed_size = result_entry.size_bytes
-  reduction_bytes = max(0, original_size - compressed_size)
-  reduction_percent = round((reduction_bytes / original_size) * 100, 2) if original_size else 0
-
-  stats: Dict[str, float | int] = {
-    "original_size": original_size,
-    "compressed_size": compressed_size,
-    "reduction_bytes": reduction_bytes,
-    "reduction_percent": reduction_percent,
-  }
-
-  logger.info("اكتملت عملية الضغط للملف %s بمستوى %s", entry.filename, payload.level)
-
-  return {
-    "status": "ok",
-    "message": "تم ضغط الملف بنجاح.",
-    "result": result_card,
-    "stats": stats,
-    "level": payload.level,
-  }
+
+  return await dispatch("compress", run, async_mode=async_mode, response=response, pins=[entry.path])
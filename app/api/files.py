@@ -1,13 +1,29 @@
 ﻿from datetime import datetime
 from pathlib import Path
+from typing import Literal, Optional, Tuple
+from urllib.parse import urlencode
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException, Query, Response, status
 
+from app.core.config import get_settings
+from app.core.executor import get_executor
 from app.storage.local import LocalStorage
+from app.storage.registry import RegisteredFile, get_document
 from app.utils.file_utils import file_stats
+from app.utils.pdf_preview import (
+    IMAGE_MEDIA_TYPES,
+    contact_sheet_keys,
+    page_image_key,
+    render_contact_sheet_async,
+    render_page_image_async,
+)
 
 router = APIRouter(prefix="/files", tags=["Files"])
+settings = get_settings()
 storage = LocalStorage()
+executor = get_executor()
+
+PREVIEW_CACHE_CONTROL = "public, max-age=86400, immutable"
 
 
 @router.get("/", summary="قائمة الملفات المتاحة للتنزيل من المجلد العام")
@@ -27,3 +43,109 @@ async def list_files() -> dict:
             )
 
     return {"files": files}
+
+
+@router.get("/{file_id}/pages/{page_number}/preview", summary="صورة معاينة لصفحة بعرض محدد (بايتات الصورة مباشرة)")
+async def page_image(
+    file_id: str,
+    page_number: int,
+    width: int = Query(320, ge=16, le=2400, description="عرض الصورة بالبكسل."),
+    format: Literal["jpeg", "webp", "png"] = Query("jpeg", description="صيغة الصورة."),
+    quality: int = Query(75, ge=1, le=100, description="جودة JPEG/WebP."),
+    if_none_match: Optional[str] = Header(default=None),
+) -> Response:
+    entry = get_document(file_id, require_pdf=True)
+    if page_number < 1 or (entry.page_count is not None and page_number > entry.page_count):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"رقم الصفحة {page_number} خارج نطاق الملف ({entry.page_count} صفحة).",
+        )
+
+    # الجودة لا تؤثر على PNG، فنوحدها حتى لا تتكرر المدخلات في الذاكرة المؤقتة
+    quality = quality if format != "png" else 0
+    key = page_image_key(entry.path, page_number, width, format, quality, entry.sha256)
+
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": PREVIEW_CACHE_CONTROL}
+    if if_none_match and etag in {tag.strip() for tag in if_none_match.split(",")}:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    image_bytes, _ = await render_page_image_async(entry.path, page_number, width, format, quality, entry.sha256)
+    return Response(content=image_bytes, media_type=IMAGE_MEDIA_TYPES[format], headers=headers)
+
+
+def _sheet_range(entry: RegisteredFile, start: int, end: Optional[int]) -> Tuple[int, int]:
+    limit = settings.contact_sheet_max_pages
+    end = end if end is not None else min(entry.page_count, start + limit - 1)
+    if start > end or end > entry.page_count:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"المدى ({start}-{end}) خارج نطاق عدد الصفحات ({entry.page_count}).",
+        )
+    if end - start + 1 > limit:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"لا يمكن أن تضم لوحة المصغرات أكثر من {limit} صفحة.",
+        )
+    return start, end
+
+
+async def _render_sheet(entry: RegisteredFile, start: int, end: int, width: int, columns: int, fmt: str, quality: int):
+    try:
+        return await render_contact_sheet_async(entry.path, start, end, width, columns, fmt, quality, entry.sha256)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="أبعاد لوحة المصغرات تتجاوز الحد المسموح؛ قلل العرض أو عدد الصفحات أو زد عدد الأعمدة.",
+        ) from exc
+
+
+@router.get("/{file_id}/contact-sheet", summary="فهرس لوحة مصغرات الصفحات (مواقع المربعات ورابط الصورة)")
+async def contact_sheet(
+    file_id: str,
+    start: int = Query(1, ge=1, description="أول صفحة."),
+    end: Optional[int] = Query(None, ge=1, description="آخر صفحة (افتراضيًا حتى الحد الأقصى للوحة)."),
+    width: int = Query(120, ge=16, le=400, description="عرض المصغرة الواحدة بالبكسل."),
+    columns: int = Query(10, ge=1, le=50, description="عدد المصغرات في كل صف."),
+    format: Literal["jpeg", "webp"] = Query("jpeg", description="صيغة الصورة."),
+    quality: int = Query(70, ge=1, le=100, description="جودة JPEG/WebP."),
+) -> dict:
+    entry = get_document(file_id, require_pdf=True)
+    start, end = _sheet_range(entry, start, end)
+    _, index, key = await _render_sheet(entry, start, end, width, columns, format, quality)
+
+    query = urlencode(
+        {"start": start, "end": end, "width": width, "columns": columns, "format": format, "quality": quality}
+    )
+    return {
+        "status": "ok",
+        "sheet_url": f"/files/{file_id}/contact-sheet/image?{query}",
+        "etag": key,
+        "start": start,
+        "end": end,
+        **index,
+    }
+
+
+@router.get("/{file_id}/contact-sheet/image", summary="صورة لوحة مصغرات الصفحات (بايتات الصورة مباشرة)")
+async def contact_sheet_image(
+    file_id: str,
+    start: int = Query(1, ge=1, description="أول صفحة."),
+    end: Optional[int] = Query(None, ge=1, description="آخر صفحة (افتراضيًا حتى الحد الأقصى للوحة)."),
+    width: int = Query(120, ge=16, le=400, description="عرض المصغرة الواحدة بالبكسل."),
+    columns: int = Query(10, ge=1, le=50, description="عدد المصغرات في كل صف."),
+    format: Literal["jpeg", "webp"] = Query("jpeg", description="صيغة الصورة."),
+    quality: int = Query(70, ge=1, le=100, description="جودة JPEG/WebP."),
+    if_none_match: Optional[str] = Header(default=None),
+) -> Response:
+    entry = get_document(file_id, require_pdf=True)
+    start, end = _sheet_range(entry, start, end)
+    key, _ = contact_sheet_keys(entry.path, start, end, width, columns, format, quality, entry.sha256)
+
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": PREVIEW_CACHE_CONTROL}
+    if if_none_match and etag in {tag.strip() for tag in if_none_match.split(",")}:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    image_bytes, _, _ = await _render_sheet(entry, start, end, width, columns, format, quality)
+    return Response(content=image_bytes, media_type=IMAGE_MEDIA_TYPES[format], headers=headers)
@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+
+from app.core.jobs import get_job_manager
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+job_manager = get_job_manager()
+
+
+@router.get("/{job_id}", summary="حالة مهمة تعمل في الخلفية وبطاقة نتيجتها عند الاكتمال")
+async def get_job(job_id: str) -> dict:
+    job = job_manager.get(job_id)
+    return job.model_dump(mode="json")
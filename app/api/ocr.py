@@ -2,44 +2,47 @@
 from pathlib import Path
 from typing import Optional
 
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 
 from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.core.jobs import dispatch
 from app.core.logging import configure_logging
 from app.models import OCRCommitRequest
 from app.services.docx_builder import DocxBuilder
 from app.services.mistral_service import MistralService
+from app.storage.ingest import UploadIngestor, upload_openapi
 from app.storage.local import LocalStorage
-from app.storage.registry import get_document, register_document
-from app.utils.file_utils import ensure_pdf
-from app.utils.pdf_preview import render_page_preview
+from app.storage.registry import get_document, ingest_document
+from app.utils.pdf_preview import card_preview
 
 router = APIRouter(prefix="/ocr", tags=["OCR"])
 
 settings = get_settings()
 logger = configure_logging()
 storage = LocalStorage()
+ingestor = UploadIngestor(storage)
+executor = get_executor()
 
 
-def _card(entry) -> dict:
-    preview = render_page_preview(entry.path, page_number=1)
+async def _card(entry) -> dict:
+    preview = await card_preview(entry.path, entry.sha256)
     card = entry.to_card(preview=preview)
     card["is_temp"] = True
     return card
 
 
-@router.post("/upload", summary="رفع ملف PDF لمعالجته باستخدام Mistral OCR")
-async def upload_pdf(file: UploadFile = File(...)) -> dict:
-    ensure_pdf(file)
-    temp_path = storage.save_upload(file, temp=True)
-    entry = register_document(temp_path, file.filename, expect_pdf=True)
+@router.post("/upload", summary="رفع ملف PDF لمعالجته باستخدام Mistral OCR", openapi_extra=upload_openapi("file"))
+async def upload_pdf(request: Request) -> dict:
+    upload = await ingestor.receive_one(request, field="file", expect_pdf=True)
+    entry = await ingest_document(upload.path, upload.filename, expect_pdf=True, sha256=upload.sha256)
 
-    card = _card(entry)
+    card = await _card(entry)
 
     file_id = getattr(entry, "id", None) or card.get("file_id") or card.get("id")
     page_count = card.get("page_count", 0)
 
-    logger.info("تم رفع ملف لـ OCR: %s", file.filename)
+    logger.info("تم رفع ملف لـ OCR: %s", upload.filename)
     return {
         "status": "ok",
         "file": card,               # بطاقة للاستخدام العام
@@ -49,7 +52,11 @@ async def upload_pdf(file: UploadFile = File(...)) -> dict:
 
 
 @router.post("/commit", summary="تشغيل OCR وإنتاج ملف DOCX")
-async def commit_ocr(payload: OCRCommitRequest) -> dict:
+async def commit_ocr(
+    payload: OCRCommitRequest,
+    response: Response,
+    async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202)."),
+) -> dict:
     # 0) مجلدات آمنة
     downloads_dir: Path = settings.public_dir / "downloads"
     outputs_dir: Path = getattr(settings, "outputs_dir", settings.public_dir / "outputs")
@@ -68,56 +75,59 @@ async def commit_ocr(payload: OCRCommitRequest) -> dict:
     if not api_key:
         raise HTTPException(status_code=400, detail="Missing API key")
 
-    # 3) قراءة الملف
-    try:
-        file_bytes = entry.path.read_bytes()
-    except Exception as e:
-        logger.exception("Failed reading uploaded file")
-        raise HTTPException(status_code=500, detail=f"Failed to read uploaded file: {e}")
-
-    # 4) استدعاء خدمة Mistral (نقطة 502 إن فشلت)
-    try:
-        service = MistralService(api_key=api_key)
-        ocr_result = service.extract_text(file_bytes)  # يجب أن يعيد markdown/page_count/word_count
-    except Exception as e:
-        logger.exception("Mistral OCR call failed")
-        raise HTTPException(status_code=502, detail=f"OCR upstream failed: {e}")
-
-    # 5) بناء DOCX
-    try:
-        builder = DocxBuilder(output_dir=str(outputs_dir))
-        docx_path = Path(builder.markdown_to_docx(ocr_result.markdown))
-    except Exception as e:
-        logger.exception("DOCX build failed")
-        raise HTTPException(status_code=500, detail=f"DOCX build failed: {e}")
-
-    # 6) تسجيل ملف التحميل العام
-    output_name = payload.output_filename or f"{entry.path.stem}_ocr.docx"
-    try:
-        public_path = storage.register_public_download(docx_path, output_name)
-        result_entry = register_document(public_path, output_name, expect_pdf=False)
-    except Exception as e:
-        logger.exception("Register public download failed")
-        raise HTTPException(status_code=500, detail=f"Register public download failed: {e}")
-
-    # 7) الاستجابة
-    card = result_entry.to_card()
-    card.update({
-        "download_url": f"/downloads/{public_path.name}",
-        "page_count": getattr(ocr_result, "page_count", None),
-        "word_count": getattr(ocr_result, "word_count", None),
-        "is_temp": False,
-    })
-
-    logger.info("اكتمل OCR للملف %s وتم إنشاء %s", entry.filename, output_name)
-
-    return {
-        "status": "ok",
-        "message": "تم إنشاء ملف Word باستخدام Mistral OCR.",
-        "result": card,                                      # مثل الدمج
-        "output_filename": output_name,                      # مسطّح (للواجهة)
-        "download_url": f"/downloads/{public_path.name}",    # مسطّح (للواجهة)
-        "page_count": getattr(ocr_result, "page_count", None),
-        "word_count": getattr(ocr_result, "word_count", None),
-        "text_preview": getattr(ocr_result, "markdown", "")[:800],
-    }
+    async def run() -> dict:
+        # 3) قراءة الملف
+        try:
+            file_bytes = await executor.run_io(entry.path.read_bytes)
+        except Exception as e:
+            logger.exception("Failed reading uploaded file")
+            raise HTTPException(status_code=500, detail=f"Failed to read uploaded file: {e}")
+
+        # 4) استدعاء خدمة Mistral (نقطة 502 إن فشلت)
+        try:
+            service = MistralService(api_key=api_key)
+            ocr_result = await executor.run_io(service.extract_text, file_bytes, operation="ocr")  # يجب أن يعيد markdown/page_count/word_count
+        except Exception as e:
+            logger.exception("Mistral OCR call failed")
+            raise HTTPException(status_code=502, detail=f"OCR upstream failed: {e}")
+
+        # 5) بناء DOCX
+        try:
+            builder = DocxBuilder(output_dir=str(outputs_dir))
+            docx_path = Path(await executor.run_io(builder.markdown_to_docx, ocr_result.markdown))
+        except Exception as e:
+            logger.exception("DOCX build failed")
+            raise HTTPException(status_code=500, detail=f"DOCX build failed: {e}")
+
+        # 6) تسجيل ملف التحميل العام
+        output_name = payload.output_filename or f"{entry.path.stem}_ocr.docx"
+        try:
+            public_path = await executor.run_io(storage.register_public_download, docx_path, output_name)
+            result_entry = await ingest_document(public_path, output_name, expect_pdf=False)
+        except Exception as e:
+            logger.exception("Register public download failed")
+            raise HTTPException(status_code=500, detail=f"Register public download failed: {e}")
+
+        # 7) الاستجابة
+        card = result_entry.to_card()
+        card.update({
+            "download_url": f"/downloads/{public_path.name}",
+            "page_count": getattr(ocr_result, "page_count", None),
+            "word_count": getattr(ocr_result, "word_count", None),
+            "is_temp": False,
+        })
+
+        logger.info("اكتمل OCR للملف %s وتم إنشاء %s", entry.filename, output_name)
+
+        return {
+            "status": "ok",
+            "message": "تم إنشاء ملف Word باستخدام Mistral OCR.",
+            "result": card,                                      # مثل الدمج
+            "output_filename": output_name,                      # مسطّح (للواجهة)
+            "download_url": f"/downloads/{public_path.name}",    # مسطّح (للواجهة)
+            "page_count": getattr(ocr_result, "page_count", None),
+            "word_count": getattr(ocr_result, "word_count", None),
+            "text_preview": getattr(ocr_result, "markdown", "")[:800],
+        }
+
+    return await dispatch("ocr", run, async_mode=async_mode, response=response, pins=[entry.path])
@@ -1,40 +1,51 @@
-﻿from pathlib import Path
+﻿import asyncio
+import json
+import re
+from pathlib import Path
 from typing import List
 from uuid import uuid4
 
-from fastapi import APIRouter, File, HTTPException, UploadFile, status
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 
+from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.core.jobs import dispatch
 from app.core.logging import configure_logging
-from app.models import PagePreviewRequest, SplitCommitRequest
+from app.models import PagePreviewRequest, SplitBulkRequest, SplitCommitRequest
 from app.services.pdf_service import PDFService
+from app.storage.budget import get_disk_budget
+from app.storage.ingest import UploadIngestor, upload_openapi
 from app.storage.local import LocalStorage
-from app.storage.registry import get_document, register_document
-from app.utils.file_utils import ensure_pdf
-from app.utils.pdf_preview import render_page_preview
+from app.storage.registry import get_document, ingest_document
+from app.utils.file_utils import clean_temp_files, content_disposition, stream_zip
+from app.utils.pdf_preview import card_preview, render_page_preview_async, stream_page_previews
 
 router = APIRouter(prefix="/pdf/split", tags=["PDF Split"])
 
+settings = get_settings()
 logger = configure_logging()
 storage = LocalStorage()
+ingestor = UploadIngestor(storage)
 pdf_service = PDFService(storage)
+executor = get_executor()
 
 
-def _card(entry, *, temp: bool = True) -> dict:
-    preview = render_page_preview(entry.path, page_number=1)
+async def _card(entry, *, temp: bool = True) -> dict:
+    preview = await card_preview(entry.path, entry.sha256)
     card = entry.to_card(preview=preview)
     card["is_temp"] = temp
     return card
 
 
-@router.post("/upload", summary="رفع ملف PDF لتجهيز بيانات التقسيم")
-async def upload_pdf(file: UploadFile = File(...)) -> dict:
-    ensure_pdf(file)
-    temp_path = storage.save_upload(file, temp=True)
-    entry = register_document(temp_path, file.filename, expect_pdf=True)
-    logger.info("تم تسجيل ملف للتقسيم: %s", file.filename)
+@router.post("/upload", summary="رفع ملف PDF لتجهيز بيانات التقسيم", openapi_extra=upload_openapi("file"))
+async def upload_pdf(request: Request) -> dict:
+    upload = await ingestor.receive_one(request, field="file", expect_pdf=True)
+    entry = await ingest_document(upload.path, upload.filename, expect_pdf=True, sha256=upload.sha256)
+    logger.info("تم تسجيل ملف للتقسيم: %s", upload.filename)
     return {
         "status": "ok",
-        "file": _card(entry),
+        "file": await _card(entry),
         "page_count": entry.page_count,
     }
 
@@ -50,7 +61,8 @@ async def page_preview(payload: PagePreviewRequest) -> dict:
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"رقم الصفحة {page} خارج نطاق الملف ({entry.page_count} صفحة).",
             )
-        previews.append({"page": page, "preview": render_page_preview(entry.path, page)})
+        preview = await render_page_preview_async(entry.path, page, digest=entry.sha256)
+        previews.append({"page": page, "preview": preview})
 
     return {
         "status": "ok",
@@ -59,8 +71,39 @@ async def page_preview(payload: PagePreviewRequest) -> dict:
     }
 
 
+@router.post("/page-preview/stream", summary="معاينات الصفحات المطلوبة كسطور NDJSON تُرسل فور جاهزية كل صفحة")
+async def page_preview_stream(payload: PagePreviewRequest) -> StreamingResponse:
+    entry = get_document(payload.file_id, require_pdf=True)
+
+    limit = settings.preview_stream_max_pages
+    if len(payload.pages) > limit:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"لا يمكن طلب معاينة أكثر من {limit} صفحة في الطلب الواحد.",
+        )
+    for page in payload.pages:
+        if page < 1 or page > entry.page_count:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"رقم الصفحة {page} خارج نطاق الملف ({entry.page_count} صفحة).",
+            )
+
+    async def lines():
+        async for page, preview in stream_page_previews(
+            entry.path, payload.pages, chunk_size=settings.preview_stream_chunk_pages, digest=entry.sha256
+        ):
+            yield json.dumps({"page": page, "preview": preview}) + "\n"
+        yield json.dumps({"status": "ok", "page_count": entry.page_count}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 @router.post("/commit", summary="تنفيذ عملية التقسيم وإرجاع الملفات الناتجة")
-async def commit_split(payload: SplitCommitRequest) -> dict:
+async def commit_split(
+    payload: SplitCommitRequest,
+    response: Response,
+    async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202)."),
+) -> dict:
     entry = get_document(payload.file_id, require_pdf=True)
     ranges = [(r.start, r.end) for r in payload.ranges]
 
@@ -73,43 +116,115 @@ async def commit_split(payload: SplitCommitRequest) -> dict:
 
     logger.info("تنفيذ تقسيم للملف %s مع المديات %s", entry.filename, ranges)
 
-    output_paths = pdf_service.split(entry.path, ranges, payload.separate_files)
-    result_cards: List[dict] = []
+    async def run() -> dict:
+        output_paths = await executor.run_cpu("split", pdf_service.split, entry.path, ranges, payload.separate_files)
+        result_cards: List[dict] = []
 
-    if payload.separate_files:
-        grouped = zip(output_paths, ranges)
-    else:
-        combined_range = (ranges[0][0], ranges[-1][1])
-        grouped = [(output_paths[0], combined_range)]
-
-    base_stem = Path(entry.filename or "split").stem
-    for index, (chunk_path, page_range) in enumerate(grouped, start=1):
         if payload.separate_files:
-            range_label = f"{page_range[0]}-{page_range[1]}"
-            display_name = f"{base_stem}_{range_label}_{uuid4().hex[:6]}.pdf"
+            grouped = zip(output_paths, ranges)
         else:
-            display_name = f"{base_stem}_combined_{uuid4().hex[:6]}.pdf"
-
-        public_path = storage.register_public_download(chunk_path, display_name)
-        result_entry = register_document(public_path, display_name, expect_pdf=True)
-        preview = render_page_preview(public_path, 1)
-        card = result_entry.to_card(preview=preview)
-        card.update(
-            {
-                "download_url": f"/downloads/{public_path.name}",
-                "range": {"start": page_range[0], "end": page_range[1]},
-                "index": index,
-                "is_temp": False,
-            }
+            combined_range = (ranges[0][0], ranges[-1][1])
+            grouped = [(output_paths[0], combined_range)]
+
+        base_stem = Path(entry.filename or "split").stem
+        for index, (chunk_path, page_range) in enumerate(grouped, start=1):
+            if payload.separate_files:
+                range_label = f"{page_range[0]}-{page_range[1]}"
+                display_name = f"{base_stem}_{range_label}_{uuid4().hex[:6]}.pdf"
+            else:
+                display_name = f"{base_stem}_combined_{uuid4().hex[:6]}.pdf"
+
+            public_path = await executor.run_io(storage.register_public_download, chunk_path, display_name)
+            result_entry = await ingest_document(public_path, display_name, expect_pdf=True)
+            preview = await card_preview(public_path, result_entry.sha256)
+            card = result_entry.to_card(preview=preview)
+            card.update(
+                {
+                    "download_url": f"/downloads/{public_path.name}",
+                    "range": {"start": page_range[0], "end": page_range[1]},
+                    "index": index,
+                    "is_temp": False,
+                }
+            )
+            if not payload.separate_files:
+                card["ranges"] = [{"start": r.start, "end": r.end} for r in payload.ranges]
+            result_cards.append(card)
+
+        return {
+            "status": "ok",
+            "message": "تم تقسيم الملف بنجاح.",
+            "original": await _card(entry, temp=True),
+            "results": result_cards,
+            "separate_files": payload.separate_files,
+        }
+
+    return await dispatch("split", run, async_mode=async_mode, response=response, pins=[entry.path])
+
+
+def _chunk_name(stem: str, index: int, start: int, end: int, title: str) -> str:
+    label = re.sub(r"[^\w\- ]+", "", title).strip().replace(" ", "_")[:60] if title else f"{start}-{end}"
+    return f"{stem}_{index:03d}_{label or f'{start}-{end}'}.pdf"
+
+
+@router.post("/bulk", summary="تقسيم جماعي (كل N صفحة أو حسب الفهرس أو الحجم) وتنزيل المقاطع كملف ZIP متدفق")
+async def bulk_split(payload: SplitBulkRequest) -> StreamingResponse:
+    entry = get_document(payload.file_id, require_pdf=True)
+    if payload.mode == "every" and not payload.every_pages:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="يجب تحديد every_pages لوضع every.")
+    if payload.mode == "max_size" and not payload.max_chunk_bytes:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="يجب تحديد max_chunk_bytes لوضع max_size.")
+
+    budget = get_disk_budget()
+    with budget.pinned([entry.path]):
+        try:
+            plan = await executor.run_cpu(
+                "split",
+                pdf_service.plan_split,
+                entry.path,
+                payload.mode,
+                every_pages=payload.every_pages,
+                bookmark_level=payload.bookmark_level,
+                max_chunk_bytes=payload.max_chunk_bytes,
+            )
+        except ValueError as exc:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
+
+        # دفعة متجاورة لكل عامل، يفتح فيها المصدر مرة واحدة ويكتب مقاطعها
+        batch_size = -(-len(plan) // executor.cpu_workers)
+        batches = [plan[index : index + batch_size] for index in range(0, len(plan), batch_size)]
+        results = await asyncio.gather(
+            *(
+                executor.run_cpu("split_batch", pdf_service.write_ranges, entry.path, [(start, end) for start, end, _ in batch])
+                for batch in batches
+            ),
+            return_exceptions=True,
         )
-        if not payload.separate_files:
-            card["ranges"] = [{"start": r.start, "end": r.end} for r in payload.ranges]
-        result_cards.append(card)
 
-    return {
-        "status": "ok",
-        "message": "تم تقسيم الملف بنجاح.",
-        "original": _card(entry, temp=True),
-        "results": result_cards,
-        "separate_files": payload.separate_files,
-    }
+    paths = [path for result in results if isinstance(result, list) for path in result]
+    failure = next((result for result in results if isinstance(result, BaseException)), None)
+    if failure is not None:
+        await executor.run_io(clean_temp_files, paths)
+        raise failure
+
+    stem = Path(entry.filename or "split").stem
+    members = [
+        (_chunk_name(stem, index, start, end, title), path)
+        for index, ((start, end, title), path) in enumerate(zip(plan, paths), start=1)
+    ]
+    zip_name = payload.output_filename or f"{stem}_split_{uuid4().hex[:6]}.zip"
+    logger.info("تقسيم جماعي للملف %s (%s) إلى %s مقطع", entry.filename, payload.mode, len(members))
+
+    def archive():
+        # المقاطع ملفات مؤقتة تُحذف بعد إرسالها، وتبقى محمية من الإخلاء أثناء الإرسال
+        budget.pin(paths)
+        try:
+            yield from stream_zip(members)
+        finally:
+            budget.unpin(paths)
+            clean_temp_files(paths)
+
+    return StreamingResponse(
+        archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(zip_name)},
+    )
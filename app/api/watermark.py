@@ -1,30 +1,68 @@
-﻿from fastapi import APIRouter, File, HTTPException, UploadFile
+﻿import asyncio
+import json
+from pathlib import Path
+from typing import Dict, List
+from uuid import uuid4
 
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from PIL import Image, UnidentifiedImageError
+
+from app.core.executor import get_executor
+from app.core.jobs import dispatch
 from app.core.logging import configure_logging
-from app.models import WatermarkCommitRequest, WatermarkOptions
+from app.models import (
+    ImageWatermarkCommitRequest,
+    ImageWatermarkPreviewRequest,
+    WatermarkBatchRequest,
+    WatermarkCommitRequest,
+    WatermarkPreviewRequest,
+    WatermarkStyle,
+)
 from app.services.pdf_service import PDFService
+from app.storage.budget import get_disk_budget
+from app.storage.ingest import UploadIngestor, upload_openapi
 from app.storage.local import LocalStorage
-from app.storage.registry import get_document, register_document
-from app.utils.file_utils import ensure_pdf
-from app.utils.pdf_preview import render_page_preview
+from app.storage.registry import get_document, ingest_document
+from app.utils.file_utils import clean_temp_files, content_disposition, stream_zip
+from app.utils.pdf_preview import card_preview
 
 router = APIRouter(prefix="/pdf/watermark", tags=["PDF Watermark"])
 
 logger = configure_logging()
 storage = LocalStorage()
+ingestor = UploadIngestor(storage)
 pdf_service = PDFService(storage)
+executor = get_executor()
 
 ALLOWED_POSITIONS = {"center", "top", "bottom", "diagonal", "tile"}
+ALLOWED_IMAGE_FORMATS = {"PNG", "JPEG"}
 
 
-def _card(entry) -> dict:
-    preview = render_page_preview(entry.path, 1)
+async def _card(entry) -> dict:
+    preview = await card_preview(entry.path, entry.sha256)
     card = entry.to_card(preview=preview)
     card["is_temp"] = True
     return card
 
 
-def _validate_options(options: WatermarkOptions) -> None:
+def _image_format(path: Path) -> str | None:
+    try:
+        with Image.open(path) as image:
+            image.verify()
+            return image.format
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        return None
+
+
+def _get_image(image_id: str):
+    entry = get_document(image_id)
+    if entry.is_pdf or entry.extension.lower() not in {"png", "jpg", "jpeg"}:
+        raise HTTPException(status_code=400, detail="صورة العلامة المائية يجب أن تكون PNG أو JPEG.")
+    return entry
+
+
+def _validate_options(options: WatermarkStyle) -> None:
     if options.position not in ALLOWED_POSITIONS:
         raise HTTPException(
             status_code=400,
@@ -34,57 +72,276 @@ def _validate_options(options: WatermarkOptions) -> None:
         raise HTTPException(status_code=400, detail="يجب أن تكون قيمة الشفافية بين 0 و 1.")
 
 
-@router.post("/upload", summary="رفع ملف لتحضير تطبيق العلامة المائية")
-async def upload_pdf(file: UploadFile = File(...)) -> dict:
-    ensure_pdf(file)
-    temp_path = storage.save_upload(file, temp=True)
-    entry = register_document(temp_path, file.filename, expect_pdf=True)
-    logger.info("تم رفع ملف للعلامة المائية: %s", file.filename)
-    return {"status": "ok", "file": _card(entry)}
+@router.post("/upload", summary="رفع ملف لتحضير تطبيق العلامة المائية", openapi_extra=upload_openapi("file"))
+async def upload_pdf(request: Request) -> dict:
+    upload = await ingestor.receive_one(request, field="file", expect_pdf=True)
+    entry = await ingest_document(upload.path, upload.filename, expect_pdf=True, sha256=upload.sha256)
+    logger.info("تم رفع ملف للعلامة المائية: %s", upload.filename)
+    return {"status": "ok", "file": await _card(entry)}
 
 
 @router.post("/preview", summary="عرض معاينة فورية للعلامة المائية")
-async def preview_watermark(options: WatermarkOptions) -> dict:
+async def preview_watermark(options: WatermarkPreviewRequest) -> dict:
     _validate_options(options)
     entry = get_document(options.file_id, require_pdf=True)
-    preview_image = pdf_service.preview_text_watermark(
-        entry.path,
-        text=options.text,
-        opacity=options.opacity,
-        position=options.position,
-        font_size=options.font_size or None,
-    )
+    try:
+        preview_image = await executor.run_cpu(
+            "preview",
+            pdf_service.preview_text_watermark,
+            entry.path,
+            text=options.text,
+            opacity=options.opacity,
+            position=options.position,
+            font_size=options.font_size or None,
+            page_number=options.page_number,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {
+        "status": "ok",
+        "preview": preview_image,
+    }
+
+
+@router.post(
+    "/image/upload",
+    summary="رفع صورة شعار (PNG أو JPEG) لاستخدامها كعلامة مائية",
+    openapi_extra=upload_openapi("file"),
+)
+async def upload_watermark_image(request: Request) -> dict:
+    upload = await ingestor.receive_one(request, field="file", expect_pdf=False)
+    if await executor.run_io(_image_format, upload.path) not in ALLOWED_IMAGE_FORMATS:
+        await executor.run_io(storage.cleanup, [upload.path])
+        raise HTTPException(status_code=400, detail="صورة العلامة المائية يجب أن تكون PNG أو JPEG.")
+    entry = await ingest_document(upload.path, upload.filename, expect_pdf=False, sha256=upload.sha256)
+    logger.info("تم رفع صورة للعلامة المائية: %s", upload.filename)
+    return {"status": "ok", "image": entry.to_card()}
+
+
+@router.post("/image/preview", summary="عرض معاينة فورية لعلامة مائية من صورة")
+async def preview_image_watermark(options: ImageWatermarkPreviewRequest) -> dict:
+    _validate_options(options)
+    entry = get_document(options.file_id, require_pdf=True)
+    image = _get_image(options.image_id)
+    try:
+        preview_image = await executor.run_cpu(
+            "preview",
+            pdf_service.preview_image_watermark,
+            entry.path,
+            image.path,
+            opacity=options.opacity,
+            position=options.position,
+            scale=options.scale,
+            page_number=options.page_number,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
     return {
         "status": "ok",
         "preview": preview_image,
     }
 
 
+@router.post("/image/commit", summary="تطبيق علامة مائية من صورة وإرجاع ملف جديد")
+async def commit_image_watermark(
+    payload: ImageWatermarkCommitRequest,
+    response: Response,
+    async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202)."),
+) -> dict:
+    _validate_options(payload)
+    entry = get_document(payload.file_id, require_pdf=True)
+    image = _get_image(payload.image_id)
+
+    async def run() -> dict:
+        result_path = await executor.run_cpu(
+            "watermark",
+            pdf_service.add_image_watermark,
+            entry.path,
+            image.path,
+            opacity=payload.opacity,
+            position=payload.position,
+            scale=payload.scale,
+        )
+
+        output_name = payload.output_filename or f"{entry.path.stem}_wm.pdf"
+        public_path = await executor.run_io(storage.register_public_download, result_path, output_name)
+        result_entry = await ingest_document(public_path, output_name, expect_pdf=True)
+
+        preview = await card_preview(public_path, result_entry.sha256)
+        card = result_entry.to_card(preview=preview)
+        card["download_url"] = f"/downloads/{public_path.name}"
+        card["is_temp"] = False
+
+        logger.info("تم تطبيق علامة مائية من صورة على الملف %s", entry.filename)
+
+        return {
+            "status": "ok",
+            "message": "تم تطبيق العلامة المائية بنجاح.",
+            "result": card,
+        }
+
+    return await dispatch("watermark", run, async_mode=async_mode, response=response, pins=[entry.path, image.path])
+
+
 @router.post("/commit", summary="تطبيق العلامة المائية وإرجاع ملف جديد")
-async def commit_watermark(payload: WatermarkCommitRequest) -> dict:
+async def commit_watermark(
+    payload: WatermarkCommitRequest,
+    response: Response,
+    async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202)."),
+) -> dict:
     _validate_options(payload)
     entry = get_document(payload.file_id, require_pdf=True)
 
-    result_path = pdf_service.add_text_watermark(
-        entry.path,
+    async def run() -> dict:
+        result_path = await executor.run_cpu(
+            "watermark",
+            pdf_service.add_text_watermark,
+            entry.path,
+            text=payload.text,
+            opacity=payload.opacity,
+            position=payload.position,
+            font_size=payload.font_size or None,
+        )
+
+        output_name = payload.output_filename or f"{entry.path.stem}_wm.pdf"
+        public_path = await executor.run_io(storage.register_public_download, result_path, output_name)
+        result_entry = await ingest_document(public_path, output_name, expect_pdf=True)
+
+        preview = await card_preview(public_path, result_entry.sha256)
+        card = result_entry.to_card(preview=preview)
+        card["download_url"] = f"/downloads/{public_path.name}"
+        card["is_temp"] = False
+
+        logger.info("تم تطبيق العلامة المائية على الملف %s", entry.filename)
+
+        return {
+            "status": "ok",
+            "message": "تم تطبيق العلامة المائية بنجاح.",
+            "result": card,
+        }
+
+    return await dispatch("watermark", run, async_mode=async_mode, response=response, pins=[entry.path])
+
+
+def _batch_error(file_id: str, exc: BaseException) -> dict:
+    detail = exc.detail if isinstance(exc, HTTPException) else "تعذر تطبيق العلامة المائية على هذا الملف."
+    return {"file_id": file_id, "error": detail}
+
+
+def _zip_member_names(filenames: List[str]) -> List[str]:
+    names: List[str] = []
+    seen: Dict[str, int] = {}
+    for filename in filenames:
+        stem = Path(filename).stem or "document"
+        count = seen.get(stem, 0)
+        seen[stem] = count + 1
+        names.append(f"{stem}_wm.pdf" if not count else f"{stem}_wm_{count + 1}.pdf")
+    return names
+
+
+@router.post("/batch", summary="تطبيق العلامة المائية نفسها على عدة ملفات مسجلة بالتوازي")
+async def batch_watermark(
+    payload: WatermarkBatchRequest,
+    response: Response,
+    async_mode: bool = Query(False, description="تنفيذ العملية في الخلفية وإرجاع معرف مهمة (202). غير متاح مع output=zip."),
+):
+    _validate_options(payload)
+    if async_mode and payload.output == "zip":
+        # الأرشيف يُبث مباشرة في الاستجابة ولا يُحفظ كنتيجة مهمة
+        raise HTTPException(status_code=400, detail="وضع التنفيذ في الخلفية غير متاح مع output=zip.")
+
+    entries = {}
+    errors: List[dict] = []
+    for file_id in dict.fromkeys(payload.file_ids):
+        try:
+            entries[file_id] = get_document(file_id, require_pdf=True)
+        except HTTPException as exc:
+            errors.append(_batch_error(file_id, exc))
+    if not entries:
+        raise HTTPException(status_code=404, detail="لم يُعثر على أي من الملفات المطلوبة.")
+
+    style = dict(
         text=payload.text,
         opacity=payload.opacity,
         position=payload.position,
         font_size=payload.font_size or None,
     )
 
-    output_name = payload.output_filename or f"{entry.path.stem}_wm.pdf"
-    public_path = storage.register_public_download(result_path, output_name)
-    result_entry = register_document(public_path, output_name, expect_pdf=True)
+    async def stamp_all() -> Dict[str, BaseException | Path]:
+        # الأختام تُبنى مرة واحدة لكل مقاسات الصفحات المعروفة من التسجيل ثم تُمرر جاهزة إلى كل عامل
+        sizes = {tuple(size) for entry in entries.values() for size in (entry.page_sizes or [])}
+        stamps = await executor.run_cpu("watermark", pdf_service.build_watermark_stamps, sizes, **style)
+        results = await asyncio.gather(
+            *(
+                executor.run_cpu("watermark_batch", pdf_service.add_text_watermark, entry.path, stamps=stamps, **style)
+                for entry in entries.values()
+            ),
+            return_exceptions=True,
+        )
+        for file_id, result in zip(entries, results):
+            if isinstance(result, BaseException):
+                logger.warning("فشل تطبيق العلامة المائية على الملف %s: %s", file_id, result)
+        return dict(zip(entries, results))
 
-    card = result_entry.to_card(preview=render_page_preview(public_path, 1))
-    card["download_url"] = f"/downloads/{public_path.name}"
-    card["is_temp"] = False
+    pins = [entry.path for entry in entries.values()]
 
-    logger.info("تم تطبيق العلامة المائية على الملف %s", entry.filename)
+    if payload.output == "zip":
+        budget = get_disk_budget()
+        with budget.pinned(pins):
+            results = await stamp_all()
 
-    return {
-        "status": "ok",
-        "message": "تم تطبيق العلامة المائية بنجاح.",
-        "result": card,
-    }
+        paths = [result for result in results.values() if isinstance(result, Path)]
+        done = [file_id for file_id, result in results.items() if isinstance(result, Path)]
+        errors += [_batch_error(file_id, result) for file_id, result in results.items() if not isinstance(result, Path)]
+        if not paths:
+            raise HTTPException(status_code=500, detail="تعذر تطبيق العلامة المائية على أي من الملفات.")
+
+        members = list(zip(_zip_member_names([entries[file_id].filename for file_id in done]), paths))
+        if errors:
+            report_bytes = json.dumps(errors, ensure_ascii=False, indent=2).encode("utf-8")
+            report = await executor.run_io(storage.save_bytes, report_bytes, suffix=".json")
+            members.append(("errors.json", report))
+            paths.append(report)
+        zip_name = payload.output_filename or f"watermarked_{uuid4().hex[:6]}.zip"
+        logger.info("تم تطبيق العلامة المائية على %s ملفات (فشل %s).", len(done), len(errors))
+
+        def archive():
+            budget.pin(paths)
+            try:
+                yield from stream_zip(members)
+            finally:
+                budget.unpin(paths)
+                clean_temp_files(paths)
+
+        return StreamingResponse(
+            archive(),
+            media_type="application/zip",
+            headers={"Content-Disposition": content_disposition(zip_name), "X-Batch-Errors": str(len(errors))},
+        )
+
+    async def run() -> dict:
+        results = await stamp_all()
+        cards: List[dict] = []
+        failures = list(errors)
+        for file_id, result in results.items():
+            if not isinstance(result, Path):
+                failures.append(_batch_error(file_id, result))
+                continue
+            output_name = f"{Path(entries[file_id].filename).stem}_wm.pdf"
+            public_path = await executor.run_io(storage.register_public_download, result, output_name)
+            result_entry = await ingest_document(public_path, output_name, expect_pdf=True)
+            card = result_entry.to_card(preview=await card_preview(public_path, result_entry.sha256))
+            card["download_url"] = f"/downloads/{public_path.name}"
+            card["is_temp"] = False
+            card["source_file_id"] = file_id
+            cards.append(card)
+
+        logger.info("تم تطبيق العلامة المائية على %s ملفات (فشل %s).", len(cards), len(failures))
+        return {
+            "status": "ok" if not failures else "partial",
+            "message": "تم تطبيق العلامة المائية على الملفات.",
+            "results": cards,
+            "errors": failures,
+        }
+
+    return await dispatch("watermark", run, async_mode=async_mode, response=response, pins=pins)
@@ -27,14 +27,81 @@ class Settings(BaseSettings):
 
     allow_origins: list[str] = Field(default_factory=lambda: ["*"])
 
+    # طبقة التنفيذ: عدد عمليات المعالجة الثقيلة وخيوط الإدخال/الإخراج
+    cpu_workers: Optional[int] = None
+    io_workers: int = 8
+    worker_start_method: str = "spawn"
+    operation_limits: dict[str, int] = Field(
+        default_factory=lambda: {
+            "merge": 2,
+            "split": 2,
+            # split_batch (دفعات التقسيم الجماعي) حدها الافتراضي عدد العمال، انظر BATCH_OPERATIONS
+            "compress": 2,
+            # دفعات إعادة ترميز الصور لملف واحد تتوزع على كل العمال
+            "compress_images": 8,
+            "watermark": 2,
+            # watermark_batch (ملفات الدفعة الواحدة) حدها الافتراضي عدد العمال، انظر BATCH_OPERATIONS
+            "convert": 2,
+            "preview": 4,
+            "inspect": 4,
+        }
+    )
+    default_operation_limit: int = 2
+    # محرك الدمج: pymupdf (افتراضي) أو pypdf
+    merge_engine: str = "pymupdf"
+
+    # سجل الملفات المرفوعة: sqlite (مشترك بين العمال) أو memory
+    registry_backend: str = "sqlite"
+    registry_path: Optional[Path] = None
+    registry_cache_size: int = 256
+
+    # مدة الاحتفاظ بالملفات حسب الفئة، والمنظف الدوري
+    temp_ttl_seconds: int = 2 * 3600
+    processed_ttl_seconds: int = 2 * 3600
+    public_ttl_seconds: int = 24 * 3600
+    sweep_interval_seconds: int = 300
+    sweep_batch_size: int = 500
+
+    # ميزانية القرص: عند تجاوز العلامة العليا تُحذف الملفات الأقدم استخدامًا حتى العلامة الدنيا.
+    # دون قيمة صريحة تُعتبر الميزانية المساحة المستخدمة حاليًا مع المساحة الحرة على القرص.
+    disk_budget_bytes: Optional[int] = None
+    disk_high_watermark: float = 0.9
+    disk_low_watermark: float = 0.75
+    disk_eviction_grace_seconds: int = 60
+
+    # الحد الأقصى لحجم الملف المرفوع الواحد
+    max_upload_bytes: int = 200 * 1024 * 1024
+
+    # المهام غير المتزامنة لنقاط commit
+    job_workers: int = 4
+    job_result_ttl_seconds: int = 3600
+
+    # ذاكرة معاينات الصفحات (ذاكرة + قرص)
+    preview_cache_dir: Optional[Path] = None
+    preview_cache_items: int = 256
+    preview_cache_disk_bytes: int = 256 * 1024 * 1024
+    # تضمين معاينة base64 داخل البطاقات (يمكن تعطيلها والاكتفاء بـ preview_url)
+    inline_previews: bool = True
+    # المعاينات المتدفقة: الحد الأقصى لصفحات الطلب الواحد وعدد الصفحات في كل دفعة رسم
+    preview_stream_max_pages: int = 200
+    preview_stream_chunk_pages: int = 8
+    # الحد الأقصى لعدد الصفحات في لوحة المصغرات الواحدة
+    contact_sheet_max_pages: int = 300
+    # عدد مستندات PDF المفتوحة المحتفظ بها في كل عملية (كل مستند يشغل واصف ملف)
+    document_cache_size: int = 16
+    # المستند غير المستخدم منذ هذه المدة يُغلق، فلا يبقي عامل خامل ملفات محذوفة مفتوحة
+    document_cache_idle_seconds: float = 30.0
+
     def configure_paths(self) -> None:
         """تهيئة المسارات الافتراضية وإنشاء المجلدات في حال غيابها."""
         self.storage_dir = (self.storage_dir or (self.base_dir / "outputs")).resolve()
         self.public_dir = (self.public_dir or (self.base_dir / "public")).resolve()
         self.outputs_dir = (self.outputs_dir or (self.storage_dir / "processed")).resolve()
         self.temp_dir = (self.temp_dir or (self.storage_dir / "tmp")).resolve()
+        self.preview_cache_dir = (self.preview_cache_dir or (self.storage_dir / "previews")).resolve()
+        self.registry_path = (self.registry_path or (self.storage_dir / "registry.sqlite3")).resolve()
 
-        for directory in (self.storage_dir, self.outputs_dir, self.temp_dir, self.public_dir):
+        for directory in (self.storage_dir, self.outputs_dir, self.temp_dir, self.public_dir, self.preview_cache_dir):
             directory.mkdir(parents=True, exist_ok=True)
 
         (self.public_dir / "downloads").mkdir(parents=True, exist_ok=True)
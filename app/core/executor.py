@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from .config import Settings, get_settings
+from .logging import configure_logging
+
+T = TypeVar("T")
+
+# عمليات تُقسم فيها مهمة واحدة إلى دفعات بعدد العمال؛ حدها الافتراضي عدد العمال لا حد العملية الأم
+BATCH_OPERATIONS = ("split_batch", "watermark_batch")
+
+logger = configure_logging()
+
+
+@dataclass
+class OperationStats:
+    limit: int
+    waiting: int = 0
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "limit": self.limit,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+class ExecutionPool:
+    """
+    طبقة تنفيذ مشتركة تُبعد الأعمال الحاجبة عن حلقة الأحداث.
+
+    - العمليات الثقيلة على المعالج (PyMuPDF/pypdf/reportlab) تُرسل إلى مجمع عمليات.
+    - عمليات الملفات تُرسل إلى مجمع خيوط.
+    - لكل عملية حد أقصى للتزامن مع عدّادات لعمق الطابور.
+    """
+
+    def __init__(self, settings: Optional[Settings] = None) -> None:
+        settings = settings or get_settings()
+        self.cpu_workers = settings.cpu_workers or os.cpu_count() or 1
+        self.io_workers = max(1, settings.io_workers)
+        self.start_method = settings.worker_start_method
+        self.operation_limits = dict(settings.operation_limits)
+        self.operation_limits.setdefault("io", self.io_workers)
+        # دفعات العملية الواحدة (مقاطع التقسيم الجماعي وملفات العلامة المائية الجماعية) تتوزع على كل العمال
+        for operation in BATCH_OPERATIONS:
+            self.operation_limits.setdefault(operation, self.cpu_workers)
+        self.default_limit = max(1, settings.default_operation_limit)
+
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, OperationStats] = {}
+
+    # ------------------------------------------------------------------
+    # المجمعات
+    # ------------------------------------------------------------------
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._process_pool is None:
+                context = multiprocessing.get_context(self.start_method)
+                self._process_pool = ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=context)
+            return self._process_pool
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="pdf-io")
+            return self._thread_pool
+
+    def _reset_process_pool(self) -> None:
+        with self._pool_lock:
+            pool, self._process_pool = self._process_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    # ------------------------------------------------------------------
+    # التنفيذ
+    # ------------------------------------------------------------------
+    def _operation(self, operation: str) -> tuple[asyncio.Semaphore, OperationStats]:
+        semaphore = self._semaphores.get(operation)
+        if semaphore is None:
+            limit = max(1, self.operation_limits.get(operation, self.default_limit))
+            semaphore = self._semaphores[operation] = asyncio.Semaphore(limit)
+            self._stats[operation] = OperationStats(limit=limit)
+        return semaphore, self._stats[operation]
+
+    async def _submit(self, operation: str, executor: Executor, call: Callable[[], T]) -> T:
+        semaphore, stats = self._operation(operation)
+        loop = asyncio.get_running_loop()
+
+        stats.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            stats.waiting -= 1
+
+        stats.running += 1
+        try:
+            result = await loop.run_in_executor(executor, call)
+        except Exception:
+            stats.failed += 1
+            raise
+        else:
+            stats.completed += 1
+            return result
+        finally:
+            stats.running -= 1
+            semaphore.release()
+
+    async def run_cpu(self, operation: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """تشغيل دالة ثقيلة على المعالج داخل مجمع العمليات مع احترام حد العملية."""
+        call = partial(func, *args, **kwargs)
+        try:
+            return await self._submit(operation, self.process_pool, call)
+        except BrokenProcessPool:
+            logger.warning("تعطل مجمع العمليات أثناء %s، ستتم إعادة إنشائه.", operation)
+            self._reset_process_pool()
+            raise
+
+    async def run_io(self, func: Callable[..., T], *args: Any, operation: str = "io", **kwargs: Any) -> T:
+        """تشغيل عملية ملفات حاجبة داخل مجمع الخيوط."""
+        call = partial(func, *args, **kwargs)
+        return await self._submit(operation, self.thread_pool, call)
+
+    # ------------------------------------------------------------------
+    # التقارير والإيقاف
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        operations = {name: stats.as_dict() for name, stats in self._stats.items()}
+        return {
+            "cpu_workers": self.cpu_workers,
+            "io_workers": self.io_workers,
+            "queue_depth": sum(stats.waiting for stats in self._stats.values()),
+            "running": sum(stats.running for stats in self._stats.values()),
+            "operations": operations,
+        }
+
+    def shutdown(self) -> None:
+        with self._pool_lock:
+            process_pool, self._process_pool = self._process_pool, None
+            thread_pool, self._thread_pool = self._thread_pool, None
+        if process_pool is not None:
+            process_pool.shutdown(wait=True, cancel_futures=True)
+        if thread_pool is not None:
+            thread_pool.shutdown(wait=True, cancel_futures=True)
+
+
+@lru_cache()
+def get_executor() -> ExecutionPool:
+    return ExecutionPool()
@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from fastapi import HTTPException, Response, status
+
+from app.models.common import FileDescriptor, JobMetadata, JobStatus
+from app.storage.budget import get_disk_budget
+from app.utils.process import process_alive
+
+from .config import Settings, get_settings
+from .logging import configure_logging
+
+logger = configure_logging()
+
+JobFactory = Callable[[], Awaitable[dict]]
+
+_EPOCH = datetime(1970, 1, 1)
+
+# رسالة المهام التي لم تكتمل لأن العامل الذي يُنفذها توقف (إيقاف أو إعادة نشر أو انهيار)
+INTERRUPTED_MESSAGE = "توقف الخادم قبل اكتمال المهمة؛ يرجى إعادة إرسال الطلب."
+
+
+class MemoryJobStore:
+    """سجلات المهام داخل ذاكرة العملية (مناسب لعامل uvicorn واحد أو للاختبارات)."""
+
+    def __init__(self) -> None:
+        self._jobs: Dict[str, JobMetadata] = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: JobMetadata) -> None:
+        with self._lock:
+            self._jobs[job.job_id] = job.model_copy(deep=True)
+
+    def get(self, job_id: str) -> Optional[JobMetadata]:
+        job = self._jobs.get(job_id)
+        return job.model_copy(deep=True) if job is not None else None
+
+    def purge_expired(self, now: datetime) -> None:
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job.expires_at and job.expires_at <= now]:
+                del self._jobs[job_id]
+
+    def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for job in list(self._jobs.values()):
+            counts[job.status.value] = counts.get(job.status.value, 0) + 1
+        return counts
+
+    def orphaned(self) -> List[JobMetadata]:
+        # السجلات تنتهي مع العملية، فلا مهام متبقية من عملية سابقة
+        return []
+
+
+class SQLiteJobStore:
+    """
+    سجلات المهام في قاعدة SQLite نفسها التي يستخدمها سجل الملفات، فيجدها أي عامل uvicorn.
+
+    المهمة تُنفَّذ في العامل الذي استلمها، لكن حالتها ونتيجتها تُكتبان هنا عند كل تغيير،
+    فيعمل GET /jobs/{id} أيًا كان العامل الذي يصله الطلب.
+    """
+
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            expires_at REAL,
+            data TEXT NOT NULL,
+            owner TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at)",
+    )
+    _MIGRATIONS = {"owner": "ALTER TABLE jobs ADD COLUMN owner TEXT"}
+    _UPSERT = "INSERT OR REPLACE INTO jobs (job_id, status, expires_at, data, owner) VALUES (?, ?, ?, ?, ?)"
+    _SELECT = "SELECT data FROM jobs WHERE job_id = ?"
+    _SELECT_UNFINISHED = "SELECT data, owner FROM jobs WHERE status IN ('pending', 'processing')"
+    _DELETE_EXPIRED = "DELETE FROM jobs WHERE expires_at <= ?"
+    _COUNT = "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        # مالك المهام التي تُنشئها هذه العملية: pid مع رمز فريد، لأن pid قد يتكرر بعد إعادة التشغيل
+        self.owner = f"{os.getpid()}:{uuid4().hex}"
+        connection = self._connection()
+        with connection:
+            for statement in self._SCHEMA:
+                connection.execute(statement)
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+            for column, statement in self._MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(str(self.path), timeout=10, cached_statements=16)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _seconds(value: Optional[datetime]) -> Optional[float]:
+        return (value - _EPOCH).total_seconds() if value is not None else None
+
+    def save(self, job: JobMetadata) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                self._UPSERT,
+                (job.job_id, job.status.value, self._seconds(job.expires_at), job.model_dump_json(), self.owner),
+            )
+
+    def get(self, job_id: str) -> Optional[JobMetadata]:
+        row = self._connection().execute(self._SELECT, (job_id,)).fetchone()
+        return JobMetadata.model_validate_json(row[0]) if row else None
+
+    def purge_expired(self, now: datetime) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(self._DELETE_EXPIRED, (self._seconds(now),))
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._connection().execute(self._COUNT).fetchall())
+
+    def orphaned(self) -> List[JobMetadata]:
+        """المهام غير المكتملة التي توقفت عمليتها: pid غير موجود، أو pid هذه العملية برمز سابق."""
+        current_pid, _, _ = self.owner.partition(":")
+        orphans = []
+        for data, owner in self._connection().execute(self._SELECT_UNFINISHED).fetchall():
+            pid_text, _, _ = (owner or "").partition(":")
+            if owner == self.owner:
+                continue
+            if pid_text == current_pid or not pid_text.isdigit() or not process_alive(int(pid_text)):
+                orphans.append(JobMetadata.model_validate_json(data))
+        return orphans
+
+
+def _default_store(settings: Settings) -> MemoryJobStore | SQLiteJobStore:
+    # المهام تتبع سجل الملفات: مشتركة بين العمال مع sqlite، وداخل العملية مع memory
+    if settings.registry_backend == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore(settings.registry_path)
+
+
+class JobManager:
+    """
+    تشغيل عمليات commit الطويلة في الخلفية وإتاحة حالتها عبر معرف المهمة.
+
+    تُحفظ نتائج المهام المنتهية لمدة محددة (job_result_ttl_seconds) ثم تُحذف.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[Settings] = None,
+        store: MemoryJobStore | SQLiteJobStore | None = None,
+    ) -> None:
+        settings = settings or get_settings()
+        self.worker_count = max(1, settings.job_workers)
+        self.result_ttl = timedelta(seconds=settings.job_result_ttl_seconds)
+
+        self.store = store or _default_store(settings)
+        # المهام التي يُنفذها هذا العامل؛ حالتها المرجعية في store
+        self._jobs: Dict[str, JobMetadata] = {}
+        self._queue: Optional[asyncio.Queue[Tuple[str, JobFactory]]] = None
+        self._workers: list[asyncio.Task] = []
+
+    # ------------------------------------------------------------------
+    # دورة الحياة
+    # ------------------------------------------------------------------
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._fail_orphans()
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{index}")
+            for index in range(self.worker_count)
+        ]
+
+    async def stop(self) -> None:
+        """إيقاف العمال؛ المهام الجارية والمنتظرة تُسجل فاشلة حتى لا ينتظرها العميل إلى الأبد."""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        queue, self._queue = self._queue, None
+        while queue is not None and not queue.empty():
+            job_id, _ = queue.get_nowait()
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._interrupt(job)
+
+    def _fail_orphans(self) -> None:
+        # مهام تركتها عملية سابقة (إعادة نشر أو انهيار) دون أن تسجل نهايتها
+        for job in self.store.orphaned():
+            self._interrupt(job)
+            logger.warning("سُجلت المهمة %s (%s) فاشلة لتوقف العامل الذي كان ينفذها.", job.job_id, job.task_type)
+
+    def _interrupt(self, job: JobMetadata) -> None:
+        job.status = JobStatus.failed
+        job.message = INTERRUPTED_MESSAGE
+        job.completed_at = datetime.utcnow()
+        job.expires_at = job.completed_at + self.result_ttl
+        self.store.save(job)
+
+    # ------------------------------------------------------------------
+    # الإرسال والاستعلام
+    # ------------------------------------------------------------------
+    def submit(self, task_type: str, factory: JobFactory) -> JobMetadata:
+        self.start()
+        self._purge_expired()
+
+        job = JobMetadata(job_id=uuid4().hex, task_type=task_type, status=JobStatus.pending)
+        self._jobs[job.job_id] = job
+        self.store.save(job)
+        self._queue.put_nowait((job.job_id, factory))
+        logger.info("تمت جدولة مهمة %s بالمعرف %s", task_type, job.job_id)
+        return job
+
+    def get(self, job_id: str) -> JobMetadata:
+        self._purge_expired()
+        job = self.store.get(job_id)
+        if not job or (job.expires_at and job.expires_at <= datetime.utcnow()):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="المهمة المطلوبة غير موجودة أو انتهت صلاحيتها.",
+            )
+        return job
+
+    def stats(self) -> dict:
+        counts = {job_status.value: 0 for job_status in JobStatus}
+        counts.update(self.store.counts())
+        return {
+            "workers": self.worker_count,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "jobs": counts,
+        }
+
+    # ------------------------------------------------------------------
+    # التنفيذ
+    # ------------------------------------------------------------------
+    async def _worker(self) -> None:
+        while True:
+            job_id, factory = await self._queue.get()
+            try:
+                await self._run(job_id, factory)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str, factory: JobFactory) -> None:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+
+        job.status = JobStatus.processing
+        job.started_at = datetime.utcnow()
+        self.store.save(job)
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            job.status = JobStatus.failed
+            job.message = INTERRUPTED_MESSAGE
+            raise
+        except HTTPException as exc:
+            job.status = JobStatus.failed
+            job.message = str(exc.detail)
+        except Exception as exc:  # noqa: BLE001 - نعيد الخطأ للعميل عبر حالة المهمة
+            logger.exception("فشلت المهمة %s (%s)", job_id, job.task_type)
+            job.status = JobStatus.failed
+            job.message = str(exc) or exc.__class__.__name__
+        else:
+            job.status = JobStatus.completed
+            job.message = result.get("message")
+            job.result = result
+            job.output = self._describe_output(result)
+        finally:
+            job.completed_at = datetime.utcnow()
+            job.expires_at = job.completed_at + self.result_ttl
+            self._jobs.pop(job_id, None)
+            self._save_final(job)
+
+    def _save_final(self, job: JobMetadata) -> None:
+        try:
+            self.store.save(job)
+        except Exception as exc:  # noqa: BLE001 - نتيجة لا تُسلسل إلى JSON لا يجوز أن تبقي المهمة "قيد التنفيذ"
+            logger.exception("تعذر حفظ نتيجة المهمة %s", job.job_id)
+            job.status = JobStatus.failed
+            job.message = str(exc) or exc.__class__.__name__
+            job.result = job.output = None
+            self.store.save(job)
+
+    @staticmethod
+    def _describe_output(result: dict) -> Optional[FileDescriptor]:
+        card = result.get("result")
+        if not isinstance(card, dict) or "filename" not in card:
+            return None
+        extension = card.get("extension") or "bin"
+        content_type = "application/pdf" if extension == "pdf" else "application/octet-stream"
+        return FileDescriptor(
+            filename=card["filename"],
+            content_type=content_type,
+            size_bytes=card.get("size_bytes", 0),
+            download_url=card.get("download_url"),
+        )
+
+    def _purge_expired(self) -> None:
+        self.store.purge_expired(datetime.utcnow())
+
+
+async def dispatch(
+    task_type: str,
+    factory: JobFactory,
+    *,
+    async_mode: bool,
+    response: Response,
+    pins: Iterable[Path] = (),
+) -> dict:
+    """
+    تنفيذ عملية commit مباشرة، أو جدولتها وإرجاع 202 مع معرف المهمة عند طلب الوضع غير المتزامن.
+
+    تبقى ملفات pins محمية من الإخلاء عند امتلاء القرص من لحظة الاستلام حتى انتهاء المهمة.
+    """
+    budget = get_disk_budget()
+    pins = list(pins)
+    budget.pin(pins)
+
+    async def pinned() -> dict:
+        try:
+            return await factory()
+        finally:
+            budget.unpin(pins)
+
+    if not async_mode:
+        return await pinned()
+
+    job = get_job_manager().submit(task_type, pinned)
+    response.status_code = status.HTTP_202_ACCEPTED
+    return {
+        "status": "accepted",
+        "message": "تم استلام الطلب وسيتم تنفيذه في الخلفية.",
+        "job_id": job.job_id,
+        "status_url": f"/jobs/{job.job_id}",
+    }
+
+
+@lru_cache()
+def get_job_manager() -> JobManager:
+    return JobManager()
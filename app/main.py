@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Iterable
 
@@ -11,15 +12,36 @@ from fastapi.staticfiles import StaticFiles
 
 from app.api import routers
 from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.core.jobs import get_job_manager
 from app.core.logging import configure_logging
+from app.storage.budget import get_disk_budget
+from app.storage.sweeper import StorageSweeper
+from app.utils.preview_cache import get_preview_cache
 
 # === إعدادات وتسجيل ===
 settings = get_settings()
 logger = configure_logging()
+executor = get_executor()
+job_manager = get_job_manager()
+sweeper = StorageSweeper()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    job_manager.start()
+    sweeper.start()
+    yield
+    # إيقاف مجمعات التنفيذ بعد انتهاء الطلبات الجارية
+    await sweeper.stop()
+    await job_manager.stop()
+    executor.shutdown()
+
 
 app = FastAPI(
     title=getattr(settings, "app_name", "Mistral OCR API"),
     version=getattr(settings, "app_version", "0.1.0"),
+    lifespan=lifespan,
 )
 
 # === CORS ===
@@ -89,4 +111,12 @@ async def root() -> dict:
 @app.get("/health")
 async def health_check() -> dict:
     logger.debug("Health check invoked")
-    return {"status": "ok", "message": "PDF Toolkit API is running"}
+    return {
+        "status": "ok",
+        "message": "PDF Toolkit API is running",
+        "workers": executor.stats(),
+        "jobs": job_manager.stats(),
+        "preview_cache": get_preview_cache().stats(),
+        "sweeper": sweeper.stats(),
+        "disk": get_disk_budget().stats(),
+    }
@@ -1,20 +1,37 @@
 
-from .compress import CompressionCommitRequest
+from .compress import CompressionCommitRequest, CompressionEstimateRequest
 from .conversion import ConversionCommitRequest
 from .merge import MergeCommitRequest, MergeCard
 from .ocr import OCRCommitRequest
-from .split import PagePreviewRequest, PageRange, SplitCommitRequest
-from .watermark import WatermarkCommitRequest, WatermarkOptions
+from .split import PagePreviewRequest, PageRange, SplitBulkRequest, SplitCommitRequest
+from .watermark import (
+    ImageWatermarkCommitRequest,
+    ImageWatermarkOptions,
+    ImageWatermarkPreviewRequest,
+    WatermarkBatchRequest,
+    WatermarkCommitRequest,
+    WatermarkOptions,
+    WatermarkPreviewRequest,
+    WatermarkStyle,
+)
 
 __all__ = [
     "CompressionCommitRequest",
+    "CompressionEstimateRequest",
     "ConversionCommitRequest",
+    "ImageWatermarkCommitRequest",
+    "ImageWatermarkOptions",
+    "ImageWatermarkPreviewRequest",
     "MergeCommitRequest",
     "MergeCard",
     "OCRCommitRequest",
     "PagePreviewRequest",
     "PageRange",
+    "SplitBulkRequest",
     "SplitCommitRequest",
+    "WatermarkBatchRequest",
     "WatermarkCommitRequest",
     "WatermarkOptions",
+    "WatermarkPreviewRequest",
+    "WatermarkStyle",
 ]
@@ -1,7 +1,7 @@
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel, Field
 
@@ -25,9 +25,12 @@ class JobMetadata(BaseModel):
     task_type: str
     status: JobStatus
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
     message: Optional[str] = None
     output: Optional[FileDescriptor] = None
+    result: Optional[Dict[str, Any]] = None
 
 
 class StorageLocation(BaseModel):
@@ -3,5 +3,14 @@
 
 class CompressionCommitRequest(BaseModel):
     file_id: str = Field(..., description="معرف الملف المراد ضغطه.")
-    level: str = Field(..., description="مستوى الضغط (low | medium | high).")
+    level: str = Field("medium", description="مستوى الضغط (low | medium | high | scan للملفات الممسوحة ضوئيًا)، ويُتجاهل عند تحديد target_bytes.")
+    target_bytes: int | None = Field(
+        default=None,
+        ge=10 * 1024,
+        description="الحجم الأقصى المطلوب للناتج بالبايت؛ تُختار إعدادات الصور تلقائيًا للوصول إليه.",
+    )
     output_filename: str | None = Field(default=None, description="اسم الملف الناتج (اختياري).")
+
+
+class CompressionEstimateRequest(BaseModel):
+    file_id: str = Field(..., description="معرف الملف المراد تقدير نتيجة ضغطه.")
@@ -6,6 +6,8 @@ from pydantic import BaseModel, Field
 class MergeCommitRequest(BaseModel):
     file_ids: List[str] = Field(..., description="قائمة معرفات الملفات بالترتيب المطلوب للدمج.")
     output_filename: str | None = Field(default=None, description="اسم الملف الناتج (اختياري).")
+    keep_outlines: bool = Field(default=False, description="نقل الفهارس (bookmarks) من الملفات المدمجة.")
+    keep_links: bool = Field(default=True, description="الإبقاء على الروابط داخل الصفحات.")
 
 
 class MergeCard(BaseModel):
@@ -1,4 +1,4 @@
-﻿from typing import List
+﻿from typing import List, Literal, Optional
 
 from pydantic import BaseModel, Field, validator
 
@@ -21,6 +21,17 @@ class SplitCommitRequest(BaseModel):
     separate_files: bool = Field(False, description="إنشاء ملف منفصل لكل مدى.")
 
 
+class SplitBulkRequest(BaseModel):
+    file_id: str = Field(..., description="معرف الملف المراد تقسيمه.")
+    mode: Literal["every", "bookmarks", "max_size"] = Field(
+        ..., description="every: كل N صفحة، bookmarks: حسب الفهرس، max_size: حسب الحجم الأقصى للمقطع."
+    )
+    every_pages: Optional[int] = Field(default=None, ge=1, description="عدد الصفحات في كل مقطع (وضع every).")
+    bookmark_level: int = Field(default=1, ge=1, description="مستوى عناصر الفهرس التي يبدأ عندها كل مقطع.")
+    max_chunk_bytes: Optional[int] = Field(default=None, ge=1024, description="الحجم الأقصى التقريبي لكل مقطع بالبايت.")
+    output_filename: Optional[str] = Field(default=None, description="اسم ملف ZIP الناتج (اختياري).")
+
+
 class PagePreviewRequest(BaseModel):
     file_id: str = Field(..., description="معرف الملف المسجل.")
     pages: List[int] = Field(..., min_items=1)
@@ -1,10 +1,9 @@
-﻿from typing import Literal
+﻿from typing import List, Literal
 
 from pydantic import BaseModel, Field
 
 
-class WatermarkOptions(BaseModel):
-    file_id: str = Field(..., description="معرف ملف PDF المسجل.")
+class WatermarkStyle(BaseModel):
     text: str = Field(..., description="نص العلامة المائية.")
     opacity: float = Field(..., gt=0, le=1, description="قيمة الشفافية بين 0 و 1.")
     position: Literal["center", "top", "bottom", "diagonal", "tile"] = Field(
@@ -13,5 +12,39 @@ class WatermarkOptions(BaseModel):
     font_size: int = Field(0, ge=0, description="حجم الخط (0 لاختيار تلقائي).")
 
 
+class WatermarkOptions(WatermarkStyle):
+    file_id: str = Field(..., description="معرف ملف PDF المسجل.")
+
+
+class WatermarkPreviewRequest(WatermarkOptions):
+    page_number: int = Field(1, ge=1, description="رقم الصفحة المراد معاينتها (يبدأ من 1).")
+
+
 class WatermarkCommitRequest(WatermarkOptions):
     output_filename: str | None = Field(default=None, description="اسم الملف الناتج (اختياري).")
+
+
+class WatermarkBatchRequest(WatermarkStyle):
+    file_ids: List[str] = Field(..., min_items=1, description="معرفات الملفات المراد تطبيق العلامة المائية عليها.")
+    output: Literal["cards", "zip"] = Field(
+        "cards", description="cards: بطاقة لكل ملف ناتج، zip: تنزيل كل النواتج كملف ZIP متدفق."
+    )
+    output_filename: str | None = Field(default=None, description="اسم ملف ZIP الناتج (اختياري).")
+
+
+class ImageWatermarkOptions(BaseModel):
+    file_id: str = Field(..., description="معرف ملف PDF المسجل.")
+    image_id: str = Field(..., description="معرف صورة الشعار المرفوعة (PNG أو JPEG).")
+    opacity: float = Field(..., gt=0, le=1, description="قيمة الشفافية بين 0 و 1.")
+    position: Literal["center", "top", "bottom", "diagonal", "tile"] = Field(
+        "center", description="موضع العلامة المائية."
+    )
+    scale: float = Field(0.3, ge=0.05, le=1, description="عرض الصورة كنسبة من عرض الصفحة.")
+
+
+class ImageWatermarkPreviewRequest(ImageWatermarkOptions):
+    page_number: int = Field(1, ge=1, description="رقم الصفحة المراد معاينتها (يبدأ من 1).")
+
+
+class ImageWatermarkCommitRequest(ImageWatermarkOptions):
+    output_filename: str | None = Field(default=None, description="اسم الملف الناتج (اختياري).")
@@ -1,11 +1,171 @@
 from __future__ import annotations
 
-from io import BytesIO
+import asyncio
+import hashlib
+import time
+import zlib
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence
 
 import fitz  # PyMuPDF
 
+from app.core.executor import get_executor
 from app.storage.local import LocalStorage
+from app.utils.document_cache import get_document_cache, open_document
+from app.utils.file_utils import clean_temp_files
+from app.utils.pdf_inspect import stream_length
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """إعدادات تمريرة الصور لمستوى ضغط: الدقة المستهدفة وجودة JPEG."""
+
+    dpi: int
+    quality: int
+
+
+@dataclass
+class ImageCandidate:
+    """صورة مرشحة لإعادة الترميز مع أقل دقة فعلية تُعرض بها في الصفحات."""
+
+    xref: int
+    width: int
+    height: int
+    dpi: float
+    stream_bytes: int
+
+
+@dataclass
+class ImageReplacement:
+    """صورة أُعيد ترميزها (JPEG أو أبيض وأسود بـ Flate)، محفوظة في ملف دفعة مؤقت عند offset."""
+
+    xref: int
+    width: int
+    height: int
+    gray: bool
+    path: Path
+    offset: int
+    length: int
+    original_bytes: int
+    bits: int = 8
+    filter: str = "/DCTDecode"
+
+    @property
+    def page_class(self) -> str:
+        if self.bits == 1:
+            return "bilevel"
+        return "gray" if self.gray else "color"
+
+
+@dataclass
+class SampleMeasurement:
+    """مجاميع ترميز عينة الصور لكل إعداد (البايتات والبكسلات الناتجة والزمن) مع كلفة فكها."""
+
+    sizes: List[int]
+    pixels: List[int]
+    seconds: List[float]
+    decoded_pixels: int = 0
+    decode_seconds: float = 0.0
+
+    @classmethod
+    def empty(cls, count: int) -> "SampleMeasurement":
+        return cls(sizes=[0] * count, pixels=[0] * count, seconds=[0.0] * count)
+
+    def add(self, other: "SampleMeasurement") -> None:
+        for index in range(len(self.sizes)):
+            self.sizes[index] += other.sizes[index]
+            self.pixels[index] += other.pixels[index]
+            self.seconds[index] += other.seconds[index]
+        self.decoded_pixels += other.decoded_pixels
+        self.decode_seconds += other.decode_seconds
+
+    def bytes_per_pixel(self, index: int) -> float:
+        return self.sizes[index] / self.pixels[index] if self.pixels[index] else 0.0
+
+    def seconds_per_pixel(self, index: int) -> float:
+        return self.seconds[index] / self.pixels[index] if self.pixels[index] else 0.0
+
+
+@dataclass
+class StreamAnalysis:
+    """توزيع بايتات الملف حسب نوع الكائن مع ما يُتوقع توفيره من الضغط البنيوي."""
+
+    breakdown: Dict[str, int] = field(default_factory=dict)
+    # التدفقات غير المضغوطة (ما عدا الصور المرشحة) ونسبة ضغطها المقاسة على عينة
+    uncompressed_bytes: int = 0
+    deflate_ratio: float = 1.0
+    deflate_seconds_per_byte: float = 0.0
+    # بايتات التدفقات المكررة حرفيًا (يدمجها garbage=4 فقط)
+    duplicate_bytes: int = 0
+    # محتوى الصفحات مع رؤوس كائناته، ونسبته بعد الدمج وإعادة الضغط (clean) مقاسة على عينة صفحات
+    page_content_bytes: int = 0
+    clean_ratio: float = 1.0
+    stream_count: int = 0
+    sampled_streams: int = 0
+    page_count: int = 0
+
+
+@dataclass
+class FontReport:
+    """أثر مرحلة الخطوط على برنامج خط مضمن واحد (بالبايتات المخزنة بعد deflate)."""
+
+    font: str
+    xref: int
+    action: str  # subset | deduplicated | unchanged
+    bytes_before: int
+    bytes_after: int
+
+    def as_dict(self) -> dict:
+        return {
+            "font": self.font,
+            "xref": self.xref,
+            "action": self.action,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "bytes_saved": max(0, self.bytes_before - self.bytes_after),
+        }
+
+
+@dataclass
+class CompressionResult:
+    path: Path
+    level: str
+    images_found: int = 0
+    images_recompressed: int = 0
+    image_bytes_saved: int = 0
+    # وضع الحجم المستهدف: الإعدادات المختارة وعدد التمريرات الكاملة
+    profile: Optional[ImageProfile] = None
+    target_bytes: Optional[int] = None
+    target_met: Optional[bool] = None
+    passes: int = 1
+    fonts: List[FontReport] = field(default_factory=list)
+    # مستوى scan: عدد الصفحات الممسوحة المكتشفة وتوزيع ما أُعيد ترميزه منها حسب التصنيف
+    scanned_pages: int = 0
+    scan_classes: Dict[str, int] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        data = {
+            "images_found": self.images_found,
+            "images_recompressed": self.images_recompressed,
+            "image_bytes_saved": self.image_bytes_saved,
+            "font_bytes_saved": sum(max(0, font.bytes_before - font.bytes_after) for font in self.fonts),
+            "fonts": [font.as_dict() for font in self.fonts],
+        }
+        if self.level == "scan":
+            data.update({"scanned_pages": self.scanned_pages, "scan_classes": self.scan_classes})
+        if self.target_bytes is not None:
+            data.update(
+                {
+                    "target_bytes": self.target_bytes,
+                    "target_met": self.target_met,
+                    "image_dpi": self.profile.dpi if self.profile else None,
+                    "jpeg_quality": self.profile.quality if self.profile else None,
+                    "passes": self.passes,
+                }
+            )
+        return data
 
 
 class CompressionService:
@@ -17,13 +177,820 @@ class CompressionService:
         "high": dict(garbage=4, deflate=True, deflate_fonts=True, deflate_images=True, clean=True),
     }
 
+    # الصور المعروضة بدقة أعلى من dpi تُصغَّر إليها، وكل الصور المرشحة تُرمَّز JPEG بالجودة المحددة
+    IMAGE_PROFILES = {
+        "low": ImageProfile(dpi=300, quality=85),
+        "medium": ImageProfile(dpi=150, quality=75),
+        "high": ImageProfile(dpi=110, quality=60),
+    }
+    # سلم الإعدادات لوضع الحجم المستهدف، من الأخف إلى الأشد (مع خيارات مستوى high للبنية)
+    TARGET_PROFILES = (
+        ImageProfile(dpi=300, quality=85),
+        ImageProfile(dpi=200, quality=80),
+        ImageProfile(dpi=150, quality=75),
+        ImageProfile(dpi=150, quality=60),
+        ImageProfile(dpi=110, quality=60),
+        ImageProfile(dpi=96, quality=50),
+        ImageProfile(dpi=72, quality=45),
+        ImageProfile(dpi=72, quality=30),
+    )
+    TARGET_SAMPLE_IMAGES = 8
+    # القياس يتم على نافذة في وسط كل صورة بهذا العدد من البكسلات الناتجة لكل بعد
+    TARGET_SAMPLE_WINDOW = 512
+    # هامش أمان للتقدير، فالتمريرة الكاملة الأولى تصيب الهدف غالبًا دون تصحيح
+    TARGET_SAFETY = 0.95
+    # لا يُصغَّر إلا ما يزيد على الدقة المستهدفة بهذا الهامش، ولا يُستبدل إلا ما يوفر هذه النسبة على الأقل
+    DOWNSAMPLE_MARGIN = 1.15
+    MIN_SAVING_RATIO = 0.05
+    # الصور الصغيرة جدًا لا تستحق كلفة فك الترميز
+    MIN_IMAGE_BYTES = 8 * 1024
+    # المستويات التي تمر بمرحلة الخطوط (دمج البرامج المتطابقة ثم اقتطاع الحروف المستخدمة فقط)
+    FONT_LEVELS = {"medium", "high"}
+    # مستوى scan: خيارات high للبنية، وصفحات المسح تُرمَّز حسب تصنيفها والصور الأخرى بإعدادات medium
+    SCAN_LEVEL = "scan"
+    SCAN_PROFILES = {
+        "color": ImageProfile(dpi=150, quality=60),
+        "gray": ImageProfile(dpi=150, quality=60),
+    }
+    # الأبيض والأسود يحتاج دقة أعلى ليبقى النص مقروءًا، وهو أصغر بكثير من JPEG بالدقة نفسها
+    SCAN_BILEVEL_DPI = 300
+    # الصفحة الممسوحة: صورة واحدة تغطي هذه النسبة من الصفحة على الأقل ولا خطوط فيها
+    SCAN_COVERAGE = 0.9
+    # التصنيف على عينة مأخوذة بتخطي البكسلات (دون تنعيم يختلق درجات رمادية عند حواف الحروف)
+    SCAN_SAMPLE_SIZE = 400
+    SCAN_CHROMA = 40
+    SCAN_COLOR_RATIO = 0.01
+    SCAN_MIDTONES = (64, 192)
+    SCAN_MIDTONE_RATIO = 0.06
+    # الكلفة التقريبية لصياغة كل كائن في الملف ("n 0 obj"/"endobj"/"stream" ومدخل جدول xref)
+    OBJECT_OVERHEAD_BYTES = 40
+    CLEAN_SAMPLE_PAGES = 12
+
     def __init__(self, storage: LocalStorage | None = None) -> None:
         self.storage = storage or LocalStorage()
 
-    def compress(self, pdf_path: Path, level: str = "medium") -> Path:
-        options = self.LEVEL_OPTIONS.get(level.lower(), self.LEVEL_OPTIONS["medium"])
+    # ------------------------------------------------------------------
+    # الضغط على مراحل موزعة على مجمع العمليات
+    # ------------------------------------------------------------------
+    async def compress_async(
+        self,
+        pdf_path: Path,
+        level: str = "medium",
+        *,
+        target_bytes: Optional[int] = None,
+    ) -> CompressionResult:
+        """
+        ضغط الملف مع تمريرة الصور موزعة على العمال:
+
+        1. حصر الصور ودقتها الفعلية (عامل واحد).
+        2. إعادة ترميز المرشحة في دفعات متوازنة بعدد العمال، تكتب كل دفعة نتائجها إلى ملف مؤقت.
+        3. تطبيق الاستبدالات والحفظ بخيارات المستوى (عامل واحد).
+
+        مع target_bytes تُختار إعدادات الصور من TARGET_PROFILES بالتقدير على عينة قبل التمريرة الكاملة.
+        """
+        executor = get_executor()
+        candidates = await executor.run_cpu("compress", self.find_images, pdf_path)
+        if target_bytes:
+            return await self._compress_to_target(pdf_path, candidates, target_bytes)
+        if level.lower() == self.SCAN_LEVEL:
+            return await self._compress_scan(pdf_path, candidates)
+
+        level = level.lower() if level.lower() in self.LEVEL_OPTIONS else "medium"
+        return await self._image_pass(pdf_path, candidates, self.IMAGE_PROFILES[level], level)
+
+    async def _image_pass(
+        self,
+        pdf_path: Path,
+        candidates: Sequence[ImageCandidate],
+        profile: ImageProfile,
+        level: str,
+        scans: Sequence[ImageCandidate] = (),
+    ) -> CompressionResult:
+        executor = get_executor()
+        scan_xrefs = {scan.xref for scan in scans}
+        others = [candidate for candidate in candidates if candidate.xref not in scan_xrefs]
+        jobs = [
+            executor.run_cpu("compress_images", self.recompress_images, pdf_path, batch, profile)
+            for batch in self._balance(others, executor.cpu_workers)
+        ]
+        jobs += [
+            executor.run_cpu("compress_images", self.recompress_scans, pdf_path, batch)
+            for batch in self._balance(scans, executor.cpu_workers)
+        ]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        replacements = [item for result in results if isinstance(result, list) for item in result]
+        failure = next((result for result in results if isinstance(result, BaseException)), None)
+        if failure is not None:
+            clean_temp_files({item.path for item in replacements})
+            raise failure
+
+        result = await executor.run_cpu("compress", self.compress, pdf_path, level, replacements)
+        result.images_found = len(candidates)
+        result.images_recompressed = len(replacements)
+        result.image_bytes_saved = sum(item.original_bytes - item.length for item in replacements)
+        result.profile = profile
+        result.scan_classes = dict(Counter(item.page_class for item in replacements if item.xref in scan_xrefs))
+        return result
+
+    # ------------------------------------------------------------------
+    # مستوى الصفحات الممسوحة
+    # ------------------------------------------------------------------
+    async def _compress_scan(self, pdf_path: Path, candidates: Sequence[ImageCandidate]) -> CompressionResult:
+        """
+        ضغط الملفات الممسوحة ضوئيًا: كل صفحة هي صورة واحدة بلا طبقة نصية تُصنَّف (ملونة/رمادية/أبيض وأسود)
+        وتُرمَّز بأصغر فضاء لوني وترميز مناسبين، موزعة على العمال صفحةً صفحة. بقية الصور تمر بإعدادات medium.
+        """
+        scans, pages = await get_executor().run_cpu("compress", self.find_scanned_pages, pdf_path)
+        result = await self._image_pass(pdf_path, candidates, self.IMAGE_PROFILES["medium"], "high", scans=scans)
+        result.level = self.SCAN_LEVEL
+        result.scanned_pages = pages
+        return result
+
+    def find_scanned_pages(self, pdf_path: Path) -> tuple[List[ImageCandidate], int]:
+        """
+        صور الصفحات الممسوحة وعدد صفحاتها: صورة واحدة تغطي الصفحة، في صفحة بلا خطوط،
+        ولا تُستخدم في صفحة عادية. الصفحات المتطابقة تشترك في صورة واحدة فتُعالج مرة واحدة.
+        """
+        scans: Dict[int, ImageCandidate] = {}
+        pages: Counter[int] = Counter()
+        excluded: set[int] = set()
+        with open_document(pdf_path) as document:
+            for page in document:
+                infos = [info for info in page.get_image_info(xrefs=True) if not fitz.Rect(info["bbox"]).is_empty]
+                xrefs = {info.get("xref") or 0 for info in infos}
+                if len(infos) != 1 or document.get_page_fonts(page.number):
+                    excluded.update(xrefs)
+                    continue
+                info = infos[0]
+                xref = info.get("xref") or 0
+                bbox = fitz.Rect(info["bbox"]) & page.rect
+                if xref <= 0 or bbox.get_area() < page.rect.get_area() * self.SCAN_COVERAGE:
+                    excluded.add(xref)
+                    continue
+                if xref in scans:
+                    pages[xref] += 1
+                    continue
+                if not self._is_recodable(document, xref):
+                    continue
+                stream_bytes = len(document.xref_stream_raw(xref) or b"")
+                if stream_bytes < self.MIN_IMAGE_BYTES:
+                    continue
+                width = int(document.xref_get_key(xref, "Width")[1])
+                height = int(document.xref_get_key(xref, "Height")[1])
+                dpi = min(width * 72 / bbox.width, height * 72 / bbox.height)
+                scans[xref] = ImageCandidate(xref, width, height, round(dpi, 1), stream_bytes)
+                pages[xref] += 1
+        # صورة مشتركة مع صفحة عادية (شعار مثلًا) لا يجوز تغيير فضائها اللوني
+        scans = {xref: scan for xref, scan in scans.items() if xref not in excluded}
+        return list(scans.values()), sum(pages[xref] for xref in scans)
+
+    def recompress_scans(self, pdf_path: Path, candidates: Sequence[ImageCandidate]) -> List[ImageReplacement]:
+        """تصنيف دفعة صفحات ممسوحة وترميز كل منها بما يناسب تصنيفها، وحفظ ما يوفر منها في ملف مؤقت واحد."""
+        replacements: List[ImageReplacement] = []
+        with open_document(pdf_path) as document, self.storage.open_output(".bin", directory=self.storage.temp_dir) as output:
+            offset = 0
+            for candidate in candidates:
+                try:
+                    pixmap = self._decode_image(document, candidate.xref)
+                    page_class = self.classify_scan(pixmap)
+                    if page_class == "bilevel":
+                        data, width, height = self._encode_bilevel(pixmap, candidate)
+                    else:
+                        if page_class == "gray" and pixmap.colorspace.n != 1:
+                            pixmap = fitz.Pixmap(fitz.csGRAY, pixmap)
+                        data, width, height = self._encode_pixmap(pixmap, candidate, self.SCAN_PROFILES[page_class])
+                except (RuntimeError, ValueError):
+                    continue
+                if len(data) > candidate.stream_bytes * (1 - self.MIN_SAVING_RATIO):
+                    continue
+                output.handle.write(data)
+                replacements.append(
+                    ImageReplacement(
+                        xref=candidate.xref,
+                        width=width,
+                        height=height,
+                        gray=page_class != "color",
+                        path=output.path,
+                        offset=offset,
+                        length=len(data),
+                        original_bytes=candidate.stream_bytes,
+                        bits=1 if page_class == "bilevel" else 8,
+                        filter="/FlateDecode" if page_class == "bilevel" else "/DCTDecode",
+                    )
+                )
+                offset += len(data)
+
+        if not replacements:
+            output.path.unlink(missing_ok=True)
+        return replacements
+
+    @classmethod
+    def _scan_sample(cls, pixmap: fitz.Pixmap) -> tuple[bytes, Optional[int]]:
+        """عينة رمادية بتخطي البكسلات بحد أقصى SCAN_SAMPLE_SIZE لكل بعد، مع عدد البكسلات الملونة فيها."""
+        step = max(1, -(-max(pixmap.width, pixmap.height) // cls.SCAN_SAMPLE_SIZE))
+        samples, stride, n = pixmap.samples, pixmap.stride, pixmap.n
+        rows = [samples[row * stride : row * stride + pixmap.width * n] for row in range(0, pixmap.height, step)]
+        if n == 1:
+            return b"".join(row[::step] for row in rows), None
+
+        colored = 0
+        gray = bytearray()
+        for row in rows:
+            for red, green, blue in zip(row[0 :: step * n], row[1 :: step * n], row[2 :: step * n]):
+                if max(red, green, blue) - min(red, green, blue) > cls.SCAN_CHROMA:
+                    colored += 1
+                gray.append((red * 77 + green * 150 + blue * 29) >> 8)
+        return bytes(gray), colored
+
+    @classmethod
+    def classify_scan(cls, pixmap: fitz.Pixmap) -> str:
+        """color | gray | bilevel من مدرج تكراري لعينة صغيرة من الصفحة."""
+        gray, colored = cls._scan_sample(pixmap)
+        if not gray:
+            return "color" if pixmap.n > 1 else "gray"
+        if colored is not None and colored > len(gray) * cls.SCAN_COLOR_RATIO:
+            return "color"
+        histogram = Counter(gray)
+        low, high = cls.SCAN_MIDTONES
+        midtones = sum(count for value, count in histogram.items() if low <= value <= high)
+        return "bilevel" if midtones <= len(gray) * cls.SCAN_MIDTONE_RATIO else "gray"
+
+    @staticmethod
+    def _otsu_threshold(gray: bytes) -> int:
+        histogram = Counter(gray)
+        total = len(gray)
+        weighted_total = sum(value * count for value, count in histogram.items())
+        best, threshold = -1.0, 128
+        background = weighted_background = 0
+        for value in range(256):
+            background += histogram.get(value, 0)
+            if not background or background == total:
+                continue
+            weighted_background += value * histogram.get(value, 0)
+            mean_background = weighted_background / background
+            mean_foreground = (weighted_total - weighted_background) / (total - background)
+            variance = background * (total - background) * (mean_background - mean_foreground) ** 2
+            if variance > best:
+                best, threshold = variance, value
+        return threshold
+
+    @classmethod
+    def _encode_bilevel(cls, pixmap: fitz.Pixmap, candidate: ImageCandidate) -> tuple[bytes, int, int]:
+        """تحويل الصفحة إلى أبيض وأسود (1 بت، عتبة Otsu) مضغوطة بـ Flate."""
+        if pixmap.colorspace.n != 1:
+            pixmap = fitz.Pixmap(fitz.csGRAY, pixmap)
+        if candidate.dpi > cls.SCAN_BILEVEL_DPI * cls.DOWNSAMPLE_MARGIN:
+            factor = cls.SCAN_BILEVEL_DPI / candidate.dpi
+            pixmap = fitz.Pixmap(pixmap, max(1, round(pixmap.width * factor)), max(1, round(pixmap.height * factor)), None)
+
+        threshold = cls._otsu_threshold(cls._scan_sample(pixmap)[0])
+        # كل بكسل إلى الرقم "0" (أسود) أو "1" (أبيض) ثم int(..., 2) يحزم الصف بتًا بتًا دون حلقة بايثون لكل بكسل
+        table = bytes(48 if value <= threshold else 49 for value in range(256))
+        width, height, stride = pixmap.width, pixmap.height, pixmap.stride
+        padding = b"1" * (-width % 8)
+        row_bytes = (width + 7) // 8
+        samples = pixmap.samples.translate(table)
+        packed = b"".join(
+            int(samples[row * stride : row * stride + width] + padding, 2).to_bytes(row_bytes, "big") for row in range(height)
+        )
+        return zlib.compress(packed, 9), width, height
+
+    # ------------------------------------------------------------------
+    # وضع الحجم المستهدف
+    # ------------------------------------------------------------------
+    async def _compress_to_target(
+        self,
+        pdf_path: Path,
+        candidates: Sequence[ImageCandidate],
+        target_bytes: int,
+    ) -> CompressionResult:
+        """
+        اختيار أخف إعدادات يُتوقع أن تصل بالملف تحت target_bytes ثم تمريرة كاملة واحدة.
+
+        التقدير: ما ليس صورًا مرشحة يبقى بحجمه، وحجم كل صورة = بكسلاتها بعد التصغير × متوسط
+        البايتات لكل بكسل المقاس على عينة موزعة من الصور. إذا تجاوزت النتيجة الهدف تُصحح النسبة
+        بالحجم الفعلي وتُجرى تمريرة ثانية على الأكثر، ويُعاد أفضل ما تحقق.
+        """
+        profiles = self.TARGET_PROFILES
+        original_size = Path(pdf_path).stat().st_size
+        fixed_bytes = max(0, original_size - sum(candidate.stream_bytes for candidate in candidates))
+
+        measured = await self._measure_sample(pdf_path, candidates, profiles)
+        predicted = [
+            fixed_bytes + self._predict_images(candidates, profile, measured.bytes_per_pixel(index))
+            for index, profile in enumerate(profiles)
+        ]
+
+        index = self._pick_profile(predicted, target_bytes * self.TARGET_SAFETY)
+        result = await self._image_pass(pdf_path, candidates, profiles[index], "high")
+        size = result.path.stat().st_size
+        passes = 1
+
+        if size > target_bytes and index < len(profiles) - 1:
+            # تصحيح التقدير بنسبة الخطأ الفعلية ثم تمريرة أخيرة
+            correction = size / predicted[index] if predicted[index] else 1.0
+            corrected = [value * correction for value in predicted]
+            retry_index = max(index + 1, self._pick_profile(corrected, target_bytes * self.TARGET_SAFETY))
+            retry = await self._image_pass(pdf_path, candidates, profiles[retry_index], "high")
+            passes += 1
+            if retry.path.stat().st_size < size:
+                result.path.unlink(missing_ok=True)
+                result, size = retry, retry.path.stat().st_size
+            else:
+                retry.path.unlink(missing_ok=True)
+
+        result.level = "target"
+        result.target_bytes = target_bytes
+        result.target_met = size <= target_bytes
+        result.passes = passes
+        return result
+
+    async def _measure_sample(
+        self,
+        pdf_path: Path,
+        candidates: Sequence[ImageCandidate],
+        profiles: Sequence[ImageProfile],
+    ) -> SampleMeasurement:
+        executor = get_executor()
+        sample = self._sample(candidates, self.TARGET_SAMPLE_IMAGES)
+        batches = self._balance(sample, executor.cpu_workers)
+        measured = await asyncio.gather(
+            *(executor.run_cpu("compress_images", self.measure_profiles, pdf_path, batch, profiles) for batch in batches)
+        )
+        total = SampleMeasurement.empty(len(profiles))
+        for batch_result in measured:
+            total.add(batch_result)
+        return total
+
+    @staticmethod
+    def _pick_profile(predicted: Sequence[float], limit: float) -> int:
+        for index, value in enumerate(predicted):
+            if value <= limit:
+                return index
+        return len(predicted) - 1
+
+    @staticmethod
+    def _sample(candidates: Sequence[ImageCandidate], count: int) -> List[ImageCandidate]:
+        """عينة موزعة على ترتيب الصور حسب الحجم حتى تمثل الكبيرة والصغيرة معًا."""
+        ordered = sorted(candidates, key=lambda item: item.stream_bytes, reverse=True)
+        if len(ordered) <= count:
+            return ordered
+        step = len(ordered) / count
+        return [ordered[int(index * step)] for index in range(count)]
+
+    @classmethod
+    def _output_pixels(cls, candidate: ImageCandidate, profile: ImageProfile) -> int:
+        factor = profile.dpi / candidate.dpi if candidate.dpi > profile.dpi * cls.DOWNSAMPLE_MARGIN else 1.0
+        return max(1, round(candidate.width * factor)) * max(1, round(candidate.height * factor))
+
+    @classmethod
+    def _predict_images(cls, candidates: Sequence[ImageCandidate], profile: ImageProfile, bytes_per_pixel: float) -> float:
+        total = 0.0
+        for candidate in candidates:
+            estimate = cls._output_pixels(candidate, profile) * bytes_per_pixel
+            # الصور التي لا يوفر ترميزها تبقى كما هي
+            total += estimate if estimate <= candidate.stream_bytes * (1 - cls.MIN_SAVING_RATIO) else candidate.stream_bytes
+        return total
+
+    def measure_profiles(
+        self,
+        pdf_path: Path,
+        candidates: Sequence[ImageCandidate],
+        profiles: Sequence[ImageProfile],
+    ) -> SampleMeasurement:
+        """ترميز كل صورة في العينة بكل إعداد (مع فكها مرة واحدة) وقياس الحجم والزمن لكل إعداد."""
+        measurement = SampleMeasurement.empty(len(profiles))
+        with open_document(pdf_path) as document:
+            for candidate in candidates:
+                started = time.perf_counter()
+                try:
+                    pixmap = self._decode_image(document, candidate.xref)
+                except (RuntimeError, ValueError):
+                    continue
+                measurement.decode_seconds += time.perf_counter() - started
+                measurement.decoded_pixels += pixmap.width * pixmap.height
+                for index, profile in enumerate(profiles):
+                    started = time.perf_counter()
+                    data, width, height = self._encode_pixmap(pixmap, candidate, profile, window=self.TARGET_SAMPLE_WINDOW)
+                    measurement.seconds[index] += time.perf_counter() - started
+                    measurement.sizes[index] += len(data)
+                    measurement.pixels[index] += width * height
+        return measurement
+
+    # ------------------------------------------------------------------
+    # تقدير نتيجة كل مستوى دون ضغط الملف
+    # ------------------------------------------------------------------
+    async def estimate_async(self, pdf_path: Path) -> dict:
+        """
+        توقع حجم الناتج وزمنه لكل مستوى بكلفة جزء صغير من الضغط الكامل.
+
+        - يُحلل جدول الكائنات لتوزيع البايتات (صور/خطوط/محتوى/أخرى) دون فك التدفقات.
+        - تُرمَّز عينة من الصور بإعدادات كل مستوى، وتُضغط عينة من التدفقات غير المضغوطة.
+        - الحجم المتوقع = الأصل − الصور المرشحة + تقديرها − توفير deflate − المكرر (high فقط).
+        """
+        started = time.perf_counter()
+        executor = get_executor()
+        candidates, analysis = await asyncio.gather(
+            executor.run_cpu("compress", self.find_images, pdf_path),
+            executor.run_cpu("compress", self.analyse_streams, pdf_path),
+        )
+        levels = list(self.LEVEL_OPTIONS)
+        profiles = [self.IMAGE_PROFILES[level] for level in levels]
+        measured = await self._measure_sample(pdf_path, candidates, profiles) if candidates else None
+
+        original_size = Path(pdf_path).stat().st_size
+        candidate_bytes = sum(candidate.stream_bytes for candidate in candidates)
+        deflate_saving = analysis.uncompressed_bytes * (1 - analysis.deflate_ratio)
+        structural_seconds = analysis.uncompressed_bytes * analysis.deflate_seconds_per_byte
+        workers = max(1, min(executor.cpu_workers, len(candidates) or 1))
+
+        estimates = {}
+        for index, level in enumerate(levels):
+            options = self.LEVEL_OPTIONS[level]
+            size = original_size - candidate_bytes - deflate_saving
+            if options.get("garbage", 0) >= 4:
+                size -= analysis.duplicate_bytes
+            if options.get("clean"):
+                size -= analysis.page_content_bytes * (1 - analysis.clean_ratio)
+            seconds = structural_seconds
+            if measured is not None:
+                size += self._predict_images(candidates, profiles[index], measured.bytes_per_pixel(index))
+                decode_rate = measured.decode_seconds / measured.decoded_pixels if measured.decoded_pixels else 0.0
+                image_seconds = sum(
+                    candidate.width * candidate.height * decode_rate
+                    + self._output_pixels(candidate, profiles[index]) * measured.seconds_per_pixel(index)
+                    for candidate in candidates
+                )
+                seconds += image_seconds / workers
+            size = max(0, int(size))
+            estimates[level] = {
+                "estimated_size": min(size, original_size),
+                "estimated_reduction_percent": round(max(0, original_size - size) / original_size * 100, 2)
+                if original_size
+                else 0,
+                "estimated_seconds": round(seconds, 2),
+                "image_dpi": profiles[index].dpi,
+                "jpeg_quality": profiles[index].quality,
+            }
+
+        document_pages = analysis.page_count
+        return {
+            "original_size": original_size,
+            "breakdown": analysis.breakdown,
+            "images": {"recodable": len(candidates), "recodable_bytes": candidate_bytes},
+            "sampled": {
+                "images": min(len(candidates), self.TARGET_SAMPLE_IMAGES),
+                "streams": analysis.sampled_streams,
+                "pages": min(document_pages, self.CLEAN_SAMPLE_PAGES) if analysis.page_content_bytes else 0,
+            },
+            "levels": estimates,
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+        }
+
+    def analyse_streams(self, pdf_path: Path, sample_size: int = 24) -> StreamAnalysis:
+        """تصنيف بايتات الملف حسب نوع الكائن من أطوال التدفقات المخزنة، مع عينة لقياس deflate."""
+        analysis = StreamAnalysis(breakdown={"images": 0, "fonts": 0, "content": 0, "other": 0, "objects": 0})
+        with open_document(pdf_path) as document:
+            content_xrefs = {xref for page in document for xref in page.get_contents()}
+            uncompressed: List[int] = []
+            by_length: Dict[int, List[int]] = defaultdict(list)
+
+            for xref in range(1, document.xref_length()):
+                try:
+                    is_stream = document.xref_is_stream(xref)
+                except (RuntimeError, ValueError):
+                    continue
+                analysis.breakdown["objects"] += len(document.xref_object(xref, compressed=True)) + self.OBJECT_OVERHEAD_BYTES
+                if not is_stream:
+                    continue
+
+                length = stream_length(document, xref)
+                analysis.breakdown[self._stream_category(document, xref, content_xrefs)] += length
+                analysis.stream_count += 1
+                by_length[length].append(xref)
+                subtype = document.xref_get_key(xref, "Subtype")[1]
+                if document.xref_get_key(xref, "Filter")[0] == "null" and subtype != "/Image":
+                    uncompressed.append(xref)
+
+            # التدفقات ذات الطول المتطابق فقط تُقرأ وتُقارن بصمتها
+            for length, xrefs in by_length.items():
+                if length <= 0 or len(xrefs) < 2:
+                    continue
+                digests = defaultdict(int)
+                for xref in xrefs:
+                    digests[hashlib.sha1(document.xref_stream_raw(xref) or b"").digest()] += 1
+                analysis.duplicate_bytes += sum((count - 1) * length for count in digests.values())
+
+            analysis.uncompressed_bytes = sum(stream_length(document, xref) for xref in uncompressed)
+            step = max(1, len(uncompressed) // sample_size)
+            sample = uncompressed[::step][:sample_size]
+            raw_total = packed_total = 0
+            seconds = 0.0
+            for xref in sample:
+                raw = document.xref_stream_raw(xref) or b""
+                started = time.perf_counter()
+                packed_total += len(zlib.compress(raw, 6))
+                seconds += time.perf_counter() - started
+                raw_total += len(raw)
+            if raw_total:
+                analysis.deflate_ratio = min(1.0, packed_total / raw_total)
+                analysis.deflate_seconds_per_byte = seconds / raw_total
+            analysis.sampled_streams = len(sample)
+            analysis.page_count = document.page_count
+            self._sample_clean(document, analysis)
+        return analysis
+
+    def _sample_clean(self, document: fitz.Document, analysis: StreamAnalysis) -> None:
+        """
+        clean يدمج تدفقات محتوى كل صفحة في تدفق واحد ويعيد ضغطه، وهو مصدر التوفير الأكبر في الملفات
+        التي تُكتب صفحاتها على دفعات (تدفق لكل إضافة). نقيس النسبة على عينة صفحات موزعة.
+        """
+        def stored(xref: int) -> int:
+            return stream_length(document, xref) + len(document.xref_object(xref, compressed=True)) + self.OBJECT_OVERHEAD_BYTES
+
+        pages = [document[index].get_contents() for index in range(document.page_count)]
+        analysis.page_content_bytes = sum(stored(xref) for xrefs in pages for xref in xrefs)
+        if not analysis.page_content_bytes:
+            return
+
+        step = max(1, len(pages) // self.CLEAN_SAMPLE_PAGES)
+        before = after = 0
+        for xrefs in pages[::step][: self.CLEAN_SAMPLE_PAGES]:
+            if not xrefs:
+                continue
+            before += sum(stored(xref) for xref in xrefs)
+            merged = b"\n".join(document.xref_stream(xref) or b"" for xref in xrefs)
+            after += len(zlib.compress(merged, 6)) + 2 * self.OBJECT_OVERHEAD_BYTES
+        if before:
+            analysis.clean_ratio = min(1.0, after / before)
+
+    @staticmethod
+    def _stream_category(document: fitz.Document, xref: int, content_xrefs: set) -> str:
+        subtype = document.xref_get_key(xref, "Subtype")[1]
+        if subtype == "/Image":
+            return "images"
+        if xref in content_xrefs or subtype == "/Form":
+            return "content"
+        # برامج الخطوط: FontFile/FontFile2 تحمل Length1، وFontFile3 تحمل Subtype خاصًا بها
+        if document.xref_get_key(xref, "Length1")[0] != "null" or subtype in (
+            "/Type1C",
+            "/CIDFontType0C",
+            "/OpenType",
+        ):
+            return "fonts"
+        return "other"
+
+    def compress(
+        self,
+        pdf_path: Path,
+        level: str = "medium",
+        replacements: Optional[Sequence[ImageReplacement]] = None,
+    ) -> CompressionResult:
+        level = level.lower() if level.lower() in self.LEVEL_OPTIONS else "medium"
+        options = self.LEVEL_OPTIONS[level]
+        fonts: List[FontReport] = []
+
+        cache = get_document_cache()
+        try:
+            with cache.document(pdf_path) as document, self.storage.open_output(".pdf") as output:
+                if replacements:
+                    self._apply_replacements(document, replacements)
+                if level in self.FONT_LEVELS:
+                    fonts = self.optimize_fonts(document)
+                document.save(output.handle, **options)
+        finally:
+            # garbage وclean والاستبدالات ومرحلة الخطوط تعدل المستند في الذاكرة، فلا يُعاد استخدام المقبض
+            cache.invalidate(pdf_path)
+            if replacements:
+                clean_temp_files({item.path for item in replacements})
+
+        return CompressionResult(path=output.path, level=level, fonts=fonts)
+
+    # ------------------------------------------------------------------
+    # مرحلة الخطوط
+    # ------------------------------------------------------------------
+    def optimize_fonts(self, document: fitz.Document) -> List[FontReport]:
+        """
+        دمج برامج الخطوط المتطابقة حرفيًا في كائن واحد، ثم اقتطاع كل خط إلى الحروف المستخدمة.
+
+        الدمج أولًا حتى يُقتطع البرنامج المشترك مرة واحدة على مجموع الحروف المستخدمة في كل الصفحات
+        (الملفات المدمجة تضمن الخط نفسه مرة لكل ملف مصدر). الاقتطاع عبر MuPDF دون اعتماديات إضافية.
+        """
+        programs = self._font_programs(document)
+        if not programs:
+            return []
+
+        reports: List[FontReport] = []
+        canonical: Dict[str, int] = {}
+        for xref, (name, references) in programs.items():
+            digest = hashlib.sha1(document.xref_stream_raw(xref) or b"").hexdigest()
+            if digest not in canonical:
+                canonical[digest] = xref
+                continue
+            for descriptor, key in references:
+                document.xref_set_key(descriptor, key, f"{canonical[digest]} 0 R")
+            reports.append(FontReport(name, xref, "deduplicated", self._stored_font_bytes(document, xref), 0))
+
+        before = {xref: self._stored_font_bytes(document, xref) for xref in canonical.values()}
+        try:
+            document.subset_fonts()
+            subset = True
+        except (RuntimeError, ValueError):
+            subset = False  # خط لا يدعم MuPDF اقتطاعه؛ تبقى البرامج كاملة
+
+        for xref in canonical.values():
+            after = self._stored_font_bytes(document, xref) if subset else before[xref]
+            action = "subset" if after < before[xref] else "unchanged"
+            reports.append(FontReport(programs[xref][0], xref, action, before[xref], min(after, before[xref])))
+        return sorted(reports, key=lambda report: report.bytes_before - report.bytes_after, reverse=True)
+
+    @staticmethod
+    def _font_programs(document: fitz.Document) -> Dict[int, tuple]:
+        """برامج الخطوط المضمنة: xref البرنامج -> (اسم الخط، [(FontDescriptor، المفتاح)])."""
+        programs: Dict[int, tuple] = {}
+        for xref in range(1, document.xref_length()):
+            try:
+                if document.xref_get_key(xref, "Type")[1] != "/FontDescriptor":
+                    continue
+            except (RuntimeError, ValueError):
+                continue
+            name = document.xref_get_key(xref, "FontName")[1].lstrip("/") or f"font-{xref}"
+            for key in ("FontFile", "FontFile2", "FontFile3"):
+                kind, value = document.xref_get_key(xref, key)
+                if kind != "xref":
+                    continue
+                program = int(value.split()[0])
+                programs.setdefault(program, (name, []))[1].append((xref, key))
+        return programs
+
+    @staticmethod
+    def _stored_font_bytes(document: fitz.Document, xref: int) -> int:
+        # الحجم بعد deflate_fonts: المضغوط يُحسب بطوله المخزن، وغير المضغوط بعد ضغطه
+        if not document.xref_is_stream(xref):
+            return 0
+        if document.xref_get_key(xref, "Filter")[0] != "null":
+            return stream_length(document, xref)
+        return len(zlib.compress(document.xref_stream(xref) or b"", 6))
+
+    # ------------------------------------------------------------------
+    # تمريرة الصور
+    # ------------------------------------------------------------------
+    def find_images(self, pdf_path: Path) -> List[ImageCandidate]:
+        """حصر صور الملف القابلة لإعادة الترميز مع أقل دقة فعلية (DPI) تُعرض بها في أي صفحة."""
+        with open_document(pdf_path) as document:
+            dpi: Dict[int, float] = {}
+            for page in document:
+                for info in page.get_image_info(xrefs=True):
+                    xref = info.get("xref") or 0
+                    bbox = fitz.Rect(info["bbox"])
+                    if xref <= 0 or bbox.is_empty:
+                        continue
+                    # الصورة المعروضة بأكبر حجم تحدد الدقة التي يجب الحفاظ عليها
+                    shown = min(info["width"] * 72 / bbox.width, info["height"] * 72 / bbox.height)
+                    dpi[xref] = min(dpi.get(xref, shown), shown)
+
+            candidates = []
+            for xref, effective_dpi in dpi.items():
+                if not self._is_recodable(document, xref):
+                    continue
+                stream_bytes = len(document.xref_stream_raw(xref) or b"")
+                if stream_bytes < self.MIN_IMAGE_BYTES:
+                    continue
+                width = int(document.xref_get_key(xref, "Width")[1])
+                height = int(document.xref_get_key(xref, "Height")[1])
+                candidates.append(ImageCandidate(xref, width, height, round(effective_dpi, 1), stream_bytes))
+            return candidates
+
+    @staticmethod
+    def _is_recodable(document: fitz.Document, xref: int) -> bool:
+        # الأقنعة والصور أحادية البت (CCITT/JBIG2) وذات مصفوفة Decode تتغير دلالتها بترميز JPEG
+        if document.xref_get_key(xref, "Subtype")[1] != "/Image":
+            return False
+        if document.xref_get_key(xref, "ImageMask")[1] == "true":
+            return False
+        if document.xref_get_key(xref, "BitsPerComponent")[1] == "1":
+            return False
+        if document.xref_get_key(xref, "Decode")[0] != "null":
+            return False
+        return document.xref_get_key(xref, "Width")[0] == "int" and document.xref_get_key(xref, "Height")[0] == "int"
+
+    @staticmethod
+    def _balance(candidates: Sequence[ImageCandidate], workers: int) -> List[List[ImageCandidate]]:
+        """توزيع الصور على دفعات متقاربة في عدد البكسلات (الأكبر أولًا إلى الدفعة الأخف)."""
+        count = max(1, min(workers, len(candidates)))
+        batches: List[List[ImageCandidate]] = [[] for _ in range(count)]
+        loads = [0] * count
+        for candidate in sorted(candidates, key=lambda item: item.width * item.height, reverse=True):
+            index = loads.index(min(loads))
+            batches[index].append(candidate)
+            loads[index] += candidate.width * candidate.height
+        return [batch for batch in batches if batch]
+
+    def recompress_images(
+        self,
+        pdf_path: Path,
+        candidates: Sequence[ImageCandidate],
+        profile: ImageProfile,
+    ) -> List[ImageReplacement]:
+        """إعادة ترميز دفعة صور إلى JPEG (مع التصغير عند الحاجة) وحفظ ما يوفر منها في ملف مؤقت واحد."""
+        replacements: List[ImageReplacement] = []
+        with open_document(pdf_path) as document, self.storage.open_output(".bin", directory=self.storage.temp_dir) as output:
+            offset = 0
+            for candidate in candidates:
+                try:
+                    data, width, height, gray = self._encode_image(document, candidate, profile)
+                except (RuntimeError, ValueError):
+                    continue  # صيغة لا يستطيع MuPDF فكها؛ تبقى كما هي
+                if len(data) > candidate.stream_bytes * (1 - self.MIN_SAVING_RATIO):
+                    continue
+                output.handle.write(data)
+                replacements.append(
+                    ImageReplacement(
+                        xref=candidate.xref,
+                        width=width,
+                        height=height,
+                        gray=gray,
+                        path=output.path,
+                        offset=offset,
+                        length=len(data),
+                        original_bytes=candidate.stream_bytes,
+                    )
+                )
+                offset += len(data)
+
+        if not replacements:
+            output.path.unlink(missing_ok=True)
+        return replacements
+
+    @classmethod
+    def _encode_image(
+        cls,
+        document: fitz.Document,
+        candidate: ImageCandidate,
+        profile: ImageProfile,
+    ) -> tuple[bytes, int, int, bool]:
+        pixmap = cls._decode_image(document, candidate.xref)
+        data, width, height = cls._encode_pixmap(pixmap, candidate, profile)
+        return data, width, height, pixmap.colorspace.n == 1
+
+    @staticmethod
+    def _decode_image(document: fitz.Document, xref: int) -> fitz.Pixmap:
+        # Pixmap(document, xref) يفك الصورة وحدها دون SMask، فيبقى قناع الشفافية الأصلي كما هو
+        pixmap = fitz.Pixmap(document, xref)
+        if pixmap.alpha:
+            pixmap = fitz.Pixmap(pixmap, 0)
+        if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3):
+            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+        return pixmap
+
+    @classmethod
+    def _encode_pixmap(
+        cls,
+        pixmap: fitz.Pixmap,
+        candidate: ImageCandidate,
+        profile: ImageProfile,
+        *,
+        window: Optional[int] = None,
+    ) -> tuple[bytes, int, int]:
+        """ترميز الصورة بإعدادات profile؛ مع window يُرمَّز مربع في وسطها فقط (للتقدير)."""
+        factor = profile.dpi / candidate.dpi if candidate.dpi > profile.dpi * cls.DOWNSAMPLE_MARGIN else 1.0
+        if window:
+            source_width = min(pixmap.width, round(window / factor))
+            source_height = min(pixmap.height, round(window / factor))
+            left = pixmap.x + (pixmap.width - source_width) // 2
+            top = pixmap.y + (pixmap.height - source_height) // 2
+            clip = fitz.IRect(left, top, left + source_width, top + source_height)
+            # نسخ النافذة ثم تصغيرها (معامل clip في منشئ Pixmap غير مستقر في هذا الإصدار)
+            cropped = fitz.Pixmap(pixmap.colorspace, clip, False)
+            cropped.copy(pixmap, clip)
+            pixmap = cropped
+        if factor < 1.0:
+            width = max(1, round(pixmap.width * factor))
+            height = max(1, round(pixmap.height * factor))
+            pixmap = fitz.Pixmap(pixmap, width, height, None)
+
+        data = pixmap.tobytes("jpeg", jpg_quality=profile.quality)
+        return data, pixmap.width, pixmap.height
 
-        with fitz.open(pdf_path) as document:
-            pdf_bytes = document.tobytes(**options)
+    @staticmethod
+    def _apply_replacements(document: fitz.Document, replacements: Sequence[ImageReplacement]) -> None:
+        handles: Dict[Path, object] = {}
+        try:
+            for item in replacements:
+                handle = handles.get(item.path)
+                if handle is None:
+                    handle = handles[item.path] = item.path.open("rb")
+                handle.seek(item.offset)
+                data = handle.read(item.length)
 
-        return self.storage.save_bytes(pdf_bytes, suffix=".pdf")
+                document.update_stream(item.xref, data, compress=False)
+                document.xref_set_key(item.xref, "Filter", item.filter)
+                document.xref_set_key(item.xref, "DecodeParms", "null")
+                document.xref_set_key(item.xref, "SMaskInData", "null")
+                document.xref_set_key(item.xref, "Width", str(item.width))
+                document.xref_set_key(item.xref, "Height", str(item.height))
+                document.xref_set_key(item.xref, "BitsPerComponent", str(item.bits))
+                document.xref_set_key(item.xref, "ColorSpace", "/DeviceGray" if item.gray else "/DeviceRGB")
+        finally:
+            for handle in handles.values():
+                handle.close()
@@ -32,8 +32,8 @@ class ConversionService:
     # ------------------------------------------------------------------
     def _duplicate_pdf(self, source_path: Path) -> Path:
         target_path = self.storage.processed_dir / f"{uuid4().hex}.pdf"
-        target_path.write_bytes(source_path.read_bytes())
-        return target_path
+        digest = self.storage.deduplicate(source_path)
+        return self.storage.blobs.link(digest, target_path)
 
     def _docx_to_pdf(self, docx_path: Path) -> Path:
         document = DocxDocument(docx_path)
@@ -1,28 +1,77 @@
 from __future__ import annotations
 
+import math
+from functools import lru_cache
 from io import BytesIO
 from pathlib import Path
-from typing import Iterable, List, Sequence, Tuple
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
+import fitz  # PyMuPDF
 from pypdf import PdfReader, PdfWriter
 from reportlab.lib.colors import Color
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 
+from app.core.config import get_settings
 from app.storage.local import LocalStorage
-from app.utils.pdf_preview import render_page_preview
+from app.utils.document_cache import open_document
+from app.utils.pdf_inspect import stream_length
+from app.utils.pdf_preview import png_data_uri, render_pixmap_png
 
 
 class PDFService:
     """خدمات أساسية للتعامل مع ملفات PDF (دمج، تقسيم، وإضافة علامات مائية)."""
 
-    def __init__(self, storage: LocalStorage | None = None) -> None:
+    # خيارات حفظ ناتج الدمج: garbage=4 يدمج الكائنات والتدفقات المتطابقة (الخطوط والصور وملفات ICC)
+    # وuse_objstms يضغط الكائنات الصغيرة داخل تدفقات كائنات
+    MERGE_SAVE_OPTIONS = dict(garbage=4, deflate=True, use_objstms=1)
+
+    def __init__(self, storage: LocalStorage | None = None, merge_engine: str | None = None) -> None:
         self.storage = storage or LocalStorage()
+        self.merge_engine = merge_engine or get_settings().merge_engine
 
     # ------------------------------------------------------------------
     # دمج ملفات PDF
     # ------------------------------------------------------------------
-    def merge(self, pdf_paths: Sequence[Path]) -> Path:
+    def merge(
+        self,
+        pdf_paths: Sequence[Path],
+        *,
+        keep_outlines: bool = False,
+        keep_links: bool = True,
+    ) -> Path:
+        if self.merge_engine == "pypdf":
+            return self.merge_pypdf(pdf_paths)
+        return self.merge_pymupdf(pdf_paths, keep_outlines=keep_outlines, keep_links=keep_links)
+
+    def merge_pymupdf(
+        self,
+        pdf_paths: Sequence[Path],
+        *,
+        keep_outlines: bool = False,
+        keep_links: bool = True,
+    ) -> Path:
+        """
+        دمج عبر insert_pdf مع فتح ملف مصدر واحد فقط في كل لحظة.
+
+        لا تُستخدم ذاكرة المقابض هنا لأن كل مدخل يُقرأ مرة واحدة، فلا تُزاح مقابض المعاينات.
+        الموارد المكررة بين المدخلات تُدمج عند الحفظ، والفهارس (outlines) تُنقل مع إزاحة أرقام صفحاتها.
+        """
+        with fitz.open() as target:
+            toc: List[list] = []
+            for path in pdf_paths:
+                offset = target.page_count
+                with fitz.open(path) as source:
+                    target.insert_pdf(source, links=keep_links, annots=True)
+                    if keep_outlines:
+                        for level, title, page in source.get_toc(simple=True):
+                            toc.append([level, title, page + offset if page > 0 else -1])
+            if toc:
+                target.set_toc(toc)
+            return self._write_document(target, **self.MERGE_SAVE_OPTIONS)
+
+    def merge_pypdf(self, pdf_paths: Sequence[Path]) -> Path:
+        """المحرك السابق المعتمد على pypdf (للمقارنة أو عبر merge_engine=pypdf)."""
         writer = PdfWriter()
         for path in pdf_paths:
             reader = PdfReader(str(path))
@@ -39,24 +88,126 @@ class PDFService:
         ranges: List[Tuple[int, int]],
         separate_files: bool = False,
     ) -> List[Path]:
-        reader = PdfReader(str(pdf_path))
         outputs: List[Path] = []
 
-        if separate_files:
-            for start, end in ranges:
-                writer = PdfWriter()
-                for page_number in range(start - 1, end):
-                    writer.add_page(reader.pages[page_number])
-                outputs.append(self._write_writer(writer))
-        else:
-            writer = PdfWriter()
-            for start, end in ranges:
-                for page_number in range(start - 1, end):
-                    writer.add_page(reader.pages[page_number])
-            outputs.append(self._write_writer(writer))
+        # المستند المصدر يُستعار من ذاكرة المقابض المفتوحة ولا يُعدل
+        with open_document(pdf_path) as source:
+            if separate_files:
+                for start, end in ranges:
+                    outputs.append(self._write_pages(source, [(start, end)]))
+            else:
+                outputs.append(self._write_pages(source, ranges))
 
         return outputs
 
+    # ------------------------------------------------------------------
+    # التقسيم الجماعي: تخطيط المقاطع ثم كتابتها على دفعات متوازية
+    # ------------------------------------------------------------------
+    def plan_split(
+        self,
+        pdf_path: Path,
+        mode: str,
+        *,
+        every_pages: int | None = None,
+        bookmark_level: int = 1,
+        max_chunk_bytes: int | None = None,
+    ) -> List[Tuple[int, int, str]]:
+        """
+        حساب مقاطع التقسيم (بداية، نهاية، عنوان) بفتحة واحدة للملف.
+
+        - every: كل every_pages صفحة مقطع.
+        - bookmarks: يبدأ مقطع عند كل عنصر فهرس في المستوى bookmark_level.
+        - max_size: تُضم الصفحات المتتالية ما دام الحجم التقديري للمقطع لا يتجاوز max_chunk_bytes.
+
+        يرفع ValueError عند عدم وجود فهرس في المستوى المطلوب.
+        """
+        with open_document(pdf_path) as document:
+            page_count = document.page_count
+            if mode == "every":
+                step = max(1, every_pages or 1)
+                return [
+                    (start, min(start + step - 1, page_count), "")
+                    for start in range(1, page_count + 1, step)
+                ]
+            if mode == "bookmarks":
+                return self._bookmark_chunks(document, bookmark_level)
+            if mode == "max_size":
+                return self._size_chunks(document, max(1, max_chunk_bytes or 1))
+        raise ValueError(f"unsupported split mode: {mode}")
+
+    @staticmethod
+    def _bookmark_chunks(document: fitz.Document, level: int) -> List[Tuple[int, int, str]]:
+        marks: List[Tuple[int, str]] = []
+        for entry_level, title, page in document.get_toc(simple=True):
+            if entry_level == level and page > 0 and (not marks or page > marks[-1][0]):
+                marks.append((page, title))
+        if not marks:
+            raise ValueError("لا يحتوي الملف على عناصر فهرس في المستوى المطلوب.")
+
+        chunks: List[Tuple[int, int, str]] = []
+        if marks[0][0] > 1:
+            chunks.append((1, marks[0][0] - 1, ""))
+        for index, (page, title) in enumerate(marks):
+            end = marks[index + 1][0] - 1 if index + 1 < len(marks) else document.page_count
+            chunks.append((page, end, title))
+        return chunks
+
+    @classmethod
+    def _page_objects(cls, document: fitz.Document, index: int) -> Dict[int, int]:
+        """التدفقات التي تعتمد عليها الصفحة (المحتوى والصور والخطوط المضمنة) مع أحجامها."""
+        objects: Dict[int, int] = {}
+        page = document.load_page(index)
+        for xref in page.get_contents():
+            objects[xref] = stream_length(document, xref)
+        for image in document.get_page_images(index):
+            objects[image[0]] = stream_length(document, image[0])
+            if image[1]:  # قناع الشفافية
+                objects[image[1]] = stream_length(document, image[1])
+        for font in document.get_page_fonts(index):
+            descriptor_kind, descriptor = document.xref_get_key(font[0], "FontDescriptor")
+            if descriptor_kind != "xref":
+                continue
+            descriptor_xref = int(descriptor.split()[0])
+            for key in ("FontFile", "FontFile2", "FontFile3"):
+                kind, value = document.xref_get_key(descriptor_xref, key)
+                if kind == "xref":
+                    font_xref = int(value.split()[0])
+                    objects[font_xref] = stream_length(document, font_xref)
+        return objects
+
+    @classmethod
+    def _size_chunks(cls, document: fitz.Document, max_bytes: int) -> List[Tuple[int, int, str]]:
+        # الموارد المشتركة بين صفحات المقطع (خطوط وشعارات) تُحتسب مرة واحدة لكل مقطع
+        page_overhead = 512
+        chunks: List[Tuple[int, int, str]] = []
+        start = 1
+        size = 0
+        seen: Dict[int, int] = {}
+        for index in range(document.page_count):
+            objects = cls._page_objects(document, index)
+            added = page_overhead + sum(length for xref, length in objects.items() if xref not in seen)
+            if size and size + added > max_bytes:
+                chunks.append((start, index, ""))
+                start, size, seen = index + 1, 0, {}
+                added = page_overhead + sum(objects.values())
+            size += added
+            seen.update(objects)
+        chunks.append((start, document.page_count, ""))
+        return chunks
+
+    def write_ranges(self, pdf_path: Path, ranges: Sequence[Tuple[int, int]]) -> List[Path]:
+        """كتابة كل مدى كملف مستقل من مقبض واحد للمصدر (دفعة من تقسيم جماعي)."""
+        outputs: List[Path] = []
+        try:
+            with open_document(pdf_path) as source:
+                for start, end in ranges:
+                    outputs.append(self._write_pages(source, [(start, end)]))
+        except BaseException:
+            for path in outputs:
+                path.unlink(missing_ok=True)
+            raise
+        return outputs
+
     # ------------------------------------------------------------------
     # إضافة علامة مائية نصية بسيطة
     # ------------------------------------------------------------------
@@ -67,26 +218,63 @@ class PDFService:
         opacity: float = 0.3,
         position: str = "center",
         font_size: int | None = None,
+        stamps: Optional[Mapping[Tuple[float, float], bytes]] = None,
     ) -> Path:
-        reader = PdfReader(str(pdf_path))
-        writer = PdfWriter()
+        with fitz.open() as target:
+            with open_document(pdf_path) as source:
+                target.insert_pdf(source)
 
-        for page in reader.pages:
-            width = float(page.mediabox.width)
-            height = float(page.mediabox.height)
-            watermark_pdf = self._create_watermark_page(
-                width=width,
-                height=height,
-                text=text,
-                opacity=opacity,
-                position=position,
-                font_size=font_size,
-            )
-            watermark_page = watermark_pdf.pages[0]
-            page.merge_page(watermark_page)
-            writer.add_page(page)
+            self._stamp_pages(target, text, opacity, position, font_size, stamps)
+            return self._write_document(target)
 
-        return self._write_writer(writer)
+    def add_image_watermark(
+        self,
+        pdf_path: Path,
+        image_path: Path,
+        opacity: float = 0.3,
+        position: str = "center",
+        scale: float = 0.3,
+    ) -> Path:
+        image = Path(image_path).read_bytes()
+        with fitz.open() as target:
+            with open_document(pdf_path) as source:
+                target.insert_pdf(source)
+
+            self._stamp_image_pages(target, image, opacity, position, scale)
+            return self._write_document(target)
+
+    def preview_image_watermark(
+        self,
+        pdf_path: Path,
+        image_path: Path,
+        opacity: float = 0.3,
+        position: str = "center",
+        scale: float = 0.3,
+        page_number: int = 1,
+        zoom: float = 1.5,
+    ) -> str:
+        """معاينة علامة الصورة على صفحة واحدة في الذاكرة، كما في preview_text_watermark."""
+        image = Path(image_path).read_bytes()
+        with fitz.open() as target:
+            with open_document(pdf_path) as source:
+                if not 1 <= page_number <= source.page_count:
+                    raise ValueError("رقم الصفحة خارج نطاق صفحات الملف.")
+                target.insert_pdf(source, from_page=page_number - 1, to_page=page_number - 1)
+
+            self._stamp_image_pages(target, image, opacity, position, scale)
+            return png_data_uri(render_pixmap_png(target[0], zoom))
+
+    @staticmethod
+    def build_watermark_stamps(
+        page_sizes: Iterable[Tuple[float, float]],
+        text: str,
+        opacity: float = 0.3,
+        position: str = "center",
+        font_size: int | None = None,
+    ) -> Dict[Tuple[float, float], bytes]:
+        """بناء أختام العلامة المائية مسبقًا لمقاسات الصفحات المعروفة حتى تُمرر جاهزة إلى add_text_watermark."""
+        sizes = {(round(width, 2), round(height, 2)) for width, height in page_sizes}
+        return {size: _watermark_stamp(*size, text, opacity, position, font_size or None) for size in sizes}
 
     def preview_text_watermark(
         self,
@@ -95,27 +283,194 @@ class PDFService:
         opacity: float = 0.3,
         position: str = "center",
         font_size: int | None = None,
+        page_number: int = 1,
+        zoom: float = 1.5,
     ) -> str:
-        temp_path = self.add_text_watermark(
-            pdf_path=pdf_path,
-            text=text,
-            opacity=opacity,
-            position=position,
-            font_size=font_size,
-        )
-        try:
-            return render_page_preview(temp_path, page_number=1)
-        finally:
-            temp_path.unlink(missing_ok=True)
+        """
+        معاينة العلامة المائية على صفحة واحدة دون كتابة أي ملف.
+
+        تُنسخ الصفحة المطلوبة وحدها إلى مستند في الذاكرة ثم تُختم وتُرسم، فتبقى كلفة المعاينة
+        ثابتة مهما كان عدد صفحات الملف.
+        """
+        with fitz.open() as target:
+            with open_document(pdf_path) as source:
+                if not 1 <= page_number <= source.page_count:
+                    raise ValueError("رقم الصفحة خارج نطاق صفحات الملف.")
+                target.insert_pdf(source, from_page=page_number - 1, to_page=page_number - 1)
+
+            self._stamp_pages(target, text, opacity, position, font_size)
+            return png_data_uri(render_pixmap_png(target[0], zoom))
 
     # ------------------------------------------------------------------
     # Helpers
     # ------------------------------------------------------------------
     def _write_writer(self, writer: PdfWriter) -> Path:
-        buffer = BytesIO()
-        writer.write(buffer)
-        buffer.seek(0)
-        return self.storage.save_bytes(buffer.getvalue(), suffix=".pdf")
+        with self.storage.open_output(".pdf") as output:
+            writer.write(output.handle)
+        return output.path
+
+    def _write_document(self, document: fitz.Document, **options) -> Path:
+        options = options or dict(garbage=1, deflate=True)
+        with self.storage.open_output(".pdf") as output:
+            document.save(output.handle, **options)
+        return output.path
+
+    def _write_pages(self, source: fitz.Document, ranges: Sequence[Tuple[int, int]]) -> Path:
+        with fitz.open() as target:
+            for start, end in ranges:
+                target.insert_pdf(source, from_page=start - 1, to_page=end - 1)
+            return self._write_document(target)
+
+    @staticmethod
+    def _overlay_pages(
+        document: fitz.Document,
+        stamp_page: Callable[[Tuple[float, float]], Tuple[fitz.Document, int]],
+    ) -> None:
+        """
+        وضع صفحة ختم فوق كل صفحة في المستند.
+
+        stamp_page تُرجع (مستند الختم، رقم الصفحة) لمقاس الصفحة. show_pdf_page يضيف كل صفحة ختم
+        إلى الملف كـ Form XObject مشترك تشير إليه كل الصفحات بدل تكرار محتواه في كل صفحة.
+        """
+        for page in document:
+            # العلامة تُرسم في فضاء الصفحة غير المدار كما كان الدمج عبر pypdf
+            rotation = page.rotation
+            if rotation:
+                page.set_rotation(0)
+            source, page_index = stamp_page((round(page.rect.width, 2), round(page.rect.height, 2)))
+            page.show_pdf_page(page.rect, source, page_index, overlay=True)
+            if rotation:
+                page.set_rotation(rotation)
+
+    @classmethod
+    def _stamp_pages(
+        cls,
+        document: fitz.Document,
+        text: str,
+        opacity: float,
+        position: str,
+        font_size: int | None,
+        prebuilt: Optional[Mapping[Tuple[float, float], bytes]] = None,
+    ) -> None:
+        """ختم كل الصفحات بعلامة نصية: ختم واحد لكل مقاس صفحة مختلف (أو من prebuilt) يُفتح مرة واحدة."""
+        prebuilt = prebuilt or {}
+        stamps: Dict[Tuple[float, float], fitz.Document] = {}
+
+        def stamp_page(size: Tuple[float, float]) -> Tuple[fitz.Document, int]:
+            if size not in stamps:
+                stamp_pdf = prebuilt.get(size) or _watermark_stamp(*size, text, opacity, position, font_size or None)
+                stamps[size] = fitz.open("pdf", stamp_pdf)
+            return stamps[size], 0
+
+        try:
+            cls._overlay_pages(document, stamp_page)
+        finally:
+            for stamp in stamps.values():
+                stamp.close()
+
+    @classmethod
+    def _stamp_image_pages(
+        cls,
+        document: fitz.Document,
+        image: bytes,
+        opacity: float,
+        position: str,
+        scale: float,
+    ) -> None:
+        """
+        ختم كل الصفحات بصورة (شعار).
+
+        مستند الختم يحوي صفحة لكل مقاس صفحة مختلف، والصورة مضمنة فيه مرة واحدة تشير إليها كل
+        صفحاته (insert_image مع xref)، فيزيد حجم الناتج بحجم الصورة مرة واحدة فقط.
+        """
+        # كل صفحات الختم تُبنى قبل أول show_pdf_page، فإضافة صفحات إلى المصدر بعد بدء النقل منه غير مدعومة
+        sizes = dict.fromkeys(
+            (round(box.width, 2), round(box.height, 2))
+            for box in (document.page_cropbox(index) for index in range(document.page_count))
+        )
+        stamp = fitz.open()
+        pages: Dict[Tuple[float, float], int] = {}
+        image_xref = 0
+        for width, height in sizes:
+            page = stamp.new_page(width=width, height=height)
+            if image_xref:
+                page.insert_image(page.rect, xref=image_xref)
+            else:
+                image_xref = page.insert_image(page.rect, stream=image)
+            info = next(item for item in page.get_images(full=True) if item[0] == image_xref)
+            pixel_width, pixel_height, name = info[2], info[3], info[7]
+            placements = cls._image_placements(width, height, pixel_height / pixel_width, position, scale)
+            cls._write_image_stamp(stamp, page, name, placements, opacity)
+            pages[(width, height)] = page.number
+
+        def stamp_page(size: Tuple[float, float]) -> Tuple[fitz.Document, int]:
+            return stamp, pages[size]
+
+        try:
+            cls._overlay_pages(document, stamp_page)
+        finally:
+            stamp.close()
+
+    @staticmethod
+    def _image_placements(
+        width: float,
+        height: float,
+        aspect: float,
+        position: str,
+        scale: float,
+    ) -> List[Tuple[float, float, float, float, float]]:
+        """مواضع الصورة كـ (مركز x، مركز y، العرض، الارتفاع، الزاوية) في إحداثيات PDF (الأصل أسفل اليسار)."""
+        image_width = width * scale
+        image_height = image_width * aspect
+        if position != "tile" and image_height > height * 0.9:
+            image_height = height * 0.9
+            image_width = image_height / aspect
+
+        if position == "tile":
+            step_x = image_width * 1.6
+            step_y = image_height * 1.6
+            return [
+                (x, y, image_width, image_height, 30)
+                for x in PDFService._frange(-width, width * 2, step_x)
+                for y in PDFService._frange(-height, height * 2, step_y)
+            ]
+
+        margin = height * 0.05
+        if position == "top":
+            center_y = height - margin - image_height / 2
+        elif position == "bottom":
+            center_y = margin + image_height / 2
+        else:
+            center_y = height / 2
+        angle = 45 if position == "diagonal" else 0
+        return [(width / 2, center_y, image_width, image_height, angle)]
+
+    @staticmethod
+    def _write_image_stamp(
+        stamp: fitz.Document,
+        page: fitz.Page,
+        image_name: str,
+        placements: Sequence[Tuple[float, float, float, float, float]],
+        opacity: float,
+    ) -> None:
+        # نستبدل محتوى الصفحة الذي كتبه insert_image بمحتوى يرسم الصورة بالشفافية والزوايا المطلوبة
+        kind, value = stamp.xref_get_key(page.xref, "Resources")
+        owner, path = (int(value.split()[0]), "ExtGState/WmGS") if kind == "xref" else (page.xref, "Resources/ExtGState/WmGS")
+        stamp.xref_set_key(owner, path, f"<</Type/ExtGState/ca {opacity:g}/CA {opacity:g}>>")
+        operations = ["q /WmGS gs"]
+        for center_x, center_y, image_width, image_height, angle in placements:
+            cos = math.cos(math.radians(angle))
+            sin = math.sin(math.radians(angle))
+            operations.append(
+                f"q {cos:.5f} {sin:.5f} {-sin:.5f} {cos:.5f} {center_x:.3f} {center_y:.3f} cm "
+                f"{image_width:.3f} 0 0 {image_height:.3f} {-image_width / 2:.3f} {-image_height / 2:.3f} cm "
+                f"/{image_name} Do Q"
+            )
+        operations.append("Q")
+        contents = page.get_contents()
+        stamp.update_stream(contents[0], "\n".join(operations).encode("ascii"))
+        if len(contents) > 1:
+            stamp.xref_set_key(page.xref, "Contents", f"{contents[0]} 0 R")
 
     @staticmethod
     def _create_watermark_page(
@@ -125,7 +480,7 @@ class PDFService:
         opacity: float,
         position: str,
         font_size: int | None = None,
-    ) -> PdfReader:
+    ) -> bytes:
         packet = BytesIO()
         page_size = (width, height) if width and height else letter
         c = canvas.Canvas(packet, pagesize=page_size)
@@ -149,8 +504,7 @@ class PDFService:
             PDFService._draw_centered_watermark(c, text, page_size, font_size, position)
 
         c.save()
-        packet.seek(0)
-        return PdfReader(packet)
+        return packet.getvalue()
 
     @staticmethod
     def _draw_centered_watermark(
@@ -205,3 +559,23 @@ class PDFService:
         while value < stop:
             yield value
             value += step
+
+
+@lru_cache(maxsize=64)
+def _watermark_stamp(
+    width: float,
+    height: float,
+    text: str,
+    opacity: float,
+    position: str,
+    font_size: int | None,
+) -> bytes:
+    """ختم العلامة المائية لكل (مقاس، نص، شفافية، موضع، حجم خط)، يُبنى عبر ReportLab مرة واحدة لكل عملية."""
+    return PDFService._create_watermark_page(
+        width=width,
+        height=height,
+        text=text,
+        opacity=opacity,
+        position=position,
+        font_size=font_size,
+    )
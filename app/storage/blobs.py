@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import errno
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Tuple
+from uuid import uuid4
+
+from app.utils.preview_cache import file_digest, remember_digest
+
+# ioctl(FICLONE) على لينكس لإنشاء نسخة reflink على أنظمة ملفات مثل Btrfs وXFS
+_FICLONE = 0x40049409
+
+
+def _reflink(source: Path, target: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover - غير متاح على ويندوز
+        return False
+    try:
+        with source.open("rb") as src, target.open("wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        target.unlink(missing_ok=True)
+        return False
+
+
+def clone_file(source: Path, target: Path) -> None:
+    """إنشاء target كرابط صلب إلى source، أو reflink، ثم نسخة كاملة كحل أخير عبر أنظمة ملفات مختلفة."""
+    try:
+        os.link(source, target)
+        return
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    if not _reflink(source, target):
+        shutil.copy2(source, target)
+
+
+def _mark_created(path: Path) -> None:
+    """
+    الرابط الصلب يرث وقت تعديل الكتلة القديمة، فنحدّثه حتى لا يبدو الاسم الجديد منتهيًا قبل تسجيله.
+
+    (يتحدث وقت الأسماء الأخرى للكتلة نفسها أيضًا، وهذا يؤخر حذفها فقط ولا يقدّمه.)
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+class BlobStore:
+    """
+    مخزن ملفات معنون بالمحتوى: كل محتوى يُحفظ مرة واحدة باسم بصمته SHA-256.
+
+    الأسماء الظاهرة (الملفات المؤقتة والنتائج والتنزيلات العامة) روابط صلبة إلى الكتلة،
+    لذلك يمثل عدد الروابط (st_nlink) عدد المراجع؛ الكتلة التي لم يبقَ لها غير اسمها
+    داخل المخزن لا يشير إليها شيء ويمكن حذفها.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def ingest(self, path: Path, digest: Optional[str] = None) -> str:
+        """
+        ضم ملف موجود إلى المخزن وإرجاع بصمته.
+
+        إذا كان المحتوى نفسه مخزنًا مسبقًا يُستبدل الملف برابط إلى الكتلة الموجودة
+        فتتحرر مساحة النسخة المكررة، وإلا يصبح الملف نفسه هو الكتلة.
+        """
+        digest = digest or file_digest(path)
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+
+        if blob.exists():
+            if not os.path.samefile(blob, path):
+                staging = path.with_name(f".{uuid4().hex}{path.suffix}")
+                try:
+                    os.link(blob, staging)
+                except OSError:
+                    # نظام ملفات مختلف: نبقي النسخة كما هي
+                    return digest
+                os.replace(staging, path)
+                _mark_created(path)
+        else:
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                # عملية أخرى أنشأت الكتلة للتو
+                return self.ingest(path, digest)
+            except OSError:
+                clone_file(path, blob)
+
+        remember_digest(path, digest)
+        return digest
+
+    def link(self, digest: str, target: Path) -> Path:
+        """إنشاء اسم جديد يشير إلى الكتلة (رابط صلب أو reflink أو نسخة عبر الأنظمة)."""
+        clone_file(self.blob_path(digest), target)
+        _mark_created(target)
+        remember_digest(target, digest)
+        return target
+
+    def refcount(self, digest: str) -> int:
+        """عدد الأسماء خارج المخزن التي تشير إلى الكتلة."""
+        try:
+            return self.blob_path(digest).stat().st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def collect_garbage(self) -> Tuple[int, int]:
+        """حذف الكتل التي لا يشير إليها أي اسم وإرجاع (عددها، حجمها بالبايت)."""
+        removed = reclaimed = 0
+        for blob in self.root.glob("*/*"):
+            try:
+                stat = blob.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink <= 1:
+                blob.unlink(missing_ok=True)
+                removed += 1
+                reclaimed += stat.st_size
+        return removed, reclaimed
+
+    def stats(self) -> dict:
+        count = size = 0
+        for blob in self.root.glob("*/*"):
+            try:
+                size += blob.stat().st_size
+            except FileNotFoundError:
+                continue
+            count += 1
+        return {"blobs": count, "bytes": size}
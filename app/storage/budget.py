@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from app.core.config import Settings, get_settings
+from app.core.logging import configure_logging
+from app.utils.process import process_alive
+
+from .blobs import BlobStore
+
+logger = configure_logging()
+
+
+@dataclass
+class _Candidate:
+    path: Path
+    inode: Tuple[int, int]
+    size: int
+    last_used: float
+
+
+class DiskBudget:
+    """
+    مراقبة المساحة التي يشغلها التطبيق وإخلاء الأقدم استخدامًا عند تجاوز الحد.
+
+    - يُحسب الاستخدام بمسح مجلدات التخزين مع احتساب كل محتوى مرة واحدة
+      (الروابط الصلبة إلى الكتلة نفسها لا تُضاعف الحجم)، ثم يُحدَّث تقريبيًا مع كل ملف جديد.
+    - عند تجاوز العلامة العليا تُحذف الملفات الأقدم استخدامًا حتى الوصول إلى العلامة الدنيا.
+    - الملفات المثبتة (مدخلات مهام قيد التنفيذ) والملفات الحديثة جدًا لا تُحذف أبدًا.
+      التثبيت مشترك بين العمال عبر ملفات علامة في pin_dir (واحد لكل مسار مثبت في كل عملية)،
+      فلا يخلي عامل مدخلات مهمة طويلة يُنفذها عامل آخر.
+    """
+
+    def __init__(
+        self,
+        roots: Iterable[Path],
+        evictable: Iterable[Path],
+        settings: Optional[Settings] = None,
+        pin_dir: Optional[Path] = None,
+    ) -> None:
+        settings = settings or get_settings()
+        roots = [Path(root) for root in roots]
+        # المجلدات المتداخلة (مثل tmp داخل مجلد التخزين) تُمسح مرة واحدة ضمن الأعلى منها
+        self.roots = [root for root in roots if not any(other != root and other in root.parents for other in roots)]
+        self.evictable = [Path(directory) for directory in evictable]
+        self.configured_budget = settings.disk_budget_bytes
+        self.high_watermark = settings.disk_high_watermark
+        self.low_watermark = min(settings.disk_low_watermark, settings.disk_high_watermark)
+        self.grace_seconds = max(0, settings.disk_eviction_grace_seconds)
+
+        self.used_bytes = 0
+        self.budget_bytes = self.configured_budget or 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.last_eviction: Optional[datetime] = None
+
+        self._pins: Counter[str] = Counter()
+        self.pin_dir = Path(pin_dir) if pin_dir else None
+        if self.pin_dir is not None:
+            self.pin_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._scanned = False
+        # تستدعى بعد كل إخلاء لتحرير الكتل التي لم يعد يشير إليها شيء
+        self.after_eviction: Optional[Callable[[], object]] = None
+
+    # ------------------------------------------------------------------
+    # الحساب
+    # ------------------------------------------------------------------
+    def _walk(self) -> Iterator[os.DirEntry]:
+        pending = [str(root) for root in self.roots if root.exists()]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for item in entries:
+                        if item.is_dir(follow_symlinks=False):
+                            pending.append(item.path)
+                        elif item.is_file(follow_symlinks=False):
+                            yield item
+            except FileNotFoundError:
+                continue
+
+    def refresh(self) -> int:
+        """إعادة حساب الاستخدام الفعلي من القرص وإرجاعه بالبايت."""
+        seen: set[Tuple[int, int]] = set()
+        used = 0
+        for item in self._walk():
+            try:
+                stat = item.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            if inode in seen:
+                continue
+            seen.add(inode)
+            used += stat.st_size
+
+        budget = self.configured_budget
+        if not budget and self.roots:
+            # دون حد صريح: كل ما يمكن للتطبيق أن يشغله على القرص الحالي
+            budget = used + shutil.disk_usage(self.roots[0]).free
+        with self._lock:
+            self.used_bytes = used
+            self.budget_bytes = budget or 0
+            self._scanned = True
+        return used
+
+    @property
+    def high_bytes(self) -> int:
+        return int(self.budget_bytes * self.high_watermark)
+
+    @property
+    def low_bytes(self) -> int:
+        return int(self.budget_bytes * self.low_watermark)
+
+    def over_high(self) -> bool:
+        return bool(self.budget_bytes) and self.used_bytes > self.high_bytes
+
+    def charge(self, size_bytes: int) -> None:
+        """احتساب ملف جديد، وبدء الإخلاء إذا تجاوز الاستخدام العلامة العليا."""
+        if not self._scanned:
+            self.refresh()
+        with self._lock:
+            self.used_bytes += max(0, size_bytes)
+        if self.over_high():
+            self.enforce()
+
+    # ------------------------------------------------------------------
+    # الاستخدام والتثبيت
+    # ------------------------------------------------------------------
+    @staticmethod
+    def touch(path: Path) -> None:
+        """تحديث وقت آخر وصول دون المساس بوقت التعديل الذي تعتمد عليه مدة الاحتفاظ."""
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _pin_key(path: str) -> str:
+        return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+    def _marker(self, path: str) -> Optional[Path]:
+        if self.pin_dir is None:
+            return None
+        return self.pin_dir / f"{self._pin_key(path)}.{os.getpid()}"
+
+    def pin(self, paths: Iterable[Path]) -> None:
+        with self._lock:
+            for path in map(str, paths):
+                self._pins[path] += 1
+                marker = self._marker(path)
+                if marker is not None and self._pins[path] == 1:
+                    marker.touch()
+
+    def unpin(self, paths: Iterable[Path]) -> None:
+        with self._lock:
+            for path in map(str, paths):
+                self._pins[path] -= 1
+                marker = self._marker(path)
+                if marker is not None and self._pins[path] <= 0:
+                    marker.unlink(missing_ok=True)
+            self._pins += Counter()  # إزالة العدادات الصفرية
+
+    def _shared_pins(self) -> set[str]:
+        """بصمات المسارات المثبتة في كل العمليات؛ علامات العمليات المنتهية تُحذف."""
+        if self.pin_dir is None:
+            return set()
+        keys: set[str] = set()
+        alive: dict[int, bool] = {}
+        for marker in self.pin_dir.glob("*.*"):
+            key, _, pid_text = marker.name.partition(".")
+            try:
+                pid = int(pid_text)
+            except ValueError:
+                continue
+            if pid not in alive:
+                alive[pid] = process_alive(pid)
+            if alive[pid]:
+                keys.add(key)
+            else:
+                marker.unlink(missing_ok=True)  # عامل توقف دون إلغاء تثبيته
+        return keys
+
+    @contextmanager
+    def pinned(self, paths: Iterable[Path]) -> Iterator[None]:
+        paths = list(paths)
+        self.pin(paths)
+        try:
+            yield
+        finally:
+            self.unpin(paths)
+
+    # ------------------------------------------------------------------
+    # الإخلاء
+    # ------------------------------------------------------------------
+    def _candidates(self) -> Tuple[List[_Candidate], Counter]:
+        now = time.time()
+        with self._lock:
+            pinned = set(self._pins)
+        shared = self._shared_pins()
+        candidates: List[_Candidate] = []
+        names: Counter[Tuple[int, int]] = Counter()
+        for directory in self.evictable:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for item in entries:
+                # الأسماء المخفية ملفات قيد الكتابة (open_output) أو مراحل ربط الكتل
+                if item.name.startswith(".") or not item.is_file(follow_symlinks=False) or item.path in pinned:
+                    continue
+                if shared and self._pin_key(item.path) in shared:
+                    continue
+                try:
+                    stat = item.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                last_used = max(stat.st_atime, stat.st_mtime)
+                if now - last_used < self.grace_seconds:
+                    continue
+                inode = (stat.st_dev, stat.st_ino)
+                names[inode] += 1
+                candidates.append(_Candidate(Path(item.path), inode, stat.st_size, last_used))
+        candidates.sort(key=lambda candidate: candidate.last_used)
+        return candidates, names
+
+    def enforce(self) -> int:
+        """إخلاء الأقدم استخدامًا حتى العلامة الدنيا إذا تجاوز الاستخدام العلامة العليا، وإرجاع عدد الملفات المحذوفة."""
+        if not self._evicting.acquire(blocking=False):
+            return 0  # إخلاء آخر قيد التنفيذ
+        try:
+            self.refresh()
+            if not self.over_high():
+                return 0
+
+            candidates, names = self._candidates()
+            target = self.low_bytes
+            estimated = self.used_bytes
+            removed = 0
+            for candidate in candidates:
+                if estimated <= target:
+                    break
+                try:
+                    nlink = candidate.path.stat().st_nlink
+                    candidate.path.unlink()
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                names[candidate.inode] -= 1
+                # يتحرر المحتوى عند حذف آخر اسم ظاهر (قد تبقى الكتلة حتى جمع المهملات)
+                if names[candidate.inode] <= 0 and nlink <= 2:
+                    estimated -= candidate.size
+
+            if removed and self.after_eviction is not None:
+                self.after_eviction()
+            before = self.used_bytes
+            self.refresh()
+            with self._lock:
+                self.evictions += removed
+                self.evicted_bytes += max(0, before - self.used_bytes)
+                self.last_eviction = datetime.utcnow()
+            if removed:
+                logger.warning(
+                    "تجاوز التخزين العلامة العليا؛ حُذف %s ملفًا وأصبح الاستخدام %s من %s بايت.",
+                    removed,
+                    self.used_bytes,
+                    self.budget_bytes,
+                )
+            return removed
+        finally:
+            self._evicting.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "used_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+                "high_watermark_bytes": self.high_bytes,
+                "low_watermark_bytes": self.low_bytes,
+                "usage_ratio": round(self.used_bytes / self.budget_bytes, 3) if self.budget_bytes else None,
+                "pinned_files": len(self._pins) if self.pin_dir is None else len(self._shared_pins()),
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "last_eviction": self.last_eviction.isoformat() + "Z" if self.last_eviction else None,
+            }
+
+
+@lru_cache()
+def get_disk_budget() -> DiskBudget:
+    settings = get_settings()
+    downloads = settings.public_dir / "downloads"
+    budget = DiskBudget(
+        roots=(settings.storage_dir, settings.temp_dir, settings.outputs_dir, downloads),
+        evictable=(settings.temp_dir, settings.outputs_dir, downloads),
+        settings=settings,
+        pin_dir=settings.storage_dir / "pins",
+    )
+    budget.after_eviction = BlobStore(settings.storage_dir / "blobs").collect_garbage
+    return budget
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, List, Optional
+
+from fastapi import HTTPException, Request, status
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.utils.preview_cache import remember_digest
+
+from .local import LocalStorage
+
+PDF_MAGIC = b"%PDF-"
+# يسمح المعيار بوجود بايتات قبل ترويسة PDF ضمن أول 1024 بايت
+PDF_MAGIC_WINDOW = 1024
+
+
+@dataclass
+class IngestedUpload:
+    path: Path
+    filename: str
+    content_type: str
+    size_bytes: int
+    sha256: str
+
+
+class _UploadPart:
+    """حالة جزء ملف واحد أثناء القراءة: ملف الهدف والبصمة والحجم وفحص الترويسة."""
+
+    def __init__(self, path: Path, filename: str, content_type: str, *, expect_pdf: bool, max_bytes: int) -> None:
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.expect_pdf = expect_pdf
+        self.max_bytes = max_bytes
+
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.head = b""
+        self.sniffed = not expect_pdf
+        self.handle: IO[bytes] = path.open("wb")
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"حجم الملف يتجاوز الحد المسموح ({self.max_bytes // (1024 * 1024)} ميغابايت).",
+            )
+        if not self.sniffed:
+            self.head += data[:PDF_MAGIC_WINDOW]
+            self._sniff(final=False)
+        self.hasher.update(data)
+        self.handle.write(data)
+
+    def _sniff(self, *, final: bool) -> None:
+        if PDF_MAGIC in self.head[:PDF_MAGIC_WINDOW]:
+            self.sniffed = True
+            self.head = b""
+        elif final or len(self.head) >= PDF_MAGIC_WINDOW:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="الملف المرفوع ليس من نوع PDF.",
+            )
+
+    def finish(self) -> IngestedUpload:
+        self.handle.close()
+        if not self.sniffed:
+            self._sniff(final=True)
+        digest = self.hasher.hexdigest()
+        remember_digest(self.path, digest)
+        return IngestedUpload(
+            path=self.path,
+            filename=self.filename,
+            content_type=self.content_type,
+            size_bytes=self.size,
+            sha256=digest,
+        )
+
+    def abort(self) -> None:
+        self.handle.close()
+        self.path.unlink(missing_ok=True)
+
+
+class UploadIngestor:
+    """
+    استقبال الملفات المرفوعة مباشرة من جسم الطلب دون تخزين مؤقت وسيط.
+
+    تُكتب الأجزاء إلى موقعها النهائي أثناء وصولها مع حساب بصمة SHA-256،
+    ويُرفض الملف فور تجاوزه الحد الأقصى للحجم أو عند غياب ترويسة ‎%PDF-‎
+    من أول دفعة، قبل قراءة بقية الطلب.
+    """
+
+    def __init__(self, storage: Optional[LocalStorage] = None) -> None:
+        self.storage = storage or LocalStorage()
+        self.max_bytes = get_settings().max_upload_bytes
+
+    async def receive(
+        self,
+        request: Request,
+        *,
+        field: str,
+        expect_pdf: bool = True,
+        temp: bool = True,
+    ) -> List[IngestedUpload]:
+        content_type, options = parse_options_header(request.headers.get("content-type", ""))
+        boundary = options.get(b"boundary")
+        if content_type != b"multipart/form-data" or not boundary:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="يجب إرسال الملفات بصيغة multipart/form-data.",
+            )
+
+        completed: List[IngestedUpload] = []
+        headers: dict[bytes, bytes] = {}
+        header_field = bytearray()
+        header_value = bytearray()
+        current: dict[str, Optional[_UploadPart]] = {"part": None}
+
+        def on_part_begin() -> None:
+            headers.clear()
+
+        def on_header_field(data: bytes, start: int, end: int) -> None:
+            header_field.extend(data[start:end])
+
+        def on_header_value(data: bytes, start: int, end: int) -> None:
+            header_value.extend(data[start:end])
+
+        def on_header_end() -> None:
+            headers[bytes(header_field).lower()] = bytes(header_value)
+            header_field.clear()
+            header_value.clear()
+
+        def on_headers_finished() -> None:
+            _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+            name = disposition.get(b"name", b"").decode("utf-8", "replace")
+            raw_filename = disposition.get(b"filename")
+            if name != field or raw_filename is None:
+                return
+            filename = Path(raw_filename.decode("utf-8", "replace")).name
+            suffix = Path(filename).suffix or ".bin"
+            current["part"] = _UploadPart(
+                self.storage.allocate_path(suffix, temp=temp),
+                filename,
+                headers.get(b"content-type", b"application/octet-stream").decode("latin-1"),
+                expect_pdf=expect_pdf,
+                max_bytes=self.max_bytes,
+            )
+
+        def on_part_data(data: bytes, start: int, end: int) -> None:
+            part = current["part"]
+            if part is not None:
+                part.write(data[start:end])
+
+        def on_part_end() -> None:
+            part, current["part"] = current["part"], None
+            if part is None:
+                return
+            try:
+                completed.append(part.finish())
+            except BaseException:
+                # الفحص النهائي لترويسة ‎%PDF-‎ قد يرفض جسمًا أقصر من نافذة الفحص
+                part.abort()
+                raise
+
+        parser = MultipartParser(
+            boundary,
+            callbacks={
+                "on_part_begin": on_part_begin,
+                "on_header_field": on_header_field,
+                "on_header_value": on_header_value,
+                "on_header_end": on_header_end,
+                "on_headers_finished": on_headers_finished,
+                "on_part_data": on_part_data,
+                "on_part_end": on_part_end,
+            },
+        )
+
+        executor = get_executor()
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await executor.run_io(parser.write, chunk)
+            parser.finalize()
+        except BaseException:
+            if current["part"] is not None:
+                current["part"].abort()
+            self.storage.cleanup(upload.path for upload in completed)
+            raise
+
+        if not completed:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="لم يتم العثور على أي ملف في الطلب.",
+            )
+
+        # إعادة رفع المحتوى نفسه لا تستهلك مساحة إضافية
+        for upload in completed:
+            await executor.run_io(self.storage.deduplicate, upload.path, upload.sha256)
+        return completed
+
+    async def receive_one(self, request: Request, *, field: str = "file", expect_pdf: bool = True) -> IngestedUpload:
+        uploads = await self.receive(request, field=field, expect_pdf=expect_pdf)
+        if len(uploads) > 1:
+            self.storage.cleanup(upload.path for upload in uploads[1:])
+        return uploads[0]
+
+
+def upload_openapi(field: str, *, multiple: bool = False) -> dict:
+    """توصيف جسم الطلب في OpenAPI لنقاط الرفع التي تقرأ الطلب مباشرة."""
+    file_schema: dict = {"type": "string", "format": "binary"}
+    if multiple:
+        file_schema = {"type": "array", "items": file_schema}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": [field],
+                        "properties": {field: file_schema},
+                    }
+                }
+            },
+        }
+    }
@@ -1,12 +1,27 @@
-﻿import shutil
+﻿import os
+import shutil
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
 from pathlib import Path
-from typing import IO, Iterable, Optional
+from typing import IO, Dict, Iterable, Iterator, Optional
 from uuid import uuid4
 
 from fastapi import UploadFile
 
 from app.core.config import get_settings
 
+from .blobs import BlobStore
+
+
+@dataclass
+class OutputFile:
+    """ملف ناتج قيد الكتابة: handle يكتب إلى temp_path، ويظهر path فقط بعد اكتمال الكتابة."""
+
+    path: Path
+    temp_path: Path
+    handle: IO[bytes]
+
 
 class LocalStorage:
     """خدمات التخزين المحلية للملفات المرفوعة والنتائج القابلة للتنزيل."""
@@ -21,11 +36,42 @@ class LocalStorage:
         for directory in (self.base_dir, self.processed_dir, self.temp_dir, self.download_root):
             directory.mkdir(parents=True, exist_ok=True)
 
+        self.blobs = BlobStore(self.base_dir / "blobs")
+        self.retention_periods: Dict[str, timedelta] = {
+            "temp": timedelta(seconds=settings.temp_ttl_seconds),
+            "processed": timedelta(seconds=settings.processed_ttl_seconds),
+            "public": timedelta(seconds=settings.public_ttl_seconds),
+        }
+
+    @property
+    def category_dirs(self) -> Dict[str, Path]:
+        """المجلدات التي تُحذف ملفاتها بعد انتهاء مدة الاحتفاظ الخاصة بكل فئة."""
+        return {
+            "temp": self.temp_dir,
+            "processed": self.processed_dir,
+            "public": self.download_root,
+        }
+
+    def category_of(self, path: Path) -> str:
+        parent = Path(path).resolve().parent
+        for category, directory in self.category_dirs.items():
+            if parent == directory:
+                return category
+        return "temp"
+
+    def retention(self, path: Path) -> timedelta:
+        return self.retention_periods[self.category_of(path)]
+
     @staticmethod
     def _generate_filename(suffix: str) -> str:
         suffix = suffix if suffix.startswith(".") else f".{suffix.lstrip('.')}"
         return f"{uuid4().hex}{suffix}"
 
+    def allocate_path(self, suffix: str, *, temp: bool = False) -> Path:
+        """حجز مسار جديد لملف مرفوع دون إنشائه."""
+        directory = self.temp_dir if temp else self.base_dir
+        return directory / self._generate_filename(suffix)
+
     def save_upload(self, upload: UploadFile, *, temp: bool = False) -> Path:
         suffix = Path(upload.filename or "").suffix or ".bin"
         upload.file.seek(0)
@@ -47,19 +93,49 @@ class LocalStorage:
         target_path.write_bytes(data)
         return target_path
 
+    @contextmanager
+    def open_output(self, suffix: str = ".pdf", *, directory: Optional[Path] = None) -> Iterator[OutputFile]:
+        """
+        فتح ملف ناتج للكتابة المباشرة دون الاحتفاظ بمحتواه كاملًا في الذاكرة.
+
+        الكتابة تتم في ملف مؤقت مخفي داخل المجلد نفسه ثم يُعاد تسميته ذريًا عند الخروج
+        من الكتلة بنجاح؛ عند حدوث خطأ يُحذف الملف المؤقت ولا يظهر أي ملف ناقص.
+        """
+        directory = directory or self.processed_dir
+        target_path = directory / self._generate_filename(suffix)
+        temp_path = directory / f".{target_path.name}.part"
+        handle = temp_path.open("wb")
+        output = OutputFile(path=target_path, temp_path=temp_path, handle=handle)
+        try:
+            yield output
+            handle.close()
+            os.replace(temp_path, target_path)
+        except BaseException:
+            handle.close()
+            temp_path.unlink(missing_ok=True)
+            raise
+
     def move_to_processed(self, path: Path, *, new_name: Optional[str] = None) -> Path:
         destination = self.processed_dir / (new_name or path.name)
         shutil.move(path, destination)
         return destination
 
+    def deduplicate(self, path: Path, digest: Optional[str] = None) -> str:
+        """ضم الملف إلى مخزن المحتوى؛ النسخ المكررة تتحول إلى روابط لكتلة واحدة."""
+        return self.blobs.ingest(path, digest)
+
     def register_public_download(self, source: Path, original_name: str) -> Path:
         target = self.download_root / original_name
         if target.exists():
             target = self.download_root / f"{source.stem}-{uuid4().hex[:6]}{source.suffix}"
-        shutil.copy2(source, target)
-        return target
+        digest = self.blobs.ingest(source)
+        return self.blobs.link(digest, target)
 
     def cleanup(self, paths: Iterable[Path]) -> None:
+        linked = False
         for path in paths:
             if path and path.exists():
+                linked = linked or path.stat().st_nlink > 1
                 path.unlink(missing_ok=True)
+        if linked:
+            self.blobs.collect_garbage()
@@ -1,14 +1,27 @@
 ﻿from __future__ import annotations
 
+import heapq
+import json
 import mimetypes
+import sqlite3
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set, Tuple
 from uuid import uuid4
 
 from fastapi import HTTPException, status
-from pypdf import PdfReader
+from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.utils.document_cache import get_document_cache
+from app.utils.pdf_inspect import DocumentInfo, inspect_document
+from app.utils.preview_cache import get_preview_cache, remember_digest
+
+from .budget import get_disk_budget
+from .local import LocalStorage
 
 
 @dataclass
@@ -22,6 +35,15 @@ class RegisteredFile:
     extension: str
     page_count: Optional[int] = None
     is_pdf: bool = False
+    sha256: Optional[str] = None
+    expires_at: Optional[datetime] = None
+    encrypted: bool = False
+    repaired: bool = False
+    has_text: Optional[bool] = None
+    page_sizes: Optional[List[Tuple[float, float]]] = None
+
+    def is_expired(self, now: Optional[datetime] = None) -> bool:
+        return self.expires_at is not None and (now or datetime.utcnow()) >= self.expires_at
 
     def to_card(self, preview: Optional[str] = None) -> dict:
         card: dict = {
@@ -32,63 +54,368 @@ class RegisteredFile:
         }
         if self.page_count is not None:
             card["page_count"] = self.page_count
+        if self.is_pdf:
+            card["preview_url"] = f"/files/{self.file_id}/pages/1/preview"
+            card["encrypted"] = self.encrypted
+            if self.has_text is not None:
+                card["has_text"] = self.has_text
         if preview:
             card["preview"] = preview
         return card
 
 
-_registry: Dict[str, RegisteredFile] = {}
-_ttl = timedelta(hours=2)
+class MemoryRegistry:
+    """
+    سجل داخل ذاكرة العملية (مناسب لعامل uvicorn واحد أو للاختبارات).
 
+    أوقات الانتهاء محفوظة في كومة صغرى، فيكفي فحص رأسها لمعرفة ما انتهت صلاحيته.
+    """
 
-def register_document(path: Path, filename: str | None = None, expect_pdf: bool = True) -> RegisteredFile:
-    """تسجيل ملف مؤقتًا وإرجاع بياناته مع التحقق من كونه PDF عند الحاجة."""
-    cleanup()
-    filename = filename or path.name
-    extension = path.suffix.lower().lstrip(".")
-    mime_type, _ = mimetypes.guess_type(filename)
-    mime_type = mime_type or "application/octet-stream"
-    is_pdf = extension == "pdf"
+    def __init__(self) -> None:
+        self._entries: Dict[str, RegisteredFile] = {}
+        self._expiry: List[Tuple[datetime, str]] = []
+        self._lock = threading.Lock()
+
+    def add(self, entry: RegisteredFile) -> None:
+        with self._lock:
+            self._entries[entry.file_id] = entry
+            if entry.expires_at is not None:
+                heapq.heappush(self._expiry, (entry.expires_at, entry.file_id))
+
+    def get(self, file_id: str) -> Optional[RegisteredFile]:
+        return self._entries.get(file_id)
+
+    def remove(self, file_id: str) -> None:
+        # يبقى المعرف في الكومة ويُتجاهل عند خروجه منها
+        with self._lock:
+            self._entries.pop(file_id, None)
+
+    def pop_expired(self, now: datetime, limit: int) -> List[RegisteredFile]:
+        expired: List[RegisteredFile] = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now and len(expired) < limit:
+                _, file_id = heapq.heappop(self._expiry)
+                entry = self._entries.pop(file_id, None)
+                if entry is not None:
+                    expired.append(entry)
+        return expired
+
+    def live_paths(self, now: datetime) -> Set[str]:
+        with self._lock:
+            return {
+                str(entry.path)
+                for entry in self._entries.values()
+                if entry.expires_at is not None and entry.expires_at > now
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# الأوقات في السجل بتوقيت UTC دون منطقة زمنية، فنخزنها كثوانٍ منذ 1970 صراحةً
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_seconds(value: datetime) -> float:
+    return (value - _EPOCH).total_seconds()
+
+
+def _from_seconds(value: float) -> datetime:
+    return _EPOCH + timedelta(seconds=value)
+
+
+class SQLiteRegistry:
+    """
+    سجل دائم في SQLite (وضع WAL) مشترك بين عمال uvicorn ويبقى بعد إعادة التشغيل.
+
+    لكل خيط اتصال خاص به، والاستعلامات نصوص ثابتة تعيد sqlite3 استخدام صيغتها المجهزة.
+    أمامه ذاكرة قراءة صغيرة داخل العملية لأن السجلات لا تتغير بعد إنشائها.
+    """
+
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            mime_type TEXT NOT NULL,
+            extension TEXT NOT NULL,
+            page_count INTEGER,
+            is_pdf INTEGER NOT NULL,
+            sha256 TEXT,
+            expires_at REAL,
+            encrypted INTEGER NOT NULL DEFAULT 0,
+            repaired INTEGER NOT NULL DEFAULT 0,
+            has_text INTEGER,
+            page_sizes TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS files_created_at ON files (created_at)",
+    )
+    _MIGRATIONS = {
+        "expires_at": "ALTER TABLE files ADD COLUMN expires_at REAL",
+        "encrypted": "ALTER TABLE files ADD COLUMN encrypted INTEGER NOT NULL DEFAULT 0",
+        "repaired": "ALTER TABLE files ADD COLUMN repaired INTEGER NOT NULL DEFAULT 0",
+        "has_text": "ALTER TABLE files ADD COLUMN has_text INTEGER",
+        "page_sizes": "ALTER TABLE files ADD COLUMN page_sizes TEXT",
+    }
+    _INDEXES = ("CREATE INDEX IF NOT EXISTS files_expires_at ON files (expires_at)",)
+    _COLUMNS = (
+        "file_id, path, filename, size_bytes, created_at, mime_type, extension, page_count, is_pdf, "
+        "sha256, expires_at, encrypted, repaired, has_text, page_sizes"
+    )
+    _INSERT = f"INSERT OR REPLACE INTO files ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    _SELECT = f"SELECT {_COLUMNS} FROM files WHERE file_id = ?"
+    _DELETE = "DELETE FROM files WHERE file_id = ?"
+    _SELECT_EXPIRED = f"SELECT {_COLUMNS} FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?"
+    _SELECT_LIVE_PATHS = "SELECT path FROM files WHERE expires_at > ?"
+    _COUNT = "SELECT COUNT(*) FROM files"
+
+    def __init__(self, path: Path, cache_size: int = 256) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_size = max(0, cache_size)
+        self._local = threading.local()
+        self._cache: "OrderedDict[str, RegisteredFile]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        connection = self._connection()
+        with connection:
+            for statement in self._SCHEMA:
+                connection.execute(statement)
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(files)")}
+            for column, statement in self._MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(statement)
+            for statement in self._INDEXES:
+                connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(str(self.path), timeout=10, cached_statements=32)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    # ------------------------------------------------------------------
+    def _remember(self, entry: RegisteredFile) -> None:
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            self._cache[entry.file_id] = entry
+            self._cache.move_to_end(entry.file_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, file_id: str) -> None:
+        with self._cache_lock:
+            self._cache.pop(file_id, None)
+
+    # ------------------------------------------------------------------
+    def add(self, entry: RegisteredFile) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                self._INSERT,
+                (
+                    entry.file_id,
+                    str(entry.path),
+                    entry.filename,
+                    entry.size_bytes,
+                    _to_seconds(entry.created_at),
+                    entry.mime_type,
+                    entry.extension,
+                    entry.page_count,
+                    int(entry.is_pdf),
+                    entry.sha256,
+                    _to_seconds(entry.expires_at) if entry.expires_at else None,
+                    int(entry.encrypted),
+                    int(entry.repaired),
+                    None if entry.has_text is None else int(entry.has_text),
+                    json.dumps(entry.page_sizes, separators=(",", ":")) if entry.page_sizes is not None else None,
+                ),
+            )
+        self._remember(entry)
 
+    @staticmethod
+    def _from_row(row: tuple) -> RegisteredFile:
+        return RegisteredFile(
+            file_id=row[0],
+            path=Path(row[1]),
+            filename=row[2],
+            size_bytes=row[3],
+            created_at=_from_seconds(row[4]),
+            mime_type=row[5],
+            extension=row[6],
+            page_count=row[7],
+            is_pdf=bool(row[8]),
+            sha256=row[9],
+            expires_at=_from_seconds(row[10]) if row[10] is not None else None,
+            encrypted=bool(row[11]),
+            repaired=bool(row[12]),
+            has_text=None if row[13] is None else bool(row[13]),
+            page_sizes=[tuple(size) for size in json.loads(row[14])] if row[14] else None,
+        )
+
+    def get(self, file_id: str) -> Optional[RegisteredFile]:
+        with self._cache_lock:
+            entry = self._cache.get(file_id)
+            if entry is not None:
+                self._cache.move_to_end(file_id)
+                return entry
+
+        row = self._connection().execute(self._SELECT, (file_id,)).fetchone()
+        if row is None:
+            return None
+        entry = self._from_row(row)
+        self._remember(entry)
+        return entry
+
+    def remove(self, file_id: str) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(self._DELETE, (file_id,))
+        self._forget(file_id)
+
+    def pop_expired(self, now: datetime, limit: int) -> List[RegisteredFile]:
+        connection = self._connection()
+        with connection:
+            rows = connection.execute(self._SELECT_EXPIRED, (_to_seconds(now), limit)).fetchall()
+            connection.executemany(self._DELETE, [(row[0],) for row in rows])
+        expired = [self._from_row(row) for row in rows]
+        for entry in expired:
+            self._forget(entry.file_id)
+        return expired
+
+    def live_paths(self, now: datetime) -> Set[str]:
+        rows = self._connection().execute(self._SELECT_LIVE_PATHS, (_to_seconds(now),)).fetchall()
+        return {row[0] for row in rows}
+
+    def __len__(self) -> int:
+        return self._connection().execute(self._COUNT).fetchone()[0]
+
+
+@lru_cache()
+def get_registry() -> MemoryRegistry | SQLiteRegistry:
+    settings = get_settings()
+    if settings.registry_backend == "memory":
+        return MemoryRegistry()
+    return SQLiteRegistry(settings.registry_path, cache_size=settings.registry_cache_size)
+
+
+@lru_cache()
+def _storage() -> LocalStorage:
+    return LocalStorage()
+
+
+def _is_pdf(path: Path, expect_pdf: bool) -> bool:
+    is_pdf = path.suffix.lower() == ".pdf"
     if expect_pdf and not is_pdf:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="الملف المرفوع ليس من نوع PDF.",
         )
+    return is_pdf
 
-    page_count: Optional[int] = None
-    if is_pdf:
-        reader = PdfReader(str(path))
-        page_count = len(reader.pages)
+
+def _inspect(path: Path, **kwargs) -> DocumentInfo:
+    try:
+        return inspect_document(path, **kwargs)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
+
+
+def register_document(
+    path: Path,
+    filename: str | None = None,
+    expect_pdf: bool = True,
+    sha256: str | None = None,
+    info: DocumentInfo | None = None,
+) -> RegisteredFile:
+    """
+    تسجيل ملف مؤقتًا وإرجاع بياناته مع التحقق من كونه PDF عند الحاجة.
+
+    بيانات PDF تؤخذ من info إن مُررت (انظر ingest_document)، وإلا يُفحص الملف بفتحة واحدة دون رسم.
+    """
+    filename = filename or path.name
+    extension = path.suffix.lower().lstrip(".")
+    mime_type, _ = mimetypes.guess_type(filename)
+    mime_type = mime_type or "application/octet-stream"
+    is_pdf = _is_pdf(path, expect_pdf)
+
+    if is_pdf and info is None:
+        info = _inspect(path, digest=sha256, thumbnail_zoom=None)
 
     size_bytes = path.stat().st_size if path.exists() else 0
 
     file_id = uuid4().hex
+    created_at = datetime.utcnow()
     entry = RegisteredFile(
         file_id=file_id,
         path=path,
         filename=filename,
         size_bytes=size_bytes,
-        created_at=datetime.utcnow(),
+        created_at=created_at,
         mime_type=mime_type,
         extension=extension,
-        page_count=page_count,
+        page_count=info.page_count if info else None,
         is_pdf=is_pdf,
+        sha256=info.sha256 if info else sha256,
+        expires_at=created_at + _storage().retention(path),
+        encrypted=info.encrypted if info else False,
+        repaired=info.repaired if info else False,
+        has_text=info.has_text if info else None,
+        page_sizes=info.page_sizes if info else None,
     )
-    _registry[file_id] = entry
+    get_registry().add(entry)
+    get_disk_budget().charge(size_bytes)
     return entry
 
 
+async def ingest_document(
+    path: Path,
+    filename: str | None = None,
+    expect_pdf: bool = True,
+    sha256: str | None = None,
+) -> RegisteredFile:
+    """
+    فحص الملف وتسجيله بفتحة واحدة داخل مجمع العمليات.
+
+    التحقق والتشفير وعدد الصفحات وأبعادها والطبقة النصية ومعاينة الصفحة الأولى
+    كلها تُستخرج معًا، فتجد البطاقة المعاينة جاهزة في الذاكرة المؤقتة.
+    """
+    info: Optional[DocumentInfo] = None
+    if _is_pdf(path, expect_pdf):
+        thumbnail_zoom = 1.5 if get_settings().inline_previews else None
+        try:
+            info = await get_executor().run_cpu(
+                "inspect", inspect_document, path, digest=sha256, thumbnail_zoom=thumbnail_zoom
+            )
+        except ValueError as exc:
+            await get_executor().run_io(_storage().cleanup, [path])
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
+        remember_digest(path, info.sha256)
+        if info.thumbnail is not None:
+            get_preview_cache().remember(info.thumbnail_key, info.thumbnail)
+            info.thumbnail = None
+    return await get_executor().run_io(register_document, path, filename, expect_pdf, sha256, info)
+
+
 def get_document(file_id: str, require_pdf: bool = False) -> RegisteredFile:
-    cleanup()
-    entry = _registry.get(file_id)
-    if not entry:
+    registry = get_registry()
+    entry = registry.get(file_id)
+    if not entry or entry.is_expired():
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="المعرف المطلوب غير موجود أو انتهت صلاحيته.",
         )
     if not entry.path.exists():
-        _registry.pop(file_id, None)
+        registry.remove(file_id)
+        get_document_cache().invalidate(entry.path)
         raise HTTPException(
             status_code=status.HTTP_410_GONE,
             detail="الملف لم يعد متاحًا على الخادم.",
@@ -98,16 +425,35 @@ def get_document(file_id: str, require_pdf: bool = False) -> RegisteredFile:
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="الملف المختار ليس من نوع PDF.",
         )
+    # ترتيب الإخلاء عند امتلاء القرص يعتمد على آخر استخدام
+    get_disk_budget().touch(entry.path)
     return entry
 
 
 def unregister_document(file_id: str) -> None:
-    _registry.pop(file_id, None)
+    registry = get_registry()
+    entry = registry.get(file_id)
+    registry.remove(file_id)
+    if entry is not None:
+        # يغلق مقبض هذه العملية فقط؛ مقابض عمليات المعالجة تُغلق عند اكتشاف حذف الملف أو بعد خمولها
+        get_document_cache().invalidate(entry.path)
+
+
+def pop_expired(limit: int = 500) -> List[RegisteredFile]:
+    """إزالة دفعة من السجلات المنتهية الصلاحية (الأقدم انتهاءً أولًا) وإرجاعها لحذف ملفاتها."""
+    expired = get_registry().pop_expired(datetime.utcnow(), limit)
+    cache = get_document_cache()
+    for entry in expired:
+        cache.invalidate(entry.path)
+    return expired
+
+
+def live_paths() -> Set[str]:
+    """مسارات السجلات التي لم تنتهِ صلاحيتها؛ حذفها يتم عبر pop_expired عند انتهائها لا بحسب وقت تعديلها."""
+    return get_registry().live_paths(datetime.utcnow())
 
 
 def cleanup() -> None:
     """حذف السجلات المنتهية الصلاحية وفق مدة الاحتفاظ المحددة."""
-    now = datetime.utcnow()
-    expired = [file_id for file_id, entry in _registry.items() if now - entry.created_at > _ttl]
-    for file_id in expired:
-        _registry.pop(file_id, None)
+    while pop_expired():
+        pass
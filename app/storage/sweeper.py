@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.core.config import Settings, get_settings
+from app.core.executor import get_executor
+from app.core.logging import configure_logging
+
+from .budget import DiskBudget, get_disk_budget
+from .local import LocalStorage
+from .registry import live_paths, pop_expired
+
+logger = configure_logging()
+
+
+@dataclass
+class SweepReport:
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    duration_seconds: float = 0.0
+    registry_expired: int = 0
+    files_removed: Dict[str, int] = field(default_factory=dict)
+    blobs_removed: int = 0
+    bytes_reclaimed: int = 0
+    evicted: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "started_at": self.started_at.isoformat() + "Z",
+            "duration_seconds": round(self.duration_seconds, 3),
+            "registry_expired": self.registry_expired,
+            "files_removed": dict(self.files_removed),
+            "blobs_removed": self.blobs_removed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "evicted": self.evicted,
+        }
+
+
+class StorageSweeper:
+    """
+    منظف دوري يعمل في الخلفية.
+
+    1. يزيل سجلات الملفات المنتهية من السجل على دفعات ويحذف ملفاتها.
+    2. يحذف من مجلدات temp/processed/public الملفات غير المسجلة الأقدم من مدة الاحتفاظ الخاصة بكل فئة
+       (الملف المسجل يبقى حتى expires_at في السجل، فالرابط الصلب الجديد يرث وقت تعديل الكتلة القديمة).
+    3. يحذف كتل مخزن المحتوى التي لم يعد يشير إليها أي اسم.
+    4. يطبق ميزانية القرص ويخلي الأقدم استخدامًا عند تجاوز العلامة العليا.
+    """
+
+    def __init__(
+        self,
+        storage: Optional[LocalStorage] = None,
+        settings: Optional[Settings] = None,
+        budget: Optional[DiskBudget] = None,
+    ) -> None:
+        settings = settings or get_settings()
+        self.storage = storage or LocalStorage()
+        self.budget = budget or get_disk_budget()
+        self.interval = max(1, settings.sweep_interval_seconds)
+        self.batch_size = max(1, settings.sweep_batch_size)
+        self.last_report: Optional[SweepReport] = None
+        self.total_bytes_reclaimed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # ------------------------------------------------------------------
+    def _remove(self, path: Path, category: str, report: SweepReport) -> None:
+        """حذف اسم واحتساب البايتات المحررة فعليًا (صفر إذا بقيت روابط أخرى للمحتوى)."""
+        try:
+            stat = path.stat()
+            path.unlink()
+        except FileNotFoundError:
+            return
+        report.files_removed[category] = report.files_removed.get(category, 0) + 1
+        if stat.st_nlink <= 1:
+            report.bytes_reclaimed += stat.st_size
+
+    def sweep(self) -> SweepReport:
+        report = SweepReport()
+        started = time.monotonic()
+
+        while True:
+            expired = pop_expired(self.batch_size)
+            if not expired:
+                break
+            report.registry_expired += len(expired)
+            for entry in expired:
+                self._remove(entry.path, self.storage.category_of(entry.path), report)
+
+        now = time.time()
+        live = live_paths()
+        for category, directory in self.storage.category_dirs.items():
+            cutoff = now - self.storage.retention_periods[category].total_seconds()
+            batch: list[Path] = []
+            with os.scandir(directory) as entries:
+                for item in entries:
+                    if item.path in live or not item.is_file(follow_symlinks=False):
+                        continue
+                    if item.stat().st_mtime < cutoff:
+                        batch.append(Path(item.path))
+                    if len(batch) >= self.batch_size:
+                        for path in batch:
+                            self._remove(path, category, report)
+                        batch.clear()
+            for path in batch:
+                self._remove(path, category, report)
+
+        blobs_removed, blob_bytes = self.storage.blobs.collect_garbage()
+        report.blobs_removed = blobs_removed
+        report.bytes_reclaimed += blob_bytes
+
+        # بعد حذف المنتهي: إخلاء الأقدم استخدامًا إذا بقي الاستخدام فوق العلامة العليا
+        report.evicted = self.budget.enforce()
+
+        report.duration_seconds = time.monotonic() - started
+        self.last_report = report
+        self.total_bytes_reclaimed += report.bytes_reclaimed
+        return report
+
+    # ------------------------------------------------------------------
+    async def _loop(self) -> None:
+        executor = get_executor()
+        while True:
+            try:
+                report = await executor.run_io(self.sweep, operation="sweep")
+                if report.bytes_reclaimed or report.registry_expired:
+                    logger.info(
+                        "المنظف: حُذف %s ملفًا وتحرر %s بايت.",
+                        sum(report.files_removed.values()) + report.blobs_removed,
+                        report.bytes_reclaimed,
+                    )
+            except Exception:  # noqa: BLE001 - لا نوقف المنظف بسبب خطأ عابر
+                logger.exception("فشل تشغيل المنظف الدوري.")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="storage-sweeper")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "total_bytes_reclaimed": self.total_bytes_reclaimed,
+            "last_run": self.last_report.as_dict() if self.last_report else None,
+        }
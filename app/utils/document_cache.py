@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+from app.core.config import get_settings
+
+# أقل مدة بين فحصين لإغلاق مقابض الملفات المحذوفة
+_PRUNE_INTERVAL_SECONDS = 5.0
+
+
+@dataclass
+class _Handle:
+    document: fitz.Document
+    signature: Tuple[int, int, int]
+    lock: threading.RLock = field(default_factory=threading.RLock)
+    users: int = 0
+    stale: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class DocumentCache:
+    """
+    ذاكرة LRU لمقابض fitz.Document المفتوحة داخل العملية الحالية.
+
+    المفتاح مسار الملف (لكل file_id مسار واحد) مع رقم inode ووقت تعديله وحجمه، فيُعاد الفتح
+    تلقائيًا إذا تغير الملف. الـ inode ضروري لأن استبدال الاسم برابط صلب إلى كتلة مكررة
+    قد يُبقي الحجم نفسه ووقت تعديل أقدم. عدد المقابض (أي واصفات الملفات المفتوحة) محدود بـ max_handles، ولكل مقبض
+    قفل يمنع استخدامه من خيطين في الوقت نفسه.
+
+    العمليات التي تعدل المستند في الذاكرة (مثل الحفظ مع garbage) يجب أن تستدعي invalidate بعدها.
+
+    invalidate لا تصل إلى عمليات المعالجة الأخرى، فلكل عملية خيط خلفي يغلق المقابض غير المستخدمة
+    منذ idle_seconds والمقابض التي حُذف ملفها أو تغير، حتى لا يبقي عامل خامل واصفات ملفات محذوفة
+    (فلا تتحرر مساحتها على لينكس، ويفشل حذفها على ويندوز).
+    """
+
+    def __init__(self, max_handles: int = 16, idle_seconds: float = 30.0) -> None:
+        self.max_handles = max(1, max_handles)
+        self.idle_seconds = max(1.0, idle_seconds)
+        self._entries: "OrderedDict[str, _Handle]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+        self._reaper_pid: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_closed = 0
+
+    @staticmethod
+    def _signature(path: Path) -> Tuple[int, int, int]:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @contextmanager
+    def document(self, path: Path) -> Iterator[fitz.Document]:
+        """استعارة مقبض مفتوح للملف طوال كتلة with."""
+        handle = self._acquire(Path(path))
+        try:
+            with handle.lock:
+                yield handle.document
+        finally:
+            self._release(handle)
+
+    def _acquire(self, path: Path) -> _Handle:
+        self._ensure_reaper()
+        self._prune_if_due()
+        signature = self._signature(path)
+        key = str(path)
+        with self._lock:
+            handle = self._entries.get(key)
+            if handle is not None and handle.signature == signature:
+                self._entries.move_to_end(key)
+                handle.users += 1
+                self.hits += 1
+                return handle
+            if handle is not None:
+                self._discard(key)
+
+            self.misses += 1
+            handle = _Handle(document=fitz.open(path), signature=signature, users=1)
+            self._entries[key] = handle
+            self._trim()
+            return handle
+
+    def _release(self, handle: _Handle) -> None:
+        with self._lock:
+            handle.users -= 1
+            handle.last_used = time.monotonic()
+            if handle.stale and handle.users <= 0:
+                handle.document.close()
+            else:
+                self._trim()
+                self._close_idle()
+
+    def _discard(self, key: str) -> None:
+        # يُستدعى مع القفل؛ المقبض المستخدم حاليًا يُغلق عند إرجاعه
+        handle = self._entries.pop(key, None)
+        if handle is None:
+            return
+        handle.stale = True
+        if handle.users <= 0:
+            handle.document.close()
+
+    def _trim(self) -> None:
+        if len(self._entries) <= self.max_handles:
+            return
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_handles:
+                break
+            if self._entries[key].users <= 0:
+                self._discard(key)
+                self.evictions += 1
+
+    def _close_idle(self) -> None:
+        # يُستدعى مع القفل
+        cutoff = time.monotonic() - self.idle_seconds
+        for key, handle in list(self._entries.items()):
+            if handle.users <= 0 and handle.last_used < cutoff:
+                self._discard(key)
+                self.idle_closed += 1
+
+    def _ensure_reaper(self) -> None:
+        # خيط لكل عملية (العمليات الفرعية لا ترث خيوط الأب)
+        pid = os.getpid()
+        if self._reaper_pid == pid:
+            return
+        with self._lock:
+            if self._reaper_pid == pid:
+                return
+            self._reaper_pid = pid
+        threading.Thread(target=self._reap, name="document-cache-reaper", daemon=True).start()
+
+    def _reap(self) -> None:
+        interval = min(_PRUNE_INTERVAL_SECONDS, self.idle_seconds / 2)
+        while True:
+            time.sleep(interval)
+            self._prune_if_due(force=True)
+            with self._lock:
+                self._close_idle()
+
+    def _prune_if_due(self, force: bool = False) -> None:
+        # الملف المحذوف يبقى يشغل مساحة القرص ما دام مقبضه مفتوحًا
+        now = time.monotonic()
+        if not force and now - self._last_prune < _PRUNE_INTERVAL_SECONDS:
+            return
+        with self._lock:
+            self._last_prune = now
+            for key, handle in list(self._entries.items()):
+                try:
+                    current = self._signature(Path(key))
+                except FileNotFoundError:
+                    current = None
+                if current != handle.signature:
+                    self._discard(key)
+
+    def invalidate(self, path: Path) -> None:
+        with self._lock:
+            self._discard(str(path))
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open_handles": len(self._entries),
+                "max_handles": self.max_handles,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle_closed": self.idle_closed,
+            }
+
+
+@lru_cache()
+def get_document_cache() -> DocumentCache:
+    settings = get_settings()
+    return DocumentCache(settings.document_cache_size, settings.document_cache_idle_seconds)
+
+
+def open_document(path: Path):
+    """اختصار لـ get_document_cache().document(path)."""
+    return get_document_cache().document(path)
@@ -1,17 +1,11 @@
+import re
+import unicodedata
+import zipfile
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Iterable, Iterator, List, Tuple
+from urllib.parse import quote
 
-from fastapi import HTTPException, UploadFile, status
-
-
-def ensure_pdf(upload: UploadFile) -> None:
-    """التحقق من أن الملف المرفوع هو PDF."""
-    content_type = (upload.content_type or "").lower()
-    if not content_type.endswith("pdf"):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="يجب أن يكون الملف من نوع PDF.",
-        )
+from fastapi import HTTPException, status
 
 
 def file_stats(path: Path) -> Tuple[int, str]:
@@ -50,7 +44,65 @@ def parse_page_ranges(ranges: str, total_pages: int) -> List[Tuple[int, int]]:
     return result
 
 
+def content_disposition(filename: str, *, fallback: str = "download") -> str:
+    """
+    ترويسة Content-Disposition آمنة لاسم ملف قد يكون عربيًا أو من إدخال العميل.
+
+    الترويسات تُرمَّز latin-1، لذا يُرسل filename بصيغة ASCII منقحة مع filename* بترميز UTF-8 (RFC 6266).
+    """
+    name = Path(filename.replace("\\", "/")).name
+    name = "".join(char for char in name if unicodedata.category(char)[0] != "C").strip() or fallback
+    stem, suffix = Path(name).stem, Path(name).suffix
+    ascii_stem = unicodedata.normalize("NFKD", stem).encode("ascii", "ignore").decode("ascii")
+    ascii_stem = re.sub(r"[^A-Za-z0-9._-]+", "_", ascii_stem).strip("._")
+    ascii_suffix = re.sub(r"[^A-Za-z0-9.]+", "", suffix)
+    ascii_name = f"{ascii_stem or fallback}{ascii_suffix}"
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+
 def clean_temp_files(paths: Iterable[Path]) -> None:
     for path in paths:
         if path and path.exists():
             path.unlink(missing_ok=True)
+
+
+class _ZipSink:
+    """وجهة كتابة غير قابلة للتنقل يجمع فيها zipfile البايتات حتى تُرسل إلى العميل."""
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: Iterable[Tuple[str, Path]], *, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """
+    إنشاء أرشيف ZIP أثناء إرساله دون كتابته على القرص أو تجميعه في الذاكرة.
+
+    ملفات PDF مضغوطة أصلًا، لذا تُخزن دون ضغط إضافي (ZIP_STORED).
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, path in entries:
+            with path.open("rb") as source, archive.open(name, mode="w", force_zip64=True) as target:
+                for chunk in iter(lambda: source.read(chunk_size), b""):
+                    target.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
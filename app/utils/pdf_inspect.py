@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+from app.utils.document_cache import open_document
+from app.utils.pdf_preview import render_pixmap_png
+from app.utils.preview_cache import file_digest, get_preview_cache
+
+# عدد الصفحات الأولى التي يُبحث فيها عن طبقة نصية
+TEXT_SAMPLE_PAGES = 8
+
+
+@dataclass
+class DocumentInfo:
+    """نتيجة فحص ملف PDF بفتحة واحدة."""
+
+    sha256: str
+    page_count: int
+    page_sizes: List[Tuple[float, float]] = field(default_factory=list)
+    encrypted: bool = False
+    repaired: bool = False
+    has_text: bool = False
+    thumbnail: Optional[bytes] = None
+    thumbnail_key: Optional[str] = None
+
+
+def stream_length(document: "fitz.Document", xref: int) -> int:
+    """الطول المخزن للتدفق (بعد ضغطه) دون قراءة محتواه."""
+    kind, value = document.xref_get_key(xref, "Length")
+    if kind == "int":
+        return int(value)
+    if kind == "xref":
+        return int(document.xref_object(int(value.split()[0])).strip() or 0)
+    return 0
+
+
+def inspect_document(
+    pdf_path: Path,
+    *,
+    digest: Optional[str] = None,
+    thumbnail_zoom: Optional[float] = 1.5,
+) -> DocumentInfo:
+    """
+    فتح الملف مرة واحدة واستخراج كل ما يلزم لتسجيله وعرض بطاقته.
+
+    - عدد الصفحات من شجرة الصفحات وأبعادها من CropBox دون تحميل كائنات الصفحات.
+    - وجود طبقة نصية يُستدل عليه من خطوط الصفحات الأولى دون تحليل محتواها.
+    - تُرسم الصفحة الأولى (عند طلبها) وتُحفظ في ذاكرة المعاينات بمفتاح render_page_preview نفسه.
+
+    يرفع ValueError إذا كان الملف تالفًا أو محميًا بكلمة مرور.
+    """
+    digest = digest or file_digest(pdf_path)
+    try:
+        with open_document(pdf_path) as document:
+            return _inspect_open(document, digest, thumbnail_zoom)
+    except (fitz.FileDataError, RuntimeError) as exc:
+        raise ValueError("ملف PDF تالف أو غير صالح.") from exc
+
+
+def _inspect_open(document: "fitz.Document", digest: str, thumbnail_zoom: Optional[float]) -> DocumentInfo:
+    # الملفات المشفرة بكلمة مالك فقط تُفتح تلقائيًا، فنعتمد على قاموس التشفير في البيانات الوصفية
+    encrypted = bool(document.needs_pass or (document.metadata or {}).get("encryption"))
+    if document.needs_pass and not document.authenticate(""):
+        raise ValueError("الملف محمي بكلمة مرور ولا يمكن معالجته.")
+
+    page_count = document.page_count
+    if page_count < 1:
+        raise ValueError("ملف PDF تالف أو غير صالح.")
+
+    page_sizes = []
+    for index in range(page_count):
+        box = document.page_cropbox(index)
+        page_sizes.append((round(box.width, 2), round(box.height, 2)))
+
+    has_text = any(document.get_page_fonts(index) for index in range(min(page_count, TEXT_SAMPLE_PAGES)))
+
+    thumbnail = thumbnail_key = None
+    if thumbnail_zoom:
+        cache = get_preview_cache()
+        thumbnail_key = cache.make_key(digest, 1, size=f"z{thumbnail_zoom:g}", fmt="png")
+        thumbnail = cache.get(thumbnail_key)
+        if thumbnail is None:
+            thumbnail = render_pixmap_png(document.load_page(0), thumbnail_zoom)
+            cache.put(thumbnail_key, thumbnail)
+
+    return DocumentInfo(
+        sha256=digest,
+        page_count=page_count,
+        page_sizes=page_sizes,
+        encrypted=encrypted,
+        # تُقرأ بعد تحميل الصفحات لأن الإصلاح قد يحدث أثناءه
+        repaired=bool(document.is_repaired),
+        has_text=has_text,
+        thumbnail=thumbnail,
+        thumbnail_key=thumbnail_key,
+    )
@@ -1,40 +1,390 @@
+import asyncio
 import base64
+import json
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
 
 import fitz  # PyMuPDF
 
+from app.core.config import get_settings
+from app.core.executor import get_executor
+from app.utils.document_cache import open_document
+from app.utils.preview_cache import file_digest, get_preview_cache
+
+IMAGE_MEDIA_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+
+def _preview_key(pdf_path: Path, page_number: int, zoom: float, digest: Optional[str] = None) -> str:
+    return get_preview_cache().make_key(digest or file_digest(pdf_path), page_number, size=f"z{zoom:g}", fmt="png")
+
+
+async def _digest_async(pdf_path: Path, digest: Optional[str]) -> str:
+    """
+    بصمة الملف مرة واحدة في عملية الواجهة لتُمرر إلى العمال.
+
+    ذاكرة file_digest خاصة بكل عملية، فدون تمريرها يعيد كل عامل قراءة الملف كاملًا لحساب المفتاح.
+    البصمة المحفوظة في السجل (entry.sha256) تغني عن الحساب أصلًا.
+    """
+    return digest or await get_executor().run_io(file_digest, pdf_path)
+
+
+def png_data_uri(image_bytes: bytes) -> str:
+    encoded = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:image/png;base64,{encoded}"
+
+
+def render_pixmap_png(
+    page: "fitz.Page",
+    zoom: float = 1.5,
+    background: Optional[tuple[int, int, int]] = (255, 255, 255),
+) -> bytes:
+    """رسم صفحة محملة مسبقًا إلى PNG بمعامل التكبير المحدد."""
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+    if background and pixmap.alpha:  # pragma: no cover - يحتمل أن تكون شفافة
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+
+    return pixmap.tobytes("png")
+
 
 def render_page_preview(
     pdf_path: Path,
     page_number: int = 1,
     zoom: float = 1.5,
     background: Optional[tuple[int, int, int]] = (255, 255, 255),
+    digest: Optional[str] = None,
 ) -> str:
     """
     إنشاء صورة مصغرة للصفحة المحددة داخل ملف PDF وإرجاعها كسلسلة base64.
 
+    تُخزن الصور الناتجة في ذاكرة المعاينات، فلا يُفتح الملف عند وجود نسخة محفوظة.
+
     Args:
         pdf_path: المسار إلى ملف PDF.
         page_number: رقم الصفحة (يبدأ من 1).
         zoom: معامل التكبير للحصول على جودة أفضل.
         background: لون الخلفية RGB للصفحات الشفافة.
+        digest: بصمة SHA-256 للملف إن كانت معروفة (تغني عن قراءته لحساب المفتاح).
     """
     if page_number < 1:
         raise ValueError("page_number must be >= 1")
 
-    with fitz.open(pdf_path) as document:
+    cache = get_preview_cache()
+    key = _preview_key(pdf_path, page_number, zoom, digest)
+    image_bytes = cache.get(key)
+    if image_bytes is not None:
+        return png_data_uri(image_bytes)
+
+    with open_document(pdf_path) as document:
+        if page_number > document.page_count:
+            raise ValueError("page_number exceeds document pages")
+
+        image_bytes = render_pixmap_png(document.load_page(page_number - 1), zoom, background)
+
+    cache.put(key, image_bytes)
+    return png_data_uri(image_bytes)
+
+
+async def render_page_preview_async(
+    pdf_path: Path,
+    page_number: int = 1,
+    zoom: float = 1.5,
+    digest: Optional[str] = None,
+) -> str:
+    """فحص الذاكرة المؤقتة أولًا، ثم إرسال الرسم إلى مجمع العمليات عند عدم وجود نسخة محفوظة."""
+    executor = get_executor()
+    digest = await _digest_async(pdf_path, digest)
+    key = _preview_key(pdf_path, page_number, zoom, digest)
+    cache = get_preview_cache()
+    image_bytes = await executor.run_io(cache.get, key)
+    if image_bytes is not None:
+        return png_data_uri(image_bytes)
+
+    preview = await executor.run_cpu("preview", render_page_preview, pdf_path, page_number, zoom, digest=digest)
+    # طبقة القرص كُتبت داخل العامل، ونحتفظ بنسخة في ذاكرة هذه العملية أيضًا
+    cache.remember(key, base64.b64decode(preview.split(",", 1)[1]))
+    return preview
+
+
+def render_page_previews(
+    pdf_path: Path,
+    pages: Sequence[int],
+    zoom: float = 1.5,
+    digest: Optional[str] = None,
+) -> List[Tuple[int, str]]:
+    """رسم دفعة من الصفحات داخل عامل واحد بمقبض المستند نفسه."""
+    digest = digest or file_digest(pdf_path)
+    return [(page, render_page_preview(pdf_path, page, zoom, digest=digest)) for page in pages]
+
+
+def _cached_previews(pdf_path: Path, pages: Sequence[int], zoom: float, digest: str) -> Dict[int, bytes]:
+    cache = get_preview_cache()
+    found: Dict[int, bytes] = {}
+    for page in pages:
+        image_bytes = cache.get(_preview_key(pdf_path, page, zoom, digest))
+        if image_bytes is not None:
+            found[page] = image_bytes
+    return found
+
+
+def _chunk_pages(pages: Sequence[int], size: int) -> List[List[int]]:
+    # صفحات متجاورة في كل دفعة حتى تستفيد من ذاكرة الصفحات داخل المقبض نفسه
+    ordered = sorted(set(pages))
+    return [ordered[index : index + size] for index in range(0, len(ordered), size)]
+
+
+async def stream_page_previews(
+    pdf_path: Path,
+    pages: Sequence[int],
+    *,
+    zoom: float = 1.5,
+    chunk_size: int = 8,
+    digest: Optional[str] = None,
+) -> AsyncIterator[Tuple[int, str]]:
+    """
+    إرجاع معاينات الصفحات واحدة تلو الأخرى فور جاهزيتها.
+
+    المحفوظ في الذاكرة المؤقتة يُرسل أولًا، ثم تُوزع بقية الصفحات على مجمع العمليات
+    في دفعات متجاورة (حدود التوازي من إعدادات عملية preview) وتُرسل كل دفعة عند اكتمالها.
+    """
+    executor = get_executor()
+    cache = get_preview_cache()
+
+    digest = await _digest_async(pdf_path, digest)
+    cached = await executor.run_io(_cached_previews, pdf_path, pages, zoom, digest)
+    for page, image_bytes in sorted(cached.items()):
+        yield page, png_data_uri(image_bytes)
+
+    missing = [page for page in pages if page not in cached]
+    tasks = [
+        asyncio.ensure_future(executor.run_cpu("preview", render_page_previews, pdf_path, chunk, zoom, digest))
+        for chunk in _chunk_pages(missing, max(1, chunk_size))
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            for page, preview in await finished:
+                cache.remember(_preview_key(pdf_path, page, zoom, digest), base64.b64decode(preview.split(",", 1)[1]))
+                yield page, preview
+    finally:
+        # انقطاع الاتصال يلغي الدفعات التي لم تبدأ بعد
+        for task in tasks:
+            task.cancel()
+
+
+# ----------------------------------------------------------------------
+# صور المعاينة الثنائية بعرض محدد
+# ----------------------------------------------------------------------
+def page_image_key(
+    pdf_path: Path,
+    page_number: int,
+    width: int,
+    fmt: str,
+    quality: int,
+    digest: Optional[str] = None,
+) -> str:
+    """مفتاح الذاكرة المؤقتة لصورة الصفحة، ويُستخدم أيضًا كقيمة ETag قوية."""
+    digest = digest or file_digest(pdf_path)
+    return get_preview_cache().make_key(digest, page_number, size=f"w{width}q{quality}", fmt=fmt)
+
+
+def _encode_pixmap(pixmap: "fitz.Pixmap", fmt: str, quality: int) -> bytes:
+    if fmt == "jpeg":
+        return pixmap.tobytes("jpeg", jpg_quality=quality)
+    if fmt == "webp":
+        # PyMuPDF لا يكتب WebP مباشرة، فنمر عبر Pillow (متوفر مع reportlab)
+        return pixmap.pil_tobytes(format="WEBP", quality=quality)
+    return pixmap.tobytes("png")
+
+
+def render_page_image(
+    pdf_path: Path,
+    page_number: int = 1,
+    width: int = 320,
+    fmt: str = "jpeg",
+    quality: int = 75,
+    digest: Optional[str] = None,
+) -> bytes:
+    """
+    رسم الصفحة مباشرة بالعرض المطلوب بالبكسل وإرجاع بايتات الصورة بالصيغة المحددة.
+
+    Args:
+        pdf_path: المسار إلى ملف PDF.
+        page_number: رقم الصفحة (يبدأ من 1).
+        width: عرض الصورة الناتجة بالبكسل.
+        fmt: صيغة الصورة (jpeg | webp | png).
+        quality: جودة الضغط لصيغتي JPEG وWebP.
+        digest: بصمة SHA-256 للملف إن كانت معروفة.
+    """
+    if page_number < 1:
+        raise ValueError("page_number must be >= 1")
+    if fmt not in IMAGE_MEDIA_TYPES:
+        raise ValueError(f"unsupported image format: {fmt}")
+
+    cache = get_preview_cache()
+    key = page_image_key(pdf_path, page_number, width, fmt, quality, digest)
+    image_bytes = cache.get(key)
+    if image_bytes is not None:
+        return image_bytes
+
+    with open_document(pdf_path) as document:
         if page_number > document.page_count:
             raise ValueError("page_number exceeds document pages")
 
         page = document.load_page(page_number - 1)
-        matrix = fitz.Matrix(zoom, zoom)
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+        zoom = width / page.rect.width if page.rect.width else 1.0
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        image_bytes = _encode_pixmap(pixmap, fmt, quality)
 
-        if background and pixmap.alpha:  # pragma: no cover - يحتمل أن تكون شفافة
-            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    cache.put(key, image_bytes)
+    return image_bytes
 
-        image_bytes = pixmap.tobytes("png")
 
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
-    return f"data:image/png;base64,{encoded}"
+async def render_page_image_async(
+    pdf_path: Path,
+    page_number: int = 1,
+    width: int = 320,
+    fmt: str = "jpeg",
+    quality: int = 75,
+    digest: Optional[str] = None,
+) -> tuple[bytes, str]:
+    """إرجاع بايتات الصورة مع مفتاحها (لاستخدامه كـ ETag) مع تجنب مجمع العمليات عند وجود نسخة محفوظة."""
+    executor = get_executor()
+    digest = await _digest_async(pdf_path, digest)
+    key = page_image_key(pdf_path, page_number, width, fmt, quality, digest)
+    cache = get_preview_cache()
+    image_bytes = await executor.run_io(cache.get, key)
+    if image_bytes is None:
+        image_bytes = await executor.run_cpu(
+            "preview", render_page_image, pdf_path, page_number, width, fmt, quality, digest
+        )
+        cache.remember(key, image_bytes)
+    return image_bytes, key
+
+
+async def card_preview(pdf_path: Path, digest: Optional[str] = None) -> Optional[str]:
+    """معاينة الصفحة الأولى المضمنة في البطاقات، أو None عند تعطيلها لصالح preview_url."""
+    if not get_settings().inline_previews:
+        return None
+    return await render_page_preview_async(pdf_path, 1, digest=digest)
+
+
+# ----------------------------------------------------------------------
+# لوحة مصغرات (contact sheet) لمدى من الصفحات في صورة واحدة
+# ----------------------------------------------------------------------
+# أقصى بُعد تقبله ترميزات WebP (ويقبل JPEG حتى 65535)
+CONTACT_SHEET_MAX_SIDE = 16383
+
+
+def contact_sheet_keys(
+    pdf_path: Path,
+    start: int,
+    end: int,
+    width: int,
+    columns: int,
+    fmt: str,
+    quality: int,
+    digest: Optional[str] = None,
+) -> Tuple[str, str]:
+    """مفتاحا الصورة وفهرس المربعات في الذاكرة المؤقتة؛ مفتاح الصورة يُستخدم أيضًا كـ ETag."""
+    cache = get_preview_cache()
+    digest = digest or file_digest(pdf_path)
+    size = f"sheet{end}w{width}c{columns}q{quality}"
+    return cache.make_key(digest, start, size=size, fmt=fmt), cache.make_key(digest, start, size=size, fmt="json")
+
+
+def render_contact_sheet(
+    pdf_path: Path,
+    start: int,
+    end: int,
+    width: int = 120,
+    columns: int = 10,
+    fmt: str = "jpeg",
+    quality: int = 70,
+    digest: Optional[str] = None,
+) -> Tuple[bytes, dict]:
+    """
+    رسم صفحات المدى [start, end] بعرض ثابت في صورة واحدة وإرجاعها مع فهرس مواقع المربعات.
+
+    كل صفحة تشغل خلية بعرض width، وارتفاع الصف هو أطول صفحة فيه؛ تُرسم الصفحات مباشرة
+    بالحجم الصغير داخل عامل واحد وبمقبض المستند نفسه.
+    """
+    if fmt not in ("jpeg", "webp"):
+        raise ValueError(f"unsupported contact sheet format: {fmt}")
+
+    cache = get_preview_cache()
+    image_key, index_key = contact_sheet_keys(pdf_path, start, end, width, columns, fmt, quality, digest)
+    image_bytes, index_bytes = cache.get(image_key), cache.get(index_key)
+    if image_bytes is not None and index_bytes is not None:
+        return image_bytes, json.loads(index_bytes)
+
+    with open_document(pdf_path) as document:
+        if start < 1 or end > document.page_count or start > end:
+            raise ValueError("page range exceeds document pages")
+
+        pixmaps: List["fitz.Pixmap"] = []
+        for page_number in range(start, end + 1):
+            page = document.load_page(page_number - 1)
+            zoom = width / page.rect.width if page.rect.width else 1.0
+            pixmaps.append(page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False))
+
+    columns = max(1, min(columns, len(pixmaps)))
+    row_heights = [
+        max(pixmap.height for pixmap in pixmaps[row : row + columns]) for row in range(0, len(pixmaps), columns)
+    ]
+    sheet_width = columns * width
+    sheet_height = sum(row_heights)
+    if sheet_width > CONTACT_SHEET_MAX_SIDE or sheet_height > CONTACT_SHEET_MAX_SIDE:
+        raise ValueError("contact sheet too large")
+
+    sheet = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, sheet_width, sheet_height), False)
+    sheet.clear_with(255)
+
+    tiles: List[dict] = []
+    y = 0
+    for row, row_height in enumerate(row_heights):
+        for column, pixmap in enumerate(pixmaps[row * columns : (row + 1) * columns]):
+            x = column * width
+            pixmap.set_origin(x, y)
+            sheet.copy(pixmap, pixmap.irect)
+            tiles.append(
+                {"page": start + row * columns + column, "x": x, "y": y, "width": pixmap.width, "height": pixmap.height}
+            )
+        y += row_height
+
+    image_bytes = _encode_pixmap(sheet, fmt, quality)
+    index = {"width": sheet_width, "height": sheet_height, "tile_width": width, "columns": columns, "tiles": tiles}
+    cache.put(image_key, image_bytes)
+    cache.put(index_key, json.dumps(index, separators=(",", ":")).encode("utf-8"))
+    return image_bytes, index
+
+
+async def render_contact_sheet_async(
+    pdf_path: Path,
+    start: int,
+    end: int,
+    width: int = 120,
+    columns: int = 10,
+    fmt: str = "jpeg",
+    quality: int = 70,
+    digest: Optional[str] = None,
+) -> Tuple[bytes, dict, str]:
+    """إرجاع (الصورة، الفهرس، مفتاح الصورة) مع تجنب مجمع العمليات عند وجود نسخة محفوظة."""
+    executor = get_executor()
+    cache = get_preview_cache()
+    digest = await _digest_async(pdf_path, digest)
+    image_key, index_key = contact_sheet_keys(pdf_path, start, end, width, columns, fmt, quality, digest)
+    image_bytes = await executor.run_io(cache.get, image_key)
+    index_bytes = await executor.run_io(cache.get, index_key)
+    if image_bytes is not None and index_bytes is not None:
+        return image_bytes, json.loads(index_bytes), image_key
+
+    image_bytes, index = await executor.run_cpu(
+        "preview", render_contact_sheet, pdf_path, start, end, width, columns, fmt, quality, digest
+    )
+    cache.remember(image_key, image_bytes)
+    cache.remember(index_key, json.dumps(index, separators=(",", ":")).encode("utf-8"))
+    return image_bytes, index, image_key
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+from app.core.config import get_settings
+
+_DIGEST_CHUNK = 1024 * 1024
+_DIGEST_MEMO_SIZE = 1024
+
+_digest_memo: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+_digest_lock = threading.Lock()
+
+
+def file_digest(path: Path) -> str:
+    """
+    بصمة SHA-256 لمحتوى الملف.
+
+    تُحفظ البصمة مع حجم الملف ووقت تعديله حتى لا يُعاد حسابها إلا عند تغير الملف.
+    """
+    stat = os.stat(path)
+    memo_key = str(path)
+    with _digest_lock:
+        memo = _digest_memo.get(memo_key)
+        if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+            _digest_memo.move_to_end(memo_key)
+            return memo[2]
+
+    hasher = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(_DIGEST_CHUNK), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    remember_digest(path, digest, stat=stat)
+    return digest
+
+
+def remember_digest(path: Path, digest: str, *, stat: Optional[os.stat_result] = None) -> None:
+    """تسجيل بصمة معروفة مسبقًا (مثلًا بعد حسابها أثناء الرفع)."""
+    stat = stat or os.stat(path)
+    with _digest_lock:
+        _digest_memo[str(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+        _digest_memo.move_to_end(str(path))
+        while len(_digest_memo) > _DIGEST_MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+
+
+class PreviewCache:
+    """
+    ذاكرة مؤقتة من طبقتين لصور معاينة الصفحات.
+
+    - طبقة ذاكرة LRU بعدد عناصر محدد داخل كل عملية.
+    - طبقة قرص مشتركة بين العمليات بحد أقصى للحجم بالبايت، تُخلى الأقدم استخدامًا أولًا.
+
+    المفتاح مبني على بصمة محتوى الملف ورقم الصفحة ومعامل الحجم والصيغة،
+    لذلك لا يلزم إبطال المدخلات عند حذف الملف أو إعادة رفعه.
+    """
+
+    def __init__(self, directory: Path, max_items: int, max_disk_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_items = max(0, max_items)
+        self.max_disk_bytes = max(0, max_disk_bytes)
+
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load_disk_index()
+
+    # ------------------------------------------------------------------
+    @staticmethod
+    def make_key(digest: str, page_number: int, *, size: str, fmt: str) -> str:
+        raw = f"{digest}:{page_number}:{size}:{fmt.lower()}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.bin"
+
+    def _load_disk_index(self) -> None:
+        entries = []
+        for path in self.directory.glob("*/*.bin"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    # ------------------------------------------------------------------
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+
+        path = self._disk_path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                # قد تكون عملية أخرى أخلت الملف من القرص
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+        os.utime(path)
+        with self._lock:
+            self.disk_hits += 1
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        self.remember(key, data)
+
+    def remember(self, key: str, data: bytes) -> None:
+        """تسجيل صورة موجودة على القرص مسبقًا (كتبتها عملية أخرى) في فهرس هذه العملية."""
+        with self._lock:
+            self._remember(key, data)
+            previous = self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data) - previous
+            victims = self._collect_disk_victims()
+
+        for victim in victims:
+            self._disk_path(victim).unlink(missing_ok=True)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if not self.max_items:
+            return
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _collect_disk_victims(self) -> list[str]:
+        victims: list[str] = []
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            victims.append(key)
+        return victims
+
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_items": len(self._memory),
+                "disk_items": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+
+@lru_cache()
+def get_preview_cache() -> PreviewCache:
+    settings = get_settings()
+    return PreviewCache(
+        directory=settings.preview_cache_dir,
+        max_items=settings.preview_cache_items,
+        max_disk_bytes=settings.preview_cache_disk_bytes,
+    )
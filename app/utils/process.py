@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import os
+
+# ثوابت Win32 لفحص العملية دون إرسال إشارة إليها
+_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+_STILL_ACTIVE = 259
+_ERROR_ACCESS_DENIED = 5
+
+
+def process_alive(pid: int) -> bool:
+    """
+    هل العملية pid ما زالت تعمل على هذا الجهاز؟
+
+    على ويندوز لا يجوز استخدام os.kill(pid, 0): الإشارة 0 هناك هي CTRL_C_EVENT وتُرسل إلى مجموعة
+    الطرفية كلها، لذا يُستخدم OpenProcess/GetExitCodeProcess. على POSIX تكفي الإشارة 0 للفحص فقط.
+    """
+    if pid <= 0:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        return _windows_process_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # موجودة لكن بلا صلاحية إرسال إشارات إليها
+    return True
+
+
+def _windows_process_alive(pid: int) -> bool:  # pragma: no cover - يعمل على ويندوز فقط
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    handle = kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # رفض الوصول يعني أن العملية موجودة لكنها تخص مستخدمًا آخر
+        return ctypes.get_last_error() == _ERROR_ACCESS_DENIED
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == _STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
@@ -0,0 +1,147 @@
+"""
+مقارنة محركي الدمج (pymupdf وpypdf) من حيث الزمن وذروة الذاكرة وحجم الناتج.
+
+يُنشئ ملفات إدخال صناعية يتكرر فيها الشعار نفسه (كما في العقود والتقارير المصدرة من القالب ذاته)،
+ثم يدمجها كل محرك في عملية مستقلة حتى تُقاس ذروة الذاكرة بشكل منفصل.
+
+الاستخدام (من جذر المستودع):
+    python scripts/benchmark_merge.py
+    python scripts/benchmark_merge.py --counts 10 100 --pages 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+ENGINES = ("pypdf", "pymupdf")
+
+
+def _make_inputs(directory: Path, count: int, pages: int) -> list[Path]:
+    import fitz
+
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 256, 256), False)
+    for x in range(0, 256, 8):
+        for y in range(0, 256, 8):
+            logo.set_rect(fitz.IRect(x, y, x + 8, y + 8), ((x * 7) % 256, (y * 5) % 256, (x + y) % 256))
+    logo_bytes = logo.tobytes("png")
+
+    paths = []
+    for index in range(count):
+        with fitz.open() as document:
+            for page_number in range(pages):
+                page = document.new_page()
+                page.insert_image(fitz.Rect(36, 36, 136, 136), stream=logo_bytes)
+                page.insert_text((36, 180), f"Document {index} - page {page_number + 1}", fontsize=14)
+            document.set_toc([[1, f"Document {index}", 1]])
+            path = directory / f"input_{index:04d}.pdf"
+            document.save(path, garbage=3, deflate=True)
+            paths.append(path)
+    return paths
+
+
+def _peak_rss_bytes() -> int:
+    """
+    ذروة الذاكرة المقيمة للعملية الحالية بالبايت.
+
+    tracemalloc لا يرى ذاكرة MuPDF المحجوزة من C، فنقرأ الذروة من نظام التشغيل:
+    GetProcessMemoryInfo على Windows، وru_maxrss على غيره (بالبايت على macOS وبالكيلوبايت على Linux).
+    """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.WinDLL("kernel32")
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi = ctypes.WinDLL("psapi")
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD]
+        if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            raise ctypes.WinError()
+        return counters.PeakWorkingSetSize
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_engine(engine: str, inputs: list[Path]) -> dict:
+    """يُنفذ داخل عملية فرعية: دمج واحد وإرجاع القياسات."""
+    sys.path.insert(0, str(ROOT))
+    from app.services.pdf_service import PDFService
+
+    service = PDFService(merge_engine=engine)
+    started = time.perf_counter()
+    output = service.merge(inputs)
+    elapsed = time.perf_counter() - started
+    peak_bytes = _peak_rss_bytes()
+    size = output.stat().st_size
+    output.unlink(missing_ok=True)
+    return {"engine": engine, "seconds": round(elapsed, 3), "peak_rss_mib": round(peak_bytes / (1024 * 1024), 1), "output_bytes": size}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 500], help="أعداد ملفات الإدخال")
+    parser.add_argument("--pages", type=int, default=3, help="عدد الصفحات في كل ملف")
+    parser.add_argument("--run", nargs=2, metavar=("ENGINE", "MANIFEST"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        engine, manifest = args.run
+        inputs = [Path(line) for line in Path(manifest).read_text().splitlines() if line]
+        print(json.dumps(_run_engine(engine, inputs)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="merge-bench-") as workdir:
+        workdir_path = Path(workdir)
+        # نوجه مجلدات التطبيق إلى مجلد مؤقت حتى لا تلوث نواتج القياس مجلد outputs
+        env = dict(os.environ, STORAGE_DIR=str(workdir_path / "storage"), PUBLIC_DIR=str(workdir_path / "public"))
+
+        print(f"{'inputs':>7} {'engine':>8} {'seconds':>9} {'peak MiB':>9} {'output bytes':>13}")
+        for count in args.counts:
+            inputs_dir = workdir_path / f"inputs_{count}"
+            inputs_dir.mkdir()
+            inputs = _make_inputs(inputs_dir, count, args.pages)
+            manifest = inputs_dir / "manifest.txt"
+            manifest.write_text("\n".join(str(path) for path in inputs))
+
+            for engine in ENGINES:
+                completed = subprocess.run(
+                    [sys.executable, __file__, "--run", engine, str(manifest)],
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                print(
+                    f"{count:>7} {result['engine']:>8} {result['seconds']:>9} "
+                    f"{result['peak_rss_mib']:>9} {result['output_bytes']:>13}"
+                )
+
+
+if __name__ == "__main__":
+    main()